@@ -0,0 +1,59 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# ufit, a universal scattering fitting suite
+#
+# Copyright (c) 2013-2020, Georg Brandl and contributors.  All rights reserved.
+# Licensed under a 2-clause BSD license, see LICENSE.
+# *****************************************************************************
+
+"""Tests for combining models."""
+
+from numpy import allclose, linspace
+
+from ufit.models import CombinedModel, Const, Gauss, SumModel
+
+X = linspace(-3, 3, 31)
+
+
+def values(model):
+    return dict((p.name, p.value) for p in model.params)
+
+
+def check_components(model, peaks, mods):
+    p = values(model)
+    comps = model.get_components()
+    assert len(comps) == len(peaks)
+    background = sum(m.fcn(p, X) for m in mods)
+    for comp in comps:
+        # components of components must work as well
+        assert len(comp.get_components()) == 1
+    assert sorted(tuple(c.fcn(p, X)) for c in comps) == \
+        sorted(tuple(background + g.fcn(p, X)) for g in peaks)
+
+
+def test_sum_components():
+    peaks = [Gauss('p%d' % i, pos=i - 1, ampl=i + 1, fwhm=0.5)
+             for i in range(3)]
+    mods = [Const('b1', 1.0), Const('b2', 0.5)]
+    model = peaks[0] + mods[0] + peaks[1] + mods[1] + peaks[2]
+    assert isinstance(model, SumModel)
+    check_components(model, peaks, mods)
+
+
+def test_combined_with_sum_components():
+    peaks = [Gauss('p%d' % i, pos=i - 1, ampl=i + 1, fwhm=0.5)
+             for i in range(3)]
+    mods = [Const('b1', 1.0), Const('b2', 0.5)]
+    model = CombinedModel(SumModel(peaks[0], mods[0], peaks[1]),
+                          SumModel(mods[1], peaks[2]), '+')
+    p = values(model)
+    assert allclose(model.fcn(p, X),
+                    sum(m.fcn(p, X) for m in peaks + mods))
+    # the second operand is one component, including its modifier
+    comps = model.get_components()
+    assert len(comps) == 3
+    for comp in comps:
+        comp.get_components()
+    model = CombinedModel(SumModel(peaks[0], mods[0], peaks[1], mods[1]),
+                          peaks[2], '+')
+    check_components(model, peaks, mods)
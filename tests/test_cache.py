@@ -0,0 +1,38 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# ufit, a universal scattering fitting suite
+#
+# Copyright (c) 2013-2020, Georg Brandl and contributors.  All rights reserved.
+# Licensed under a 2-clause BSD license, see LICENSE.
+# *****************************************************************************
+
+"""Tests for the data cache."""
+
+from ufit.data import ill
+from ufit.data.cache import DataCache
+
+FORMATS = {'ill': ill}
+
+
+def test_put_get(tmpdir):
+    cache = DataCache(str(tmpdir.join('cache')))
+    fn = str(tmpdir.join('data'))
+    with open(fn, 'w') as fp:
+        fp.write('contents')
+    signature = cache.signature(fn)
+    cache.put(fn, 'ill', ill, 'result', signature)
+    assert cache.get(fn, FORMATS) == ('ill', 'result')
+
+
+def test_changed_while_reading(tmpdir):
+    cache = DataCache(str(tmpdir.join('cache')))
+    fn = str(tmpdir.join('data'))
+    with open(fn, 'w') as fp:
+        fp.write('contents')
+    signature = cache.signature(fn)
+    # file grows after the signature was taken: the result may be partial
+    with open(fn, 'a') as fp:
+        fp.write('more contents')
+    cache.put(fn, 'ill', ill, 'result', signature)
+    assert cache.get(fn, FORMATS) is None
+    assert cache.stats()['size'] == 0
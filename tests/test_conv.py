@@ -0,0 +1,51 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# ufit, a universal scattering fitting suite
+#
+# Copyright (c) 2013-2020, Georg Brandl and contributors.  All rights reserved.
+# Licensed under a 2-clause BSD license, see LICENSE.
+# *****************************************************************************
+
+"""Tests for the convolution models."""
+
+import pickle
+
+from numpy import linspace, allclose
+
+from ufit.models import Gauss, KernelConvolution
+
+
+def make_model():
+    return KernelConvolution(Gauss('p', pos=0, ampl=1, fwhm=0.5),
+                             (linspace(-2, 2, 5), linspace(0.1, 0.3, 5)),
+                             nsigma=3)
+
+
+def evaluate(model, x):
+    return model.fcn(dict((p.name, p.value) for p in model.params), x)
+
+
+def test_copy():
+    model = make_model()
+    copy = model.copy()
+    assert copy.name == model.name
+    assert copy._nsigma == 3
+    assert [p.name for p in copy.params] == [p.name for p in model.params]
+    x = linspace(-1, 1, 21)
+    assert allclose(evaluate(copy, x), evaluate(model, x))
+
+
+def test_pickle():
+    model = make_model()
+    model.params[0].value = 0.2
+    other = pickle.loads(pickle.dumps(model))
+    assert other.params[0].value == 0.2
+    x = linspace(-1, 1, 21)
+    assert allclose(evaluate(other, x), evaluate(model, x))
+
+
+def test_description():
+    model = make_model()
+    desc = model.get_description()
+    assert 'nsigma=3' in desc
+    assert 'numpy.array' in desc
@@ -0,0 +1,102 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# ufit, a universal scattering fitting suite
+#
+# Copyright (c) 2013-2020, Georg Brandl and contributors.  All rights reserved.
+# Licensed under a 2-clause BSD license, see LICENSE.
+# *****************************************************************************
+
+"""Tests for the optimizing compiler of Custom model expressions."""
+
+import pytest
+from numpy import arange, array, float32, linspace
+
+from ufit.models import Custom
+from ufit.models.exprcomp import ExprError, compile_expr
+from ufit.param import expr_namespace
+from ufit.pycompat import exec_
+
+GAUSS = 'ampl*exp(-(x - pos)**2/fwhm**2*4*log(2))'
+LORENTZ = 'ampl*(fwhm/2)**2/((x - pos)**2 + (fwhm/2)**2)'
+PSVOIGT = 'ampl*((1 - eta)*exp(-(x - pos)**2/fwhm**2*4*log(2)) + ' \
+    'eta*(fwhm/2)**2/((x - pos)**2 + (fwhm/2)**2))'
+
+VALUES = {'ampl': 3.0, 'pos': 0.4, 'fwhm': 1.5, 'eta': 0.3, 'a': 2.0,
+          'k': 1.5}
+
+
+def plain(expr, p, x):
+    return eval(expr, dict(expr_namespace, x=x, **p))
+
+
+def optimized(expr, params):
+    namespace = expr_namespace.copy()
+    lines = ['%s = p[%r]' % (name, name) for name in params.split()]
+    lines += compile_expr(expr, params.split(), namespace)
+    exec_('def _ofcn(p, x):\n    %s\n' % '\n    '.join(lines), namespace)
+    return namespace['_ofcn']
+
+
+@pytest.mark.parametrize('expr, params', [
+    (GAUSS, 'ampl pos fwhm'),
+    (LORENTZ, 'ampl pos fwhm'),
+    (PSVOIGT, 'ampl pos fwhm eta'),
+    # reused subexpressions
+    ('(x - pos)**2 + a*sin((x - pos)**2) - (x - pos)**2/fwhm', 'a pos fwhm'),
+    ('exp(-x*a)*cos(x*a) + exp(-x*a)', 'a'),
+    ('-(x*a) + 2*a*x/fwhm - x', 'a fwhm'),
+])
+def test_equivalence(expr, params):
+    fcn = optimized(expr, params)
+    p = dict((name, VALUES[name]) for name in params.split())
+    for x in (linspace(-5, 5, 101), linspace(-1, 1, 7).reshape(7, 1)):
+        assert (abs(fcn(p, x) - plain(expr, p, x)) <=
+                1e-12 * abs(plain(expr, p, x)).max()).all()
+    # through the model, also after the first call has been checked
+    model = Custom('m', params, expr, **p)
+    x = linspace(-5, 5, 101)
+    for scale in (1.0, 0.5, 2.0):
+        q = dict(('m_' + name, value * scale) for (name, value) in p.items())
+        expected = plain(expr, dict((k, v * scale) for (k, v) in p.items()),
+                         x)
+        assert abs(model.fcn(q, x) - expected).max() <= \
+            1e-12 * abs(expected).max()
+
+
+@pytest.mark.parametrize('expr', [
+    'numpy.where(x > pos, a, 0)',     # comparison
+    'numpy.clip(x, a_min=pos, a_max=a)',  # keyword arguments
+    'x[::-1]*a',                      # subscript
+    'x*a if pos else x',              # conditional expression
+    '(lambda y: y*a)(x)',             # call of a lambda
+])
+def test_fallback(expr):
+    with pytest.raises(ExprError):
+        compile_expr(expr, ['a', 'pos'], expr_namespace.copy())
+    model = Custom('m', 'a pos', expr, a=2.0, pos=0.5)
+    assert model.fcn.__name__ == '_fcn'
+    x = linspace(-1, 1, 11)
+    result = model.fcn({'m_a': 2.0, 'm_pos': 0.5}, x)
+    assert (result == plain(expr, {'a': 2.0, 'pos': 0.5}, x)).all()
+
+
+@pytest.mark.parametrize('expr', [
+    'x*2 + 0.5', '-x/2', 'x*k + 1', 'exp(x*2)', '(x + 1)**2/3',
+    'x*2 + 1', '-x*2', 'x*a + k',
+])
+@pytest.mark.parametrize('x', [
+    arange(5),                                  # int array
+    arange(5, dtype=float32),                   # single precision
+    linspace(0, 1, 5),
+    2.0,                                        # scalar x
+])
+@pytest.mark.parametrize('k', [1, 1.5, array([[1.0], [2.0]])])
+def test_inplace_dtypes(expr, x, k):
+    # int and array parameter values: no upcasting or broadcasting in place
+    p = {'a': 2, 'k': k}
+    result = optimized(expr, 'a k')(p, x)
+    expected = plain(expr, p, x)
+    assert getattr(result, 'dtype', None) == getattr(expected, 'dtype', None)
+    assert getattr(result, 'shape', ()) == getattr(expected, 'shape', ())
+    assert (result == expected).all() if hasattr(result, 'all') \
+        else result == expected
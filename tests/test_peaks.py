@@ -0,0 +1,37 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# ufit, a universal scattering fitting suite
+#
+# Copyright (c) 2013-2020, Georg Brandl and contributors.  All rights reserved.
+# Licensed under a 2-clause BSD license, see LICENSE.
+# *****************************************************************************
+
+"""Tests for the peak models."""
+
+import pytest
+from numpy import allclose, arange, column_stack, repeat, tile
+
+from ufit.models.peaks import Gauss2D
+
+PARAMS = dict(bkgd=1, pos_x=3, pos_y=4, ampl=10, fwhm_x=2, fwhm_y=3, theta=0)
+
+
+def values(model):
+    return dict((p.name, p.value) for p in model.params)
+
+
+def grid():
+    return column_stack([repeat(arange(10.), 12), tile(arange(12.), 10)])
+
+
+@pytest.mark.parametrize('roi', [None, 3])
+def test_gauss2d_changed_x(roi):
+    model = Gauss2D('g', roi=roi, **PARAMS)
+    x = grid()
+    p = values(model)
+    model.fcn(p, x)
+    # the same array with different contents must not reuse the cache
+    x[:, 0] += 0.5
+    x[::2, 1] = -x[::2, 1]
+    expected = Gauss2D('g', roi=roi, **PARAMS).fcn(p, x)
+    assert allclose(model.fcn(p, x), expected)
@@ -0,0 +1,55 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# ufit, a universal scattering fitting suite
+#
+# Copyright (c) 2013-2020, Georg Brandl and contributors.  All rights reserved.
+# Licensed under a 2-clause BSD license, see LICENSE.
+# *****************************************************************************
+
+"""Tests for the resolution calculation."""
+
+from os import path
+
+from numpy import allclose, linspace
+
+from ufit.rescalc import ResolutionGrid, get_ellipsoids, load_cfg, \
+    load_par, resmat
+
+HERE = path.dirname(__file__)
+
+
+def make_resmat():
+    return resmat(load_cfg(path.join(HERE, 'inst.cfg')),
+                  load_par(path.join(HERE, 'inst.par')))
+
+
+def make_points(n):
+    return [(1, 0, 0, e) for e in linspace(0.5, 4, n)]
+
+
+def check_ellipsoids(got, expected, rtol):
+    for ell1, ell2 in zip(got, expected):
+        assert allclose(ell1[0], ell2[0], rtol=rtol)
+        assert allclose(ell1[1], ell2[1], rtol=rtol)
+        assert allclose(ell1[2], ell2[2], rtol=rtol)
+
+
+def test_grid_within_tolerance():
+    res = make_resmat()
+    grid = ResolutionGrid(res, make_points(5), tol=1e-3)
+    assert grid.usable and grid.error <= 1e-3
+    points = make_points(37)
+    assert all(grid.ellipsoid(QE) is not None for QE in points)
+
+
+def test_grid_over_budget():
+    # the tolerance can't be reached with the allowed number of nodes: the
+    # grid must not be used, and the exact resolution is calculated
+    res = make_resmat()
+    grid = ResolutionGrid(res, make_points(5), nodes=3, tol=1e-14,
+                          maxnodes=10)
+    assert not grid.usable and grid.error > 1e-14
+    points = make_points(37)
+    assert all(grid.ellipsoid(QE) is None for QE in points)
+    check_ellipsoids(get_ellipsoids(res, points, grid=grid),
+                     get_ellipsoids(res, points, use_caching=False), 1e-12)
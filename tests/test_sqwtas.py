@@ -0,0 +1,45 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# ufit, a universal scattering fitting suite
+#
+# Copyright (c) 2013-2020, Georg Brandl and contributors.  All rights reserved.
+# Licensed under a 2-clause BSD license, see LICENSE.
+# *****************************************************************************
+
+"""Tests for the resolution-convolved scattering law model."""
+
+import sys
+from os import path
+
+import pytest
+from numpy import array, exp, linspace
+
+from ufit import UFitError, cluster
+from ufit.models import ConvolvedScatteringLaw
+
+INSTFILES = (path.join(path.dirname(__file__), 'inst.cfg'),
+             path.join(path.dirname(__file__), 'inst.par'))
+
+
+def sqw(h, k, l, E, QE0, Sigma, ampl, w0, gamma):
+    return ampl * exp(-(E - w0)**2 / gamma**2)
+
+
+def test_mc_without_cloudpickle(monkeypatch):
+    # like a function in __main__: it can't be imported on the workers, and
+    # without cloudpickle, its source lacks the global "exp"
+    def resolve(modname, qualname):
+        raise ImportError(modname)
+    monkeypatch.setattr(cluster, '_resolve', resolve)
+    monkeypatch.setitem(sys.modules, 'cloudpickle', None)
+    cluster._code_cache.clear()
+    with pytest.raises(UFitError):
+        cluster.function_code(sqw, '__sqw')
+
+    x = array([(1, 0, 0, e) for e in linspace(0.5, 4, 8)])
+    p = {'NMC': 2000, 'bkgd': 0, 'ampl': 10., 'w0': 2., 'gamma': 1.}
+    mc = ConvolvedScatteringLaw(sqw, INSTFILES, NMC=2000)
+    gh = ConvolvedScatteringLaw(sqw, INSTFILES, quadrature=5)
+    result = mc.fcn(dict((pv.name, p[pv.name]) for pv in mc.params), x)
+    ref = gh.fcn(dict((pv.name, p[pv.name]) for pv in gh.params), x)
+    assert abs(result - ref).max() < 0.05 * ref.max()
@@ -7,143 +7,667 @@
 # *****************************************************************************
 
 """
-Utilities for clustering execution of a piece of code to multiple hosts using
-SSH transport.
+Utilities for clustering execution of a piece of code to multiple processes,
+either local or on other hosts using SSH transport.
+
+Each worker is a long-lived Python process that is started once and then
+talks to ufit over its stdin/stdout using length-prefixed pickles.  The code
+to execute is sent only once per worker; afterwards, jobs are sent in
+batches.
 """
 
 from __future__ import print_function
 
+import os
+import dis
 import sys
-import md5
+import struct
+import hashlib
+import inspect
+import weakref
+import textwrap
 import threading
+import subprocess
+import multiprocessing
 from os import path
 from time import time
+from importlib import import_module
 
-import paramiko
-
+from ufit import UFitError
 from ufit.pycompat import queue, cPickle as pickle
 
 keyname = path.expanduser('~/.ufitcluster/key')
+hostsname = path.expanduser('~/.ufitcluster/hosts')
 clusterlist = []
 
+# The worker process main loop.  It is sent to the interpreter over stdin,
+# so that nothing needs to be installed on the worker hosts.
+WORKER_CODE = b'''
+import sys, struct, traceback
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+inp = getattr(sys.stdin, 'buffer', sys.stdin)
+out = getattr(sys.stdout, 'buffer', sys.stdout)
+# output of the executed code must not end up in the channel
+sys.stdout = sys.stderr
+
+def recv():
+    header = inp.read(4)
+    if len(header) < 4:
+        return None
+    return pickle.loads(inp.read(struct.unpack('>I', header)[0]))
+
+def send(obj):
+    data = pickle.dumps(obj, 2)
+    out.write(struct.pack('>I', len(data)) + data)
+    out.flush()
+
+ns = {'__name__': '__ufit_worker__'}
+while True:
+    msg = recv()
+    if msg is None or msg[0] == 'quit':
+        break
+    elif msg[0] == 'ping':
+        send(('pong', msg[1]))
+    elif msg[0] == 'code':
+        try:
+            exec(msg[1], ns)
+        except Exception:
+            send(('error', traceback.format_exc()))
+        else:
+            send(('ok', None))
+    elif msg[0] == 'jobs':
+        results = []
+        for jobnum, args in msg[2]:
+            try:
+                results.append((jobnum, True, ns[msg[1]](*args)))
+            except Exception:
+                results.append((jobnum, False, traceback.format_exc()))
+        send(('results', results))
+'''
+
+WORKER_CMD = "import sys; exec(getattr(sys.stdin, 'buffer', sys.stdin).read(%d))" \
+    % len(WORKER_CODE)
+
+
+class Transport(object):
+    """Base class for a way to start a worker process.
+
+    start() must return a pair of binary file-like objects connected to the
+    stdin and stdout of the worker.
+    """
+
+    name = 'worker'
+
+    def start(self):
+        raise NotImplementedError
+
+    def close(self, force=False):
+        """Stop the worker; with *force*, don't wait for running jobs."""
+
+
+class LocalTransport(Transport):
+    """Start the worker as a subprocess on the local machine."""
+
+    def __init__(self, python=None, name='local'):
+        self.python = python or sys.executable
+        self.name = name
+        self._proc = None
+
+    def start(self):
+        if self.python == sys.executable:
+            # make the same modules importable in the worker
+            pythonpath = [p for p in sys.path if p]
+        else:
+            # another interpreter has its own paths; only ufit is added
+            ufitdir = path.dirname(path.dirname(path.abspath(__file__)))
+            pythonpath = [ufitdir] + [
+                p for p in os.environ.get('PYTHONPATH', '').split(os.pathsep)
+                if p and p != ufitdir]
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(pythonpath))
+        self._proc = subprocess.Popen([self.python, '-u', '-c', WORKER_CMD],
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE, env=env)
+        return self._proc.stdin, self._proc.stdout
+
+    def close(self, force=False):
+        if self._proc is not None:
+            try:
+                if force:
+                    self._proc.kill()
+                self._proc.stdin.close()
+                self._proc.wait()
+            except Exception:
+                self._proc.kill()
+            self._proc = None
+
+
+class SSHTransport(Transport):
+    """Start the worker over an SSH connection."""
+
+    def __init__(self, user, host, keyfile=keyname, python='python',
+                 name=None):
+        self.user = user
+        self.host = host
+        self.keyfile = keyfile
+        self.python = python
+        self.name = name or host
+        self._client = None
+
+    def start(self):
+        import paramiko
+        self._client = paramiko.SSHClient()
+        self._client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self._client.connect(self.host, username=self.user,
+                             key_filename=self.keyfile, look_for_keys=False)
+        stdin, stdout, _ = self._client.exec_command(
+            '%s -u -c "%s"' % (self.python, WORKER_CMD))
+        return stdin, stdout
+
+    def close(self, force=False):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+
+class Worker(object):
+    """A long-lived worker process, and its statistics."""
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.name = transport.name
+        self.alive = False
+        self.jobs_done = 0
+        self.failures = 0
+        self.busy_time = 0.
+        self.last_error = None
+        self.timeouts = 0
+        self._stdin = self._stdout = None
+        self._code = None
+
+    def start(self):
+        self._stdin, self._stdout = self.transport.start()
+        self._stdin.write(WORKER_CODE)
+        self._stdin.flush()
+        self.alive = True
+        self._code = None
+
+    def send(self, msg):
+        data = pickle.dumps(msg, 2)
+        self._stdin.write(struct.pack('>I', len(data)) + data)
+        self._stdin.flush()
+
+    def recv(self):
+        header = self._stdout.read(4)
+        if len(header) < 4:
+            raise EOFError('worker %s closed the connection' % self.name)
+        size = struct.unpack('>I', header)[0]
+        data = b''
+        while len(data) < size:
+            chunk = self._stdout.read(size - len(data))
+            if not chunk:
+                raise EOFError('worker %s closed the connection' % self.name)
+            data += chunk
+        return pickle.loads(data)
+
+    def load_code(self, code):
+        """Execute *code* in the worker, unless it was the last code sent."""
+        key = hashlib.sha1(code.encode()).hexdigest()
+        if self._code == key:
+            return
+        self.send(('code', code))
+        reply = self.recv()
+        if reply[0] == 'error':
+            raise UFitError('error executing code on worker %s:\n%s' %
+                            (self.name, reply[1]))
+        self._code = key
+
+    def run_jobs(self, funcname, batch):
+        """Run a batch of (jobnum, args) and return (jobnum, ok, result)."""
+        started = time()
+        self.send(('jobs', funcname, batch))
+        reply = self.recv()
+        self.busy_time += time() - started
+        self.jobs_done += len(batch)
+        return reply[1]
+
+    def ping(self):
+        """Return the round-trip time to the worker."""
+        started = time()
+        self.send(('ping', started))
+        self.recv()
+        return time() - started
+
+    def stop(self, force=False):
+        if self.alive and not force:
+            try:
+                self.send(('quit',))
+            except Exception:
+                pass
+        self.alive = False
+        self.transport.close(force)
+
+    def health(self):
+        return {'name': self.name, 'alive': self.alive,
+                'jobs_done': self.jobs_done, 'failures': self.failures,
+                'timeouts': self.timeouts, 'busy_time': self.busy_time,
+                'last_error': self.last_error}
+
+
+class Cluster(object):
+    """A pool of workers that run the jobs of run() in parallel.
+
+    Each worker is driven by its own thread; the jobs are distributed in
+    batches to whichever worker is free.  Workers can be added and removed
+    at any time, also while run() is executing.
+
+    Batches that don't finish within *timeout* seconds, or whose worker
+    dies, are given to another worker, up to *max_retries* times.  If
+    *speculate* is true, workers that would otherwise be idle at the end of
+    a run also execute copies of batches that take more than
+    *straggler_factor* times the median batch duration; the first result
+    wins.
+    """
+
+    timeout = None
+    max_retries = 2
+    speculate = True
+    straggler_factor = 2.0
+
+    def __init__(self, transports=(), **settings):
+        self.workers = []
+        self._results = queue.Queue()
+        self._runid = 0
+        self._starting = 0
+        for key, value in settings.items():
+            if not hasattr(self, key):
+                raise UFitError('invalid cluster setting: %r' % key)
+            setattr(self, key, value)
+        for transport in transports:
+            self.add_worker(transport)
+
+    def add_worker(self, transport):
+        """Start a new worker with the given transport."""
+        worker = Worker(transport)
+        try:
+            worker.start()
+        except Exception as err:
+            print('[C] cannot start worker %s: %s' % (worker.name, err),
+                  file=sys.stderr)
+            worker.last_error = str(err)
+            return None
+        worker.busy = False
+        worker.busy_since = None
+        worker.inbox = queue.Queue()
+        thread = threading.Thread(target=self._worker_thread, args=(worker,))
+        thread.daemon = True
+        thread.start()
+        self.workers.append(worker)
+        print('[C] started worker %s' % worker.name)
+        return worker
+
+    def remove_worker(self, worker, force=False):
+        """Stop a worker; a batch it is running is given to another one."""
+        if worker in self.workers:
+            self.workers.remove(worker)
+        worker.inbox.put(None)
+        worker.stop(force)
+
+    def _replace_worker(self, worker):
+        self.remove_worker(worker, force=True)
+        self._starting += 1
+
+        def restart():
+            try:
+                new = self.add_worker(worker.transport)
+            finally:
+                self._starting -= 1
+            if new is not None:
+                new.jobs_done = worker.jobs_done
+                new.failures = worker.failures
+                new.timeouts = worker.timeouts
+                new.busy_time = worker.busy_time
+                new.last_error = worker.last_error
+        thread = threading.Thread(target=restart)
+        thread.daemon = True
+        thread.start()
+
+    def _worker_thread(self, worker):
+        while True:
+            task = worker.inbox.get()
+            if task is None:
+                return
+            runid, index, code, funcname, batch = task
+            try:
+                worker.load_code(code)
+                results = worker.run_jobs(funcname, batch)
+            except Exception as err:
+                worker.failures += 1
+                worker.last_error = str(err)
+                if not isinstance(err, UFitError):
+                    # the connection is broken
+                    worker.alive = False
+                results = err
+            self._results.put((runid, worker, index, results))
+
+    def _straggler(self, running, durations):
+        """Return the index of a running batch that should be speculatively
+        executed on another worker, or None.
+        """
+        if not self.speculate or not durations:
+            return None
+        limit = self.straggler_factor * sorted(durations)[len(durations) // 2]
+        now = time()
+        copies = {}
+        for index, _ in running.values():
+            copies[index] = copies.get(index, 0) + 1
+        candidates = [(started, index) for (index, started) in running.values()
+                      if copies[index] == 1 and now - started > limit]
+        return min(candidates)[1] if candidates else None
+
+    def run(self, code, funcname, argumentslist, batchsize=None):
+        """Execute funcname(*args) for each args in argumentslist, in the
+        namespace created by executing *code*, and return the results.
+        """
+        # results of a previous run that was aborted are ignored
+        self._runid += 1
+        runid = self._runid
+        jobs = list(enumerate(argumentslist))
+        retval = [None] * len(jobs)
+        if not jobs:
+            return retval
+        if batchsize is None:
+            batchsize = max(1, len(jobs) // (4 * max(len(self.workers), 1)))
+        batches = [jobs[i:i+batchsize] for i in range(0, len(jobs), batchsize)]
+        pending = list(range(len(batches)))
+        attempts = [0] * len(batches)
+        done = [False] * len(batches)
+        running = {}  # worker -> (batch index, start time)
+        durations = []
+        ndone = 0
+
+        def retry(index, reason):
+            attempts[index] += 1
+            if attempts[index] > self.max_retries:
+                raise UFitError('cluster job batch failed %d times, last '
+                                'error: %s' % (attempts[index], reason))
+            if index not in pending and \
+               index not in [i for (i, _) in running.values()]:
+                pending.append(index)
+
+        while ndone < len(batches):
+            # distribute work to all free workers
+            for worker in list(self.workers):
+                if not worker.alive or worker.busy:
+                    continue
+                if pending:
+                    index = pending.pop(0)
+                else:
+                    index = self._straggler(running, durations)
+                    if index is None:
+                        break
+                worker.busy = True
+                worker.busy_since = time()
+                running[worker] = (index, worker.busy_since)
+                worker.inbox.put((runid, index, code, funcname, batches[index]))
+            # workers can still be busy with batches of an aborted run; they
+            # are used again when their (ignored) results arrive
+            if not running and not self._starting and \
+               not any(w.alive and w.busy for w in self.workers):
+                raise UFitError('no cluster workers available')
+            try:
+                rid, worker, index, results = self._results.get(timeout=0.05)
+            except queue.Empty:
+                if self.timeout is not None:
+                    now = time()
+                    for worker in list(self.workers):
+                        if worker.busy and worker not in running and \
+                           now - worker.busy_since > self.timeout:
+                            print('[C] worker %s timed out on a batch of a '
+                                  'previous run, restarting' % worker.name,
+                                  file=sys.stderr)
+                            worker.timeouts += 1
+                            self._replace_worker(worker)
+                    for worker, (index, started) in list(running.items()):
+                        if now - started > self.timeout:
+                            print('[C] worker %s timed out, restarting' %
+                                  worker.name, file=sys.stderr)
+                            worker.timeouts += 1
+                            del running[worker]
+                            self._replace_worker(worker)
+                            if not done[index]:
+                                retry(index, 'timeout on %s' % worker.name)
+                continue
+            worker.busy = False
+            if rid != runid:
+                if isinstance(results, Exception) and \
+                   not isinstance(results, UFitError):
+                    self.remove_worker(worker, force=True)
+                continue
+            if running.get(worker, (None,))[0] != index:
+                continue
+            started = running.pop(worker)[1]
+            if done[index]:
+                # result of a speculative copy that lost
+                continue
+            if isinstance(results, UFitError):
+                raise results
+            elif isinstance(results, Exception):
+                print('[C] worker %s failed: %s' % (worker.name, results),
+                      file=sys.stderr)
+                self.remove_worker(worker, force=True)
+                retry(index, results)
+                continue
+            for jobnum, ok, result in results:
+                if not ok:
+                    raise UFitError('job failed on worker %s:\n%s' %
+                                    (worker.name, result))
+                retval[jobnum] = result
+            done[index] = True
+            ndone += 1
+            durations.append(time() - started)
+        return retval
+
+    def health(self):
+        """Return a list of status dictionaries, one for each worker."""
+        return [worker.health() for worker in self.workers]
+
+    def close(self):
+        for worker in list(self.workers):
+            self.remove_worker(worker)
+
+
+def _resolve(modname, qualname):
+    obj = import_module(modname)
+    for part in qualname.split('.'):
+        obj = getattr(obj, part)
+    return obj
+
+
+_code_cache = weakref.WeakKeyDictionary()
+
+
+def _global_names(code):
+    # names of globals loaded by a code object and the code objects nested
+    # in it (without the disassembler, all names it refers to)
+    if hasattr(dis, 'get_instructions'):
+        names = set(ins.argval for ins in dis.get_instructions(code)
+                    if ins.opname in ('LOAD_GLOBAL', 'LOAD_NAME'))
+    else:
+        names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= _global_names(const)
+    return names
+
+
+def function_code(func, name, source=True):
+    """Return Python code that defines *func* under *name* when executed on a
+    worker, so that it can be called by the jobs.
+
+    Functions that can be imported on the worker by module and name are
+    transferred by reference.  Others (e.g. defined in __main__ or nested) are
+    serialized with cloudpickle, if it is installed, or else transferred as
+    source code.  For numba-compiled functions, the source of the Python
+    function is compiled again on the worker if numba is available there.
+
+    The source code does not include the module globals of the function, so
+    a `UFitError` is raised if the function uses any.  With *source* false,
+    None is returned instead of transferring the source.
+    """
+    try:
+        return _code_cache[func][name]
+    except (KeyError, TypeError):
+        pass
+    pyfunc = getattr(func, 'py_func', func)
+    modname = getattr(pyfunc, '__module__', None)
+    qualname = getattr(pyfunc, '__qualname__', pyfunc.__name__)
+    code = None
+    if modname not in (None, '__main__') and '<locals>' not in qualname:
+        try:
+            if _resolve(modname, qualname) is func:
+                code = ('from importlib import import_module\n'
+                        '%s = import_module(%r)\n' % (name, modname) +
+                        ''.join('%s = getattr(%s, %r)\n' % (name, name, part)
+                                for part in qualname.split('.')))
+        except Exception:
+            pass
+    if code is None:
+        try:
+            import cloudpickle
+            code = 'import pickle\n%s = pickle.loads(%r)\n' % \
+                (name, cloudpickle.dumps(func, 2))
+        except Exception:
+            pass
+    if code is None:
+        if not source:
+            return None
+        used = set()
+        if hasattr(pyfunc, '__code__'):
+            used = _global_names(pyfunc.__code__) & \
+                set(pyfunc.__globals__) - set([pyfunc.__name__])
+        if used:
+            raise UFitError('cannot transfer function %r to the cluster '
+                            'workers: it uses the global names %s, which '
+                            'requires the cloudpickle module' %
+                            (func, ', '.join(sorted(used))))
+        try:
+            lines = textwrap.dedent(inspect.getsource(pyfunc)).splitlines()
+        except (IOError, TypeError) as err:
+            raise UFitError('cannot transfer function %r to the cluster '
+                            'workers: %s' % (func, err))
+        if pyfunc is not func:
+            # drop the numba decorator, it is applied again below
+            while lines[0].startswith('@'):
+                lines.pop(0)
+        code = '\n'.join(lines) + '\n%s = %s\n' % (name, pyfunc.__name__)
+        if pyfunc is not func:
+            code += ('try:\n    import numba\n    %s = numba.jit(%s)\n'
+                     'except ImportError:\n    pass\n' % (name, name))
+    try:
+        _code_cache.setdefault(func, {})[name] = code
+    except TypeError:
+        pass
+    return code
+
 
 def init_cluster():
     try:
-        fp = open(path.expanduser('~/.ufitcluster/hosts'))
-        for line in fp:  # user@host
-            if line.startswith('#'):
+        fp = open(hostsname)
+        for line in fp:  # user@host [python], or "local"
+            if line.startswith('#') or not line.strip():
                 continue
-            login, host = line.strip().split('@')
-            clusterlist.append((login, host))
+            parts = line.split()
+            if parts[0] == 'local':
+                clusterlist.append((None, 'local', parts[1:2] or None))
+            else:
+                login, host = parts[0].split('@')
+                clusterlist.append((login, host, parts[1:2] or None))
         fp.close()
     except Exception as err:
         print('Cannot read the list of cluster hosts:', err, file=sys.stderr)
         print('Please create a file %s with one line for each '
-              'parallel process, for example:' %
-              path.expanduser('~/.ufitcluster/hosts'), file=sys.stderr)
+              'parallel process, for example:' % hostsname, file=sys.stderr)
         print(file=sys.stderr)
         print('username@hostname1', file=sys.stderr)
         print('username@hostname1', file=sys.stderr)
         print('username@hostname1', file=sys.stderr)
         print('username@hostname1', file=sys.stderr)
         print('username@hostname2', file=sys.stderr)
-        print('username@hostname2', file=sys.stderr)
+        print('username@hostname2 /opt/python/bin/python', file=sys.stderr)
         print(file=sys.stderr)
         print('would run 4 parallel processes on hostname1 and '
               '2 parallel processes on hostname2.', file=sys.stderr)
-        print('For local operation only, use "localhost" as '
-              'hostname.', file=sys.stderr)
+        print('For local processes without SSH, use a line "local".',
+              file=sys.stderr)
         print('The file %s must contain the SSH private key to '
-              'use for the connection, even for localhost.' %
-              path.expanduser('~/.ufitcluster/key'), file=sys.stderr)
+              'use for the connection, even for localhost.' % keyname,
+              file=sys.stderr)
 
 
-def client_runner(client, task_queue, result_queue):
-    while True:
-        code, funcname, jobnum, args = task_queue.get()
-        if jobnum == -1:
-            print('[C] exiting runner for %s' % client._host)
-            return
-        try:
-            sid = md5.new(str(time()) + str(args)).hexdigest()
-            sys.stdout.write('.')
-            sys.stdout.flush()
-            # print '[C] starting job on %s: %s' % (client._host, sid)
-            code_footer = '''\nif __name__ == "__main__":
-            import cPickle as pickle
-            args = pickle.loads(%r)
-            print pickle.dumps(%s(*args))
-            ''' % (pickle.dumps(args), funcname)
-
-            sftp = client.open_sftp()
-            fobj = sftp.file('/tmp/ufit_cluster_%s.py' % sid, 'wb')
-            fobj.write(code + code_footer)
-            fobj.close()
-
-            stdin, stdout, stderr = \
-                client.exec_command('python /tmp/ufit_cluster_%s.py; '
-                                    'rm /tmp/ufit_cluster_%s.py' % (sid, sid))
-            result = pickle.load(stdout)
-            # print '[C] done with job %s: %r' % (sid, result)
-            result_queue.put((jobnum, result))
-        except Exception as err:
-            print('[C] no result on %s, requeuing: %r' % (client._host, err))
-            task_queue.put((code, funcname, jobnum, args))
-            return
+cluster = None
+
+
+def setup_cluster(**settings):
+    """Start the workers from the hosts file; *settings* are Cluster
+    attributes such as timeout or max_retries.
+    """
+    global cluster
+    if cluster is not None:
+        for key, value in settings.items():
+            setattr(cluster, key, value)
+        return cluster
+    if not clusterlist:
+        init_cluster()
+    transports = []
+    for i, (user, host, python) in enumerate(clusterlist):
+        name = '%s[%d]' % (host, i)
+        if user is None:
+            transports.append(LocalTransport(python and python[0], name))
+        else:
+            transports.append(SSHTransport(user, host, keyname,
+                                           python and python[0] or 'python',
+                                           name))
+    cluster = Cluster(transports, **settings)
+    return cluster
 
 
-clients = []
-runners = []
-task_queue = queue.Queue()
-result_queue = queue.Queue()
-cluster_setup = False
-
-
-def setup_cluster():
-    global cluster_setup
-    if cluster_setup:
-        return
-    for i, (user, host) in enumerate(clusterlist):
-        client = paramiko.SSHClient()
-        client._host = '%s[%d]' % (host, i)
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect(host, username=user, key_filename=keyname,
-                       look_for_keys=False)
-        clients.append(client)
-        print('[C] opened cluster connection to %s' % client._host)
-        runner = threading.Thread(target=client_runner,
-                                  args=(client, task_queue, result_queue))
-        runners.append(runner)
-        runner.start()
-    cluster_setup = True
+local = None
+
+
+def local_cluster():
+    """Return a cluster of local workers, one for each CPU."""
+    global local
+    if local is None:
+        local = Cluster([LocalTransport(name='local[%d]' % i)
+                         for i in range(multiprocessing.cpu_count())])
+    return local
 
 
 def kill_cluster():
-    for cl in clients:
-        task_queue.put((None, None, -1, None))  # end!
-        cl.close()
-
-
-def run_cluster(code, funcname, argumentslist):
-    setup_cluster()
-    njobs = len(argumentslist)
-    retval = [None] * njobs
-    returns = 0
-    for job in enumerate(argumentslist):
-        task_queue.put((code, funcname) + job)
-    while returns < njobs:
-        # XXX check if any client is still running
-        jobnum, result = result_queue.get()
-        if isinstance(result, Exception):
-            raise result
-        retval[jobnum] = result
-        returns += 1
-    return retval
-
-init_cluster()
+    global cluster, local
+    if cluster is not None:
+        cluster.close()
+        cluster = None
+    if local is not None:
+        local.close()
+        local = None
+
+
+def run_cluster(code, funcname, argumentslist, batchsize=None, local=False):
+    """Run the jobs on the cluster from the hosts file, or with *local* on
+    local worker processes.
+    """
+    cl = local_cluster() if local else setup_cluster()
+    return cl.run(code, funcname, argumentslist, batchsize)
+
 
 if __name__ == '__main__':
+    cluster = Cluster([LocalTransport()])
     t1 = time()
     print(run_cluster('def foo(a): return a\n', 'foo', [('a',)]))
     t2 = time()
     print(t2-t1)
+    kill_cluster()
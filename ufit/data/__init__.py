@@ -12,7 +12,11 @@ from ufit import UFitError
 from ufit.data import ill, nicos, nicos_old, simple, simple_csv, trisp, \
     llb, cascade, taipan, nist
 from ufit.data.loader import Loader
-from ufit.data.dataset import Dataset, ScanData, ImageData, DatasetList
+from ufit.data.cache import DataCache, set_datacache
+from ufit.data.index import MetadataIndex, numor_string
+from ufit.data.follow import Follower
+from ufit.data.dataset import Dataset, ScanData, ImageData, ImageStack, \
+    DatasetList
 from ufit.plotting import mapping
 from ufit.pycompat import listitems
 
@@ -35,9 +39,11 @@ data_formats_image = {
 data_formats = dict(listitems(data_formats_scan) +
                     listitems(data_formats_image))
 
-__all__ = ['Dataset', 'DatasetList', 'ScanData', 'ImageData', 'sets',
-           'set_datatemplate', 'set_dataformat', 'read_data', 'as_data',
-           'read_numors', 'do_mapping']
+__all__ = ['Dataset', 'DatasetList', 'ScanData', 'ImageData', 'ImageStack',
+           'sets', 'set_datatemplate', 'set_dataformat', 'read_data',
+           'as_data',
+           'read_numors', 'do_mapping', 'set_datacache', 'set_loadworkers',
+           'MetadataIndex', 'numor_string', 'Follower', 'follow_data']
 
 
 # simplified interface for usage in noninteractive scripts
@@ -87,6 +93,18 @@ def set_dataformat(format):
     global_loader.format = format
 
 
+def set_loadworkers(workers, processes=False):
+    """Set the number of workers used by :func:`read_numors` to read files
+    concurrently.
+
+    With *processes* false, a pool of threads is used, which helps mostly with
+    slow (network) file systems; with *processes* true, the files are parsed
+    in separate processes.
+    """
+    global_loader.workers = workers
+    global_loader.use_processes = processes
+
+
 def read_data(n, xcol='auto', ycol='auto', dycol=None, ncol=None, nscale=1, filter=None):
     """Read a data file.  Returns a :class:`Dataset` object.
 
@@ -104,13 +122,34 @@ def read_data(n, xcol='auto', ycol='auto', dycol=None, ncol=None, nscale=1, filt
     return global_loader.load(n, xcol, ycol, dycol, ncol, nscale, filter)
 
 
+def follow_data(n, xcol='auto', ycol='auto', dycol=None, ncol=None,
+                nscale=1, model=None):
+    """Read a data file that is still being written, and follow it.
+
+    Returns a :class:`Follower`; its ``dataset`` attribute is the
+    :class:`Dataset`, and calling its ``poll()`` method adds the points
+    written to the file in the meantime.  If a *model* is given, it is
+    fitted again whenever points have been added.  An example::
+
+       follower = follow_data(1234, ncol='mon1', nscale=10000, model=model)
+       while True:
+           if follower.poll():
+               follower.result.printout()
+           time.sleep(5)
+
+    Other parameters as in :func:`read_data`.
+    """
+    return global_loader.follow(n, xcol, ycol, dycol, ncol, nscale, model)
+
+
 def as_data(x, y, dy, name=''):
     """Quickly construct a :class:`Dataset` object from three numpy arrays."""
     return Dataset.from_arrays(name or 'data', x, y, dy)
 
 
 def read_numors(nstring, binsize, xcol='auto', ycol='auto',
-                dycol=None, ncol=None, nscale=1, floatmerge=True):
+                dycol=None, ncol=None, nscale=1, floatmerge=True,
+                skip_failed=False):
     """Read a number of data files.  Returns a list of :class:`Dataset`\s.
 
     :param nstring: A string that gives file numbers, with the operators given
@@ -118,6 +157,8 @@ def read_numors(nstring, binsize, xcol='auto', ycol='auto',
     :param binsize: Bin size when files need to be merged according to
         *nstring*.
     :param floatmerge: If to use float merging instead of binning. Default true.
+    :param skip_failed: If true, files that can't be loaded are left out with
+        a warning instead of raising an error.  Default false.
 
     Other parameters as in :func:`read_data`.
 
@@ -136,8 +177,12 @@ def read_numors(nstring, binsize, xcol='auto', ycol='auto',
     * ``'10>15+23'`` merges files 10 through 15 and 23 into one single dataset.
     * ``'10,11,12+13,14'`` loads four sets.
     """
-    return global_loader.load_numors(nstring, binsize, xcol, ycol,
-                                     dycol, ncol, nscale, floatmerge)
+    datas = global_loader.load_numors(nstring, binsize, xcol, ycol,
+                                      dycol, ncol, nscale, floatmerge,
+                                      skip_failed=skip_failed)
+    for _, msg in global_loader.failures:
+        print('Skipping file: %s' % msg)
+    return datas
 
 
 def do_mapping(x, y, runs, minmax=None, mode=0, log=False, dots=True,
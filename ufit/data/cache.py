@@ -0,0 +1,192 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# ufit, a universal scattering fitting suite
+#
+# Copyright (c) 2013-2020, Georg Brandl and contributors.  All rights reserved.
+# Licensed under a 2-clause BSD license, see LICENSE.
+# *****************************************************************************
+
+"""On-disk cache for parsed data files."""
+
+import io
+import os
+import hashlib
+import inspect
+
+from ufit.pycompat import cPickle as pickle
+
+__all__ = ['DataCache', 'set_datacache', 'get_datacache']
+
+# increase when the layout of the cache files changes
+CACHE_VERSION = 1
+
+
+class DataCache(object):
+    """Cache for the results of the data readers' ``read_data``.
+
+    For every data file, the reader result (column names, column data and
+    metadata for scans; array, errors and metadata for images) is stored as
+    a binary pickle in *directory*.  An entry is only used if the data file
+    still has the same size and modification time, and the source of the
+    reader module is unchanged.
+
+    When the files in the directory exceed *maxsize* bytes, the least
+    recently used ones are removed.
+    """
+
+    def __init__(self, directory, maxsize=500 * 2**20):
+        self.directory = os.path.expanduser(directory)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._total = None
+        self._reader_versions = {}
+
+    def _reader_version(self, rdr):
+        try:
+            return self._reader_versions[rdr.__name__]
+        except KeyError:
+            h = hashlib.sha1(('%d;' % CACHE_VERSION).encode())
+            try:
+                with io.open(inspect.getsourcefile(rdr), 'rb') as fp:
+                    h.update(fp.read())
+            except (TypeError, IOError, OSError):
+                h.update(rdr.__name__.encode())
+            version = self._reader_versions[rdr.__name__] = h.hexdigest()
+            return version
+
+    def _filename(self, filename):
+        key = hashlib.sha1(os.path.abspath(filename).encode('utf-8'))
+        return os.path.join(self.directory, key.hexdigest() + '.cache')
+
+    def signature(self, filename):
+        """Return the signature (size and modification time) of *filename*.
+
+        It should be taken before reading the file, and passed to `put`.
+        """
+        st = os.stat(filename)
+        return (st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime))
+
+    def get(self, filename, formats):
+        """Return ``(format, result)`` for *filename* if a valid entry
+        exists, else None.
+
+        *formats* maps format names to reader modules; entries from readers
+        not in it are ignored.
+        """
+        cfn = self._filename(filename)
+        try:
+            signature = self.signature(filename)
+            with open(cfn, 'rb') as fp:
+                header = pickle.load(fp)
+                rdr = formats.get(header['format'])
+                if rdr is None or header['signature'] != signature or \
+                   header['version'] != self._reader_version(rdr):
+                    raise KeyError
+                result = pickle.load(fp)
+            # mark as recently used for eviction
+            os.utime(cfn, None)
+        except Exception:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return header['format'], result
+
+    def put(self, filename, fmt, rdr, result, signature):
+        """Store the *result* of reader *rdr* (format name *fmt*) for
+        *filename*, whose *signature* was taken before reading it.
+
+        Nothing is stored if the file has changed since then, since the
+        result might then be from a partially written file.
+        """
+        try:
+            if self.signature(filename) != signature:
+                return
+        except OSError:
+            return
+        cfn = self._filename(filename)
+        header = {'format': fmt, 'version': self._reader_version(rdr),
+                  'signature': signature}
+        try:
+            # write to a temporary file first, so that a concurrent
+            # session never reads a partial file
+            with open(cfn + '.tmp', 'wb') as fp:
+                pickle.dump(header, fp, 2)
+                pickle.dump(result, fp, 2)
+            size = os.path.getsize(cfn + '.tmp')
+            os.rename(cfn + '.tmp', cfn)
+        except Exception as err:
+            print('Could not write data cache file for %s: %s' %
+                  (filename, err))
+            return
+        if self._total is None:
+            self._total = self._scan()[1]
+        else:
+            self._total += size
+        if self._total > self.maxsize:
+            self.evict()
+
+    def _scan(self):
+        entries = []
+        total = 0
+        for fn in os.listdir(self.directory):
+            if not fn.endswith('.cache'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, fn))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fn))
+            total += st.st_size
+        return entries, total
+
+    def evict(self, target=None):
+        """Remove least recently used entries until the cache uses less than
+        *target* bytes (default 90% of the maximum size).
+        """
+        if target is None:
+            target = 0.9 * self.maxsize
+        entries, total = self._scan()
+        for _, size, fn in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(os.path.join(self.directory, fn))
+            except OSError:
+                continue
+            total -= size
+        self._total = total
+
+    def clear(self):
+        """Remove all entries and reset the statistics."""
+        self.evict(0)
+        self.hits = self.misses = 0
+
+    def stats(self):
+        """Return a dictionary with cache size and hit/miss counts."""
+        if self._total is None:
+            self._total = self._scan()[1]
+        return {'size': self._total, 'maxsize': self.maxsize,
+                'hits': self.hits, 'misses': self.misses}
+
+
+datacache = None
+
+
+def set_datacache(directory, maxsize=500 * 2**20):
+    """Enable caching of parsed data files in *directory* for all loaders
+    (None to disable).
+    """
+    global datacache
+    if directory is None:
+        datacache = None
+    else:
+        datacache = DataCache(directory, maxsize)
+    return datacache
+
+
+def get_datacache():
+    """Return the global data cache, or None if not enabled."""
+    return datacache
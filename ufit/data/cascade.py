@@ -10,14 +10,19 @@
 
 import io
 
-from numpy import frombuffer, sqrt
+from numpy import frombuffer, memmap
+
+
+# identifies the format for autodetection: (offset, bytes); nothing can be
+# decided from the pixel data, so look at the start of the footer
+signature = (128*128*4, b'\n### NICOS Cascade')
 
 
 def check_data(fp):
-    fp.read(128*128*4)  # cannot decide anything from the pixel data
-    footerid = fp.read(18)
+    fp.seek(signature[0], 0)
+    footerid = fp.read(len(signature[1]))
     fp.seek(0, 0)
-    return footerid == b'\n### NICOS Cascade'
+    return footerid == signature[1]
 
 
 def guess_norm(meta):
@@ -31,13 +36,8 @@ def guess_norm(meta):
     return mg
 
 
-def read_data(filename, fp):
+def _read_footer(fp):
     meta = {}
-
-    arr = frombuffer(fp.read(128*128*4), '<I4').reshape((128, 128)).astype(float)
-    darr = sqrt(arr)
-
-    # now read metadata
     remark = ''
     fp = io.TextIOWrapper(fp)
     for line in fp:
@@ -79,5 +79,24 @@ def read_data(filename, fp):
         meta[key] = val
     if remark and 'title' in meta:
         meta['title'] += ', ' + remark
+    return meta
 
-    return arr, darr, meta
+
+def read_meta(filename, fp):
+    # skip the pixel data
+    fp.seek(128*128*4, 0)
+    return [], _read_footer(fp)
+
+
+def read_data(filename, fp):
+    # the counts are returned as they are in the file, memory mapped if
+    # possible, so that only the pixels that are used are read; the errors
+    # are Poisson errors, which ImageData computes when needed
+    try:
+        fp.fileno()
+        arr = memmap(filename, '<u4', 'r', shape=(128, 128))
+        fp.seek(128*128*4, 0)
+    except (AttributeError, IOError, OSError, ValueError):
+        arr = frombuffer(fp.read(128*128*4), '<u4').reshape((128, 128))
+    meta = _read_footer(fp)
+    return arr, None, meta
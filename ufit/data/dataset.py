@@ -12,8 +12,11 @@ import copy
 import operator
 from functools import reduce
 
-from numpy import array, concatenate, ones, broadcast_arrays, savetxt, sqrt
+from numpy import add, array, asarray, atleast_2d, concatenate, empty, \
+    float64, int64, ndarray, ones, promote_types, zeros, broadcast_arrays, \
+    savetxt, sqrt, dtype as npdtype
 
+from ufit import UFitError
 from ufit.utils import attrdict
 from ufit.data.merge import rebin, floatmerge
 from ufit.plotting import DataPlotter
@@ -159,6 +162,68 @@ class ScanData(DataBase):
         self.dy = self.dy_raw / self.norm
         self.yaxis = self.ycol + ' / %s %s' % (const, self.ncol)
 
+    def append_points(self, data):
+        """Append points to the dataset.
+
+        *data* has one row per point, with the columns as for the
+        constructor (x, y, dy and normalization).
+
+        The arrays are kept as views into buffers that grow geometrically,
+        so that appending a few points does not copy all the old ones.
+        """
+        data = atleast_2d(data)
+        if getattr(self.x, 'ndim', 1) != 1:
+            raise UFitError('cannot append to a dataset with multi-'
+                            'dimensional x values')
+        n, m = len(self._data), len(self._data) + len(data)
+        buf = self.__dict__.get('_buf')
+        dbuf = self.__dict__.get('_dbuf')
+        if buf is None or len(buf) < m or self._data.base is not buf or \
+           self.x.base is not buf or self.norm.base is not dbuf or \
+           self.y.base is not dbuf or self.dy.base is not dbuf or \
+           self.mask.base is not self._mbuf:
+            # (re)allocate the buffers, since they are too small or an
+            # operation has replaced some of the arrays
+            size = max(16, 2 * m)
+            buf = empty((size, self._data.shape[1]))
+            buf[:n] = self._data
+            buf[:n, 0] = self.x
+            dbuf = empty((size, 3))
+            dbuf[:n, 0] = self.norm
+            dbuf[:n, 1] = self.y
+            dbuf[:n, 2] = self.dy
+            self._mbuf = ones(size, bool)
+            self._mbuf[:n] = self.mask
+            self._buf, self._dbuf = buf, dbuf
+        buf[n:m] = data[:, :buf.shape[1]]
+        if self.ncol is not None and buf.shape[1] > 3:
+            dbuf[n:m, 0] = buf[n:m, 3] / self.nscale
+        else:
+            dbuf[n:m, 0] = 1
+        dbuf[n:m, 1] = buf[n:m, 1] / dbuf[n:m, 0]
+        dbuf[n:m, 2] = buf[n:m, 2] / dbuf[n:m, 0]
+        self._mbuf[n:m] = dbuf[n:m, 2] != 0
+
+        self._data = buf[:m]
+        self.x = self.x_raw = self.x_plot = buf[:m, 0]
+        self.y_raw = buf[:m, 1]
+        self.dy_raw = buf[:m, 2]
+        self.norm = dbuf[:m, 0]
+        if self.ncol is not None and buf.shape[1] > 3:
+            self.norm_raw = buf[:m, 3]
+        else:
+            self.norm_raw = self.norm
+        self.y = dbuf[:m, 1]
+        self.dy = dbuf[:m, 2]
+        self.mask = self._mbuf[:m]
+
+    def __getstate__(self):
+        # the buffers for append_points are not worth saving
+        state = self.__dict__.copy()
+        for key in ('_buf', '_dbuf', '_mbuf'):
+            state.pop(key, None)
+        return state
+
     def __repr__(self):
         return '<%s (%d points)>' % (self.name, len(self.x))
 
@@ -283,14 +348,37 @@ class ScanData(DataBase):
 Dataset = ScanData
 
 
+def _sum_dtype(arrays):
+    # type for the sum of the arrays; integer counts could overflow
+    dtype = reduce(promote_types, (arr.dtype for arr in arrays))
+    if dtype.kind in 'biu':
+        return int64
+    return dtype
+
+
 class ImageData(DataBase):
-    def __init__(self, meta, arr, darr, norm=None, nscale=1,
-                 name='', sources=None):
+    """An image, such as a detector frame.
+
+    *arr* are the raw counts, which can be of any numeric type (a memory
+    mapped array of integers as returned by the cascade reader avoids
+    reading and converting the whole image up front).  *darr* are the
+    errors of the raw counts; None means Poisson errors, i.e. the square
+    root of the counts.
+
+    The errors and the normalized arrays ``arr`` and ``darr`` are computed
+    from the raw counts when accessed (so changing them has no effect), in
+    the floating point type *dtype*; use ``numpy.float32`` to halve their
+    size.
+    """
+
+    def __init__(self, meta, arr, darr=None, norm=None, nscale=1,
+                 name='', sources=None, dtype=float64):
         DataBase.__init__(self, meta, name, sources)
 
         self.arr_raw = arr
-        self.darr_raw = darr
+        self._darr_raw = darr
         self.nscale = nscale
+        self.dtype = npdtype(dtype).type
 
         if norm:
             self.norm_raw = norm
@@ -298,26 +386,63 @@ class ImageData(DataBase):
         else:
             self.norm_raw = self.norm = 1
 
-        self.arr = arr / self.norm
-        self.darr = darr / self.norm
-
         # XXX implement scaling?
         self.xaxis = 'pixels X'
         self.yaxis = 'pixels Y'
 
+    @property
+    def darr_raw(self):
+        if self._darr_raw is None:
+            return sqrt(self.arr_raw, dtype=self.dtype)
+        return self._darr_raw
+
+    @property
+    def arr(self):
+        return self.region()
+
+    @property
+    def darr(self):
+        return self.region(errors=True)
+
+    def region(self, key=Ellipsis, errors=False):
+        """Return the normalized counts (or with *errors* true, their
+        errors) of the pixels selected by the index *key*, e.g.
+        ``data.region(numpy.s_[10:20, 30:40])``.
+
+        Only these pixels are read and converted.
+        """
+        if errors and self._darr_raw is not None:
+            raw = array(self._darr_raw[key], self.dtype)
+        else:
+            raw = array(self.arr_raw[key], self.dtype)
+            if errors:
+                sqrt(raw, out=raw)
+        if self.norm != 1:
+            # "raw" is a new array, so it can be scaled in place
+            raw /= self.dtype(self.norm)
+        return raw
+
     def __reduce__(self):
-        # avoid storing both arr and arr_raw in the pickle files
-        return (self.__class__, (self.meta, self.arr, self.darr, self.norm,
-                                 self.nscale, self.name, self.sources))
+        # store only the raw arrays; memory mapped ones are stored as a copy
+        return (self.__class__, (self.meta, asarray(self.arr_raw),
+                                 self._darr_raw, self.norm_raw, self.nscale,
+                                 self.name, self.sources, self.dtype))
 
     def __add__(self, other):
         if not isinstance(other, ImageData):
             raise TypeError
-        return self.__class__(self.meta, self.arr_raw + other.arr_raw,
-                              sqrt(self.darr_raw**2 + other.darr_raw**2),
-                              self.norm_raw + other.norm_raw,
+        if self._darr_raw is None and other._darr_raw is None:
+            # the sum still has Poisson errors
+            darr = None
+        else:
+            darr = sqrt(self.darr_raw**2 + other.darr_raw**2)
+        arrays = [self.arr_raw, other.arr_raw]
+        return self.__class__(self.meta, add(*arrays,
+                                             dtype=_sum_dtype(arrays)),
+                              darr, self.norm_raw + other.norm_raw,
                               self.nscale, name=self.name + '+' + other.name,
-                              sources=self.sources + other.sources)
+                              sources=self.sources + other.sources,
+                              dtype=self.dtype)
 
     def __subtract__(self, other):
         if not isinstance(other, ImageData):
@@ -328,7 +453,8 @@ class ImageData(DataBase):
                               sqrt(self.darr_raw**2 + scaled_darr**2),
                               self.norm_raw, self.nscale,
                               name=self.name + '-' + other.name,
-                              sources=self.sources + other.sources)
+                              sources=self.sources + other.sources,
+                              dtype=self.dtype)
 
     def plot(self, axes=None, **kw):
         """Plot the image dataset using matplotlib.
@@ -343,8 +469,87 @@ class ImageData(DataBase):
         return reduce(operator.add, others, self)
 
     def __repr__(self):
-        return '<%s (%dx%d pixels)>' % (self.name, self.arr.shape[0],
-                                        self.arr.shape[1])
+        return '<%s (%dx%d pixels)>' % (self.name, self.arr_raw.shape[0],
+                                        self.arr_raw.shape[1])
+
+
+class ImageStack(object):
+    """A 3-dimensional view of a series of images of the same shape.
+
+    Indexing works like for an array of shape ``(images, x, y)`` of the
+    normalized counts, e.g. ``stack[:, 10:20, 30:40]``, but only the
+    selected pixels are read from the images, and the stack itself does not
+    hold any pixel data.
+    """
+
+    def __init__(self, images, dtype=None):
+        self.images = list(images)
+        if not self.images:
+            raise UFitError('an image stack needs at least one image')
+        shapes = set(img.arr_raw.shape for img in self.images)
+        if len(shapes) != 1:
+            raise UFitError('images of a stack must have the same shape')
+        self.dtype = npdtype(dtype or self.images[0].dtype).type
+
+    @property
+    def shape(self):
+        return (len(self.images),) + self.images[0].arr_raw.shape
+
+    def __len__(self):
+        return len(self.images)
+
+    def _select(self, key, errors):
+        if not isinstance(key, tuple):
+            key = (key,)
+        which, pixels = key[0], key[1:] or Ellipsis
+        if which is Ellipsis:
+            which = slice(None)
+        if isinstance(which, slice):
+            return array([self.images[i].region(pixels, errors)
+                          for i in range(*which.indices(len(self.images)))],
+                         self.dtype)
+        if isinstance(which, (list, ndarray)):
+            return array([self.images[i].region(pixels, errors)
+                          for i in which], self.dtype)
+        return asarray(self.images[which].region(pixels, errors), self.dtype)
+
+    def __getitem__(self, key):
+        return self._select(key, False)
+
+    def errors(self, key=Ellipsis):
+        """Return the errors of the normalized counts selected by *key*."""
+        return self._select(key, True)
+
+    def integrate(self, key=Ellipsis):
+        """Return the sums of the normalized counts in the region selected
+        by the pixel index *key* for each image, and their errors.
+        """
+        sums = empty(len(self.images))
+        errors = empty(len(self.images))
+        for i, img in enumerate(self.images):
+            sums[i] = img.region(key).sum()
+            errors[i] = sqrt((img.region(key, True)**2).sum())
+        return sums, errors
+
+    def sum(self):
+        """Return the sum of all images as an `ImageData`."""
+        first = self.images[0]
+        arr = zeros(first.arr_raw.shape,
+                    _sum_dtype([img.arr_raw for img in self.images]))
+        poisson = True
+        for img in self.images:
+            arr += img.arr_raw
+            poisson &= img._darr_raw is None
+        darr = None
+        if not poisson:
+            darr = sqrt(reduce(operator.add, (img.darr_raw**2
+                                              for img in self.images)))
+        return ImageData(first.meta, arr, darr,
+                         sum(img.norm_raw for img in self.images),
+                         first.nscale, name='+'.join(img.name
+                                                     for img in self.images),
+                         sources=sum((img.sources for img in self.images),
+                                     []), dtype=self.dtype)
 
 
 class DataList(dict):
@@ -0,0 +1,105 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# ufit, a universal scattering fitting suite
+#
+# Copyright (c) 2013-2020, Georg Brandl and contributors.  All rights reserved.
+# Licensed under a 2-clause BSD license, see LICENSE.
+# *****************************************************************************
+
+"""Automatic detection of data file formats."""
+
+import time
+from os import path
+
+from ufit import UFitError
+
+__all__ = ['FormatDetector']
+
+# number of bytes from the start of the file used to match signatures
+HEADSIZE = 4096
+
+
+class FormatDetector(object):
+    """Detects the format of data files.
+
+    Readers can define a ``signature``, a tuple ``(offset, bytes)`` of a
+    string that identifies the format at a fixed position in the file.
+    These are matched against one block read from the file, so they cost
+    no additional I/O.  Other readers are probed with their ``check_data``.
+
+    Since a directory usually contains files of one format, the format
+    detected last for each directory is tried first for the next file.
+    As before, the "simple" formats, which accept almost anything, are only
+    tried if no other format matches.
+    """
+
+    def __init__(self):
+        # directory -> last detected format name
+        self.memory = {}
+        self.files = 0
+        self.probes = 0
+        self.time = 0.0
+        # (remembered format, number of formats) -> order to probe
+        self._orders = {}
+
+    def _candidates(self, formats, key):
+        remembered = self.memory.get(key)
+        cachekey = (remembered, len(formats))
+        if cachekey in self._orders:
+            return self._orders[cachekey]
+        groups = ([], [])
+        for name in formats:
+            group = groups[name.startswith('simple')]
+            if name == remembered:
+                group.insert(0, name)
+            else:
+                group.append(name)
+        order = self._orders[cachekey] = groups[0] + groups[1]
+        return order
+
+    def _matches(self, rdr, fobj, head):
+        self.probes += 1
+        signature = getattr(rdr, 'signature', None)
+        if signature is None:
+            return rdr.check_data(fobj)
+        offset, magic = signature
+        if offset + len(magic) <= len(head):
+            return head[offset:offset + len(magic)] == magic
+        fobj.seek(offset, 0)
+        data = fobj.read(len(magic))
+        fobj.seek(0, 0)
+        return data == magic
+
+    def detect(self, filename, fobj, formats):
+        """Return the name of the format of the file *fobj*, choosing from
+        the reader modules in *formats*.
+        """
+        started = time.time()
+        try:
+            try:
+                # buffered files give us the first block without seeking
+                head = fobj.peek(HEADSIZE)
+            except AttributeError:
+                head = fobj.read(HEADSIZE)
+                fobj.seek(0, 0)
+            key = path.dirname(filename)
+            for name in self._candidates(formats, key):
+                if self._matches(formats[name], fobj, head):
+                    self.memory[key] = name
+                    return name
+            raise UFitError('File %r has no recognized file format' %
+                            filename)
+        finally:
+            self.files += 1
+            self.time += time.time() - started
+
+    def forget(self):
+        """Forget the formats detected for all directories."""
+        self.memory.clear()
+
+    def stats(self):
+        """Return a dictionary with the number of detected files, the
+        number of formats probed and the total time spent.
+        """
+        return {'files': self.files, 'probes': self.probes,
+                'time': self.time, 'directories': dict(self.memory)}
@@ -0,0 +1,244 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# ufit, a universal scattering fitting suite
+#
+# Copyright (c) 2013-2020, Georg Brandl and contributors.  All rights reserved.
+# Licensed under a 2-clause BSD license, see LICENSE.
+# *****************************************************************************
+
+"""Following data files that are still being written."""
+
+import io
+import os
+import time
+
+from numpy import empty, ones, sqrt
+
+from ufit import UFitError
+from ufit.pycompat import string_types
+
+__all__ = ['Follower', 'row_layout']
+
+
+def row_layout(data, marker, namesline, nlines, exclude=(), comments='#',
+               prefix=''):
+    """Helper for the readers' ``data_layout`` functions.
+
+    In the file contents *data*, the data rows start *nlines* lines after
+    the line starting with *marker*, and the column names are given in the
+    *namesline*-th line after it (after a *prefix*).  Columns named in
+    *exclude* are skipped, and *comments* starts a comment in the rows.
+    """
+    if data.startswith(marker):
+        pos = 0
+    else:
+        pos = data.find(b'\n' + marker)
+        if pos < 0:
+            return None
+        pos += 1
+    lines = []
+    for _ in range(nlines + 1):
+        end = data.find(b'\n', pos)
+        if end < 0:
+            return None
+        lines.append(data[pos:end])
+        pos = end + 1
+    allnames = lines[namesline].decode('ascii', 'ignore')
+    if prefix and allnames.startswith(prefix):
+        allnames = allnames[len(prefix):]
+    allnames = allnames.split()
+    usecols = [i for (i, name) in enumerate(allnames)
+               if name not in exclude]
+    if not usecols:
+        return None
+    return {'offset': pos, 'colnames': [allnames[i] for i in usecols],
+            'usecols': usecols, 'comments': comments}
+
+
+class Follower(object):
+    """Follows the data file of a dataset while it is being written.
+
+    Each call to :meth:`poll` adds the points that have been appended to the
+    file since the last call to the dataset, using
+    :meth:`ScanData.append_points`.  For formats whose readers define a
+    ``data_layout`` (NICOS, old NICOS and ILL), only the new rows are read
+    and parsed; for other formats the whole file is read again.
+
+    The column values (``col_*``), column means and hkle values in the
+    metadata are updated as well, the environment strings are not.
+
+    *dycol* is the Y errors column as given when loading the dataset.  If a
+    *model* is given, it is fitted again after new points have been added,
+    starting from the current parameter values; the result is stored in
+    the ``result`` attribute.
+    """
+
+    def __init__(self, dataset, dycol=None, model=None, loader=None):
+        from ufit.data.loader import Loader
+        if len(dataset.sources) > 1:
+            raise UFitError('merged datasets cannot be followed')
+        if getattr(dataset.x, 'ndim', 1) != 1:
+            raise UFitError('datasets with hkl as X cannot be followed')
+        self.dataset = dataset
+        self.filename = dataset.meta['datafilename']
+        if not self.filename:
+            raise UFitError('dataset was not loaded from a file')
+        self.loader = loader or Loader()
+        self.dycol = dycol
+        self.model = model
+        self.result = None
+        # statistics: number of polls, full re-reads and time spent
+        self.polls = 0
+        self.reloads = 0
+        self.time = 0.0
+        self._start()
+
+    def _read(self):
+        # return the file contents up to the last complete line
+        with io.open(self.filename, 'rb') as fp:
+            data = fp.read()
+            st = os.fstat(fp.fileno())
+        self._stat = (st.st_size, st.st_mtime)
+        return data[:data.rfind(b'\n') + 1]
+
+    def _start(self):
+        data = self._read()
+        self.rdr, isimg = self.loader._get_reader(self.filename,
+                                                  io.BytesIO(data))
+        if isimg:
+            raise UFitError('image data cannot be followed')
+        layout = getattr(self.rdr, 'data_layout', lambda data: None)(data)
+        coldata = None
+        if layout is not None:
+            coldata = self._parse(layout, data[layout['offset']:])
+        if coldata is None:
+            layout = None
+            colnames, coldata, _ = self.rdr.read_data(self.filename,
+                                                      io.BytesIO(data))
+        else:
+            colnames = layout['colnames']
+        self.layout = layout
+        self.offset = len(data)
+        self.colnames = colnames
+
+        dset = self.dataset
+        try:
+            self._index = [colnames.index(col) if col is not None else None
+                           for col in (dset.xcol, dset.ycol, self._dycol(
+                               colnames, coldata), dset.ncol)]
+        except ValueError as err:
+            raise UFitError('column of the dataset not found: %s' % err)
+        self._cols = empty((max(16, 2 * len(coldata)), len(colnames)))
+        self.npoints = 0
+        self._means = dict((name, 0.0) for name in colnames)
+        if len(coldata) < len(dset.x):
+            raise UFitError('data file has fewer points than the dataset')
+        # if the hkle values are the first four columns, they are kept as a
+        # view of the column buffer
+        hkle = dset.meta.get('hkle')
+        self._hkle = len(colnames) >= 4 and \
+            getattr(hkle, 'shape', None) == (len(dset.x), 4) and \
+            (hkle == coldata[:len(dset.x), :4]).all()
+        # the file may already have grown since the dataset was loaded
+        self._store(coldata[:len(dset.x)])
+        self._pending = coldata[len(dset.x):]
+
+    def _dycol(self, colnames, coldata):
+        dycol = self.dycol
+        if dycol == 'auto':
+            dycol = self.rdr.guess_cols(colnames, coldata, {})[2]
+        if dycol is None or isinstance(dycol, string_types):
+            return dycol
+        return colnames[dycol - 1]   # 1-based indices
+
+    def _parse(self, layout, text):
+        from ufit.data.nicos import _read_columns
+        return _read_columns(text.decode('ascii', 'ignore'),
+                             layout['usecols'], layout['comments'])
+
+    def _store(self, coldata):
+        # add rows to the column buffer and update the metadata from it
+        n, m = self.npoints, self.npoints + len(coldata)
+        if m > len(self._cols):
+            cols = empty((2 * m, len(self.colnames)))
+            cols[:n] = self._cols[:n]
+            self._cols = cols
+        self._cols[n:m] = coldata
+        self.npoints = m
+        meta = self.dataset.meta
+        for i, name in enumerate(self.colnames):
+            meta['col_%s' % name] = self._cols[:m, i]
+            mean = self._means[name] = \
+                (self._means[name] * n + coldata[:, i].sum()) / (m or 1)
+            if name in meta and not isinstance(meta[name], string_types):
+                meta[name] = mean
+        if self._hkle:
+            meta['hkle'] = self._cols[:m, :4]
+
+    def _append(self, coldata):
+        if not len(coldata):
+            return 0
+        self._store(coldata)
+        xi, yi, dyi, ni = self._index
+        points = ones((len(coldata), 4))
+        points[:, 0] = coldata[:, xi]
+        points[:, 1] = coldata[:, yi]
+        if dyi is not None:
+            points[:, 2] = coldata[:, dyi]
+        else:
+            points[:, 2] = sqrt(points[:, 1])
+        if ni is not None:
+            points[:, 3] = coldata[:, ni]
+        self.dataset.append_points(points)
+        return len(coldata)
+
+    def _reload(self):
+        # read the whole file again and take the rows we don't have yet
+        self.reloads += 1
+        data = self._read()
+        colnames, coldata, _ = self.rdr.read_data(self.filename,
+                                                  io.BytesIO(data))
+        if colnames != self.colnames or len(coldata) < self.npoints:
+            raise UFitError('data file %r has been rewritten' %
+                            self.filename)
+        self.offset = len(data)
+        return self._append(coldata[self.npoints:])
+
+    def poll(self):
+        """Add new points from the data file to the dataset.
+
+        Returns the number of points added.  Raises `UFitError` if the file
+        has been rewritten instead of appended to.
+        """
+        started = time.time()
+        self.polls += 1
+        try:
+            added = self._append(self._pending)
+            self._pending = self._pending[:0]
+            added += self._read_new()
+            if added and self.model is not None:
+                self.result = self.model.fit(self.dataset)
+            return added
+        finally:
+            self.time += time.time() - started
+
+    def _read_new(self):
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return 0
+        if (st.st_size, st.st_mtime) == self._stat:
+            return 0
+        if self.layout is None or st.st_size < self.offset:
+            return self._reload()
+        with io.open(self.filename, 'rb') as fp:
+            fp.seek(self.offset)
+            data = fp.read()
+        self._stat = (st.st_size, st.st_mtime)
+        data = data[:data.rfind(b'\n') + 1]
+        coldata = self._parse(self.layout, data)
+        if coldata is None:
+            # not a regular table, let the reader sort it out
+            return self._reload()
+        self.offset += len(data)
+        return self._append(coldata)
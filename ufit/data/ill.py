@@ -13,15 +13,21 @@ import re
 from os import path
 from warnings import catch_warnings
 
-from numpy import array, genfromtxt, atleast_2d, concatenate
+from numpy import array, genfromtxt, atleast_2d, column_stack, \
+    concatenate, zeros
 
 from ufit import UFitError
+from ufit.data.follow import row_layout
+
+
+# identifies the format for autodetection: (offset, bytes)
+signature = (0, b'RRRRRRRRRRRR')
 
 
 def check_data(fp):
     dtline = fp.readline()
     fp.seek(0, 0)
-    return dtline.startswith(b'RRRRRRRRRRRR')
+    return dtline.startswith(signature[1])
 
 
 def guess_cols(colnames, coldata, meta):
@@ -45,15 +51,102 @@ def guess_cols(colnames, coldata, meta):
     return xg, yg, None, mg
 
 
+def guess_xcol(colnames, meta):
+    # like guess_cols, but with the Q/E steps from the scan command instead
+    # of the deviations in the data
+    if colnames[0] != 'QH':
+        return colnames[0]
+    names = ['QH', 'QK', 'QL', 'EN'][:4 if 'EN' in colnames else 3]
+    steps = {}
+    words = meta.get('subtitle', '').split()
+    for i, word in enumerate(words):
+        if word in ('dqh', 'dqk', 'dql', 'den'):
+            # "dqh" can be followed by the steps of all four coordinates
+            start = ['dqh', 'dqk', 'dql', 'den'].index(word)
+            for name, value in zip(['QH', 'QK', 'QL', 'EN'][start:],
+                                   words[i+1:i+5-start]):
+                try:
+                    steps[name] = abs(float(value))
+                except ValueError:
+                    break
+    steps = [steps.get(name, 0.0) for name in names]
+    if max(steps) > 0:
+        return names[steps.index(max(steps))]
+
+
 def read_data(filename, fp):
-    fp = io.TextIOWrapper(fp, 'ascii', 'ignore')
+    data = fp.read()
+    try:
+        return read_data_fast(filename, data)
+    except _Malformed:
+        return read_data_slow(filename, io.BytesIO(data))
+
+
+class _Malformed(Exception):
+    """Raised by the fast reader if the slow path should be taken."""
+
+
+def read_data_fast(filename, data):
+    """Read ILL TAS data from the file contents *data*.
+
+    The header is parsed as by the slow reader, and the data block is
+    converted in one go; for anything unusual (D23 files, rows with missing
+    or invalid values) `_Malformed` is raised.
+    """
+    fp = io.StringIO(data.decode('ascii', 'ignore'))
+    meta = _read_header(fp)
+    if meta is None:
+        # D23 format
+        raise _Malformed
+    lines = fp.read().splitlines()
+    if not lines:
+        raise _Malformed
+    all_names = lines[0].split()
+    # Berlin implementation adds "Finished ..." in the last line
+    rows = [row for row in lines[1:]
+            if row.strip() and not row.lstrip().startswith('F')]
+    if not all_names or not rows:
+        raise _Malformed
+    try:
+        values = array(' '.join(rows).split(), float)
+    except ValueError:
+        raise _Malformed
+    if values.size != len(rows) * len(all_names):
+        raise _Malformed
+    # XXX have to do flipper handling right
+    usecols = [i for (i, name) in enumerate(all_names)
+               if name not in ('PNT', 'F1', 'F2')]
+    names = [all_names[i] for i in usecols]
+    arr = values.reshape((len(rows), len(all_names)))[:, usecols]
+    meta.update(zip(names, arr.mean(0)))
+    meta['environment'] = _environment(meta)
+    if len(names) > 3 and names[3] == 'EN':
+        meta['hkle'] = arr[:, :4]
+        deviations = arr[:, :4].max(0) - arr[:, :4].min(0)
+        meta['hkle_vary'] = ['h', 'k', 'l', 'E'][deviations.argmax()]
+    elif names[0] == 'QH':  # 2-axis mode
+        meta['hkle'] = column_stack([arr[:, :3], zeros(len(arr))])
+        deviations = arr[:, :4].max(0) - arr[:, :4].min(0)
+        meta['hkle_vary'] = ['h', 'k', 'l', 'E'][deviations.argmax()]
+    return names, arr, meta
+
+
+def _environment(meta):
+    environment = []
+    if 'TT' in meta:
+        environment.append('T = %.3f K' % meta['TT'])
+    if 'MAG' in meta:
+        environment.append('B = %.5f T' % meta['MAG'])
+    return environment
+
+
+def _read_header(fp):
+    # read up to the DATA_ line; returns None for D23 files
     line = ''
     meta = {}
     while line.strip() != 'DATA_:':
         if line.startswith('IIIIIIIIIIIIIIIIIII'):
-            # D23 format
-            fp.seek(0, 0)
-            return read_data_d23(filename, fp)
+            return None
         if line.startswith('COMND:'):
             meta['subtitle'] = ' '.join(line[7:].rstrip().lower().split())
         elif line.startswith('TITLE:'):
@@ -72,6 +165,36 @@ def read_data(filename, fp):
         line = fp.readline()
         if not line:
             break
+    return meta
+
+
+def read_meta(filename, fp):
+    fp = io.TextIOWrapper(fp, 'ascii', 'ignore')
+    meta = _read_header(fp)
+    if meta is None:
+        # D23 format, which has no separate header
+        fp.seek(0, 0)
+        names, _, meta = read_data_d23(filename, fp)
+        return names, meta
+    names = [name for name in fp.readline().split()
+             if name not in ('PNT', 'F1', 'F2')]
+    meta['environment'] = _environment(meta)
+    return names, meta
+
+
+def data_layout(data):
+    # for following growing files: see ufit.data.follow; the Berlin
+    # implementation's "Finished ..." line is treated as a comment
+    return row_layout(data, b'DATA_:', 1, 1, ('PNT', 'F1', 'F2'), 'F')
+
+
+def read_data_slow(filename, fp):
+    fp = io.TextIOWrapper(fp, 'ascii', 'ignore')
+    meta = _read_header(fp)
+    if meta is None:
+        # D23 format
+        fp.seek(0, 0)
+        return read_data_d23(filename, fp)
     all_names = fp.readline().split()
     if not all_names:
         raise UFitError('No data columns found in in file %r' % filename)
@@ -93,11 +216,7 @@ def read_data(filename, fp):
         print('!!! %s' % warning.message)
     for i, n in enumerate(names):
         meta[n] = arr[:, i].mean()
-    meta['environment'] = []
-    if 'TT' in meta:
-        meta['environment'].append('T = %.3f K' % meta['TT'])
-    if 'MAG' in meta:
-        meta['environment'].append('B = %.5f T' % meta['MAG'])
+    meta['environment'] = _environment(meta)
     if names[3] == 'EN':
         meta['hkle'] = arr[:, :4]
         deviations = array([(cs.max()-cs.min()) for cs in arr.T[:4]])
@@ -0,0 +1,274 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# ufit, a universal scattering fitting suite
+#
+# Copyright (c) 2013-2020, Georg Brandl and contributors.  All rights reserved.
+# Licensed under a 2-clause BSD license, see LICENSE.
+# *****************************************************************************
+
+"""Searchable index of data file metadata."""
+
+import os
+import re
+import sqlite3
+from os import path
+
+from ufit import UFitError
+from ufit.data.loader import Loader
+from ufit.data.dataset import sanitize_meta
+from ufit.utils import attrdict, extract_template
+from ufit.pycompat import iteritems, number_types, string_types
+
+__all__ = ['MetadataIndex', 'numor_string']
+
+# increase when the layout of the database changes
+INDEX_VERSION = 1
+
+HKLE = ['h', 'k', 'l', 'E']
+
+# scan properties that are matched as strings
+STRING_KEYS = ['template', 'filedesc', 'title', 'subtitle', 'environment',
+               'hkle_vary']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS scans (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE,
+    template TEXT,
+    numor INTEGER,
+    size INTEGER,
+    mtime REAL,
+    filedesc TEXT,
+    title TEXT,
+    subtitle TEXT,
+    environment TEXT,
+    hkle_vary TEXT,
+    h_min REAL, h_max REAL,
+    k_min REAL, k_max REAL,
+    l_min REAL, l_max REAL,
+    E_min REAL, E_max REAL
+);
+CREATE TABLE IF NOT EXISTS scanvalues (
+    scan INTEGER REFERENCES scans(id) ON DELETE CASCADE,
+    key TEXT,
+    value REAL
+);
+CREATE INDEX IF NOT EXISTS scanvalues_key ON scanvalues (key, value);
+CREATE INDEX IF NOT EXISTS scanvalues_scan ON scanvalues (scan);
+CREATE INDEX IF NOT EXISTS scans_template ON scans (template, numor);
+'''
+
+env_re = re.compile(r'^(\w+) = ([-+0-9.eE]+)')
+
+
+def numor_string(numors):
+    """Return a file number string for :func:`read_numors` that loads
+    each of the *numors* as a separate dataset, e.g. ``'10-15,23'``.
+    """
+    ranges = []
+    for n in sorted(set(numors)):
+        if ranges and n == ranges[-1][1] + 1:
+            ranges[-1][1] = n
+        else:
+            ranges.append([n, n])
+    return ','.join(a == b and '%d' % a or '%d-%d' % (a, b)
+                    for (a, b) in ranges)
+
+
+class MetadataIndex(object):
+    """An SQLite database with the metadata of data files.
+
+    For every file, the index stores the description, title, subtitle and
+    environment, the varied hkle component and the ranges of h, k, l and E,
+    and all numeric metadata (including column means).  Values given in the
+    environment strings, such as ``T = 1.500 K``, are stored under their
+    name ("T") unless the file has a value of that name already.
+
+    Use :meth:`update` to add files and :meth:`query` or
+    :meth:`query_numors` to search.  An example::
+
+       index = MetadataIndex('~/scans.db')
+       index.update('/data/p1234')
+       index.update('/data/p1235')
+       for template, numors in index.query_numors(
+               T=(1.5, 2), hkle_vary='E', h=1, k=0, l=0).items():
+           set_datatemplate(template)
+           datas = read_numors(numors, 0.01)
+    """
+
+    # numbers given as query conditions match within this tolerance
+    tolerance = 1e-3
+
+    def __init__(self, filename):
+        self.filename = path.expanduser(filename)
+        # (filename, message) for each file that failed in the last update
+        self.failures = []
+        self.db = sqlite3.connect(self.filename)
+        self.db.execute('PRAGMA foreign_keys = ON')
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version not in (0, INDEX_VERSION):
+            raise UFitError('metadata index %r has an unsupported version' %
+                            filename)
+        self.db.executescript(SCHEMA)
+        self.db.execute('PRAGMA user_version = %d' % INDEX_VERSION)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def _files(self, source):
+        if isinstance(source, string_types):
+            source = path.expanduser(source)
+            if path.isdir(source):
+                return [path.join(source, fn)
+                        for fn in sorted(os.listdir(source))]
+            # a file name template: take all files that match it
+            directory = path.dirname(source)
+            files = [path.join(directory, fn)
+                     for fn in sorted(os.listdir(directory))]
+            return [fn for fn in files if extract_template(fn)[0] == source]
+        return list(source)
+
+    def update(self, source, data=True):
+        """Add new and changed files to the index.
+
+        *source* is a directory, a file name template as for
+        :func:`set_datatemplate`, or a list of file names.  Files that are
+        already indexed and unchanged are skipped.
+
+        With *data* false, only the file headers are read, which is faster
+        but leaves out column means and hkle ranges.
+
+        Returns the number of files added or updated; files that can't be
+        read are skipped and listed in the ``failures`` attribute.
+        """
+        loader = Loader()
+        self.failures = []
+        known = dict((row[0], (row[1], row[2])) for row in self.db.execute(
+            'SELECT path, size, mtime FROM scans'))
+        count = 0
+        for fn in self._files(source):
+            fn = path.abspath(fn)
+            try:
+                st = os.stat(fn)
+            except OSError:
+                continue
+            if not path.isfile(fn):
+                continue
+            if known.get(fn) == (st.st_size, st.st_mtime):
+                continue
+            template, numor = extract_template(fn)
+            loader.template = template
+            try:
+                if data:
+                    result = loader._read_file(fn)[2]
+                    meta = dict(result[-1])
+                else:
+                    meta = loader.load_meta(numor)
+            except Exception as e:
+                self.failures.append((fn, str(e)))
+                continue
+            if 'filenumber' not in meta:
+                meta['filenumber'] = numor
+            self._store(fn, template, numor, st, meta)
+            count += 1
+        self.db.commit()
+        return count
+
+    def _store(self, fn, template, numor, st, meta):
+        meta = attrdict(meta)
+        sanitize_meta(meta, '')
+        ranges = [None] * 8
+        if 'hkle' in meta and len(meta['hkle']):
+            hkle = meta['hkle']
+            ranges[0::2] = map(float, hkle.min(0))
+            ranges[1::2] = map(float, hkle.max(0))
+        environment = meta['environment']
+        cur = self.db.cursor()
+        cur.execute('DELETE FROM scans WHERE path = ?', (fn,))
+        cur.execute(
+            'INSERT INTO scans (path, template, numor, size, mtime, filedesc, '
+            'title, subtitle, environment, hkle_vary, h_min, h_max, k_min, '
+            'k_max, l_min, l_max, E_min, E_max) VALUES (%s)' %
+            ', '.join('?' * 18),
+            [fn, template, numor, st.st_size, st.st_mtime,
+             str(meta['filedesc']), str(meta['title']),
+             str(meta['subtitle']), ', '.join(environment),
+             meta.get('hkle_vary')] + ranges)
+        scan = cur.lastrowid
+        values = {}
+        for key, value in iteritems(meta):
+            if isinstance(value, number_types) and \
+               not isinstance(value, bool):
+                values[key] = float(value)
+            elif hasattr(value, 'dtype') and value.shape == () and \
+                    value.dtype.kind in 'iuf':
+                values[key] = float(value)
+        for env in environment:
+            m = env_re.match(env)
+            if m and m.group(1) not in values:
+                values[m.group(1)] = float(m.group(2))
+        cur.executemany('INSERT INTO scanvalues VALUES (?, ?, ?)',
+                        [(scan, key, value) for (key, value)
+                         in iteritems(values)])
+
+    def remove(self, source):
+        """Remove the files given by *source* (as for :meth:`update`) from
+        the index.
+        """
+        self.db.executemany('DELETE FROM scans WHERE path = ?',
+                            [(path.abspath(fn),)
+                             for fn in self._files(source)])
+        self.db.commit()
+
+    def _condition(self, key, value):
+        # return an SQL condition and its arguments
+        if isinstance(value, tuple):
+            lo, hi = value
+        elif isinstance(value, number_types):
+            lo, hi = value - self.tolerance, value + self.tolerance
+        elif key in STRING_KEYS and isinstance(value, string_types):
+            return '%s LIKE ?' % key, [value]
+        else:
+            raise UFitError('invalid query condition %s=%r' % (key, value))
+        if key in HKLE:
+            # the scan range must overlap the given range
+            return '%s_max >= ? AND %s_min <= ?' % (key, key), [lo, hi]
+        return ('id IN (SELECT scan FROM scanvalues WHERE key = ? AND '
+                'value BETWEEN ? AND ?)', [key, lo, hi])
+
+    def query(self, **conditions):
+        """Return a list of ``(template, numor)`` for all indexed files that
+        match the *conditions*.
+
+        Conditions are given as keyword arguments:
+
+        * for h, k, l and E, a ``(min, max)`` tuple matches scans whose range
+          overlaps it, and a single number scans whose range includes it
+        * for other numeric values, a ``(min, max)`` tuple matches values in
+          that range, and a single number matches within ``tolerance``
+        * template, filedesc, title, subtitle, environment and hkle_vary
+          are matched with the SQL ``LIKE`` operator, so ``'%MnSi%'``
+          matches all titles containing "MnSi", case-insensitively
+        """
+        clauses = []
+        args = []
+        for key, value in sorted(iteritems(conditions)):
+            clause, clauseargs = self._condition(key, value)
+            clauses.append(clause)
+            args.extend(clauseargs)
+        sql = 'SELECT template, numor FROM scans'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY template, numor'
+        return [tuple(row) for row in self.db.execute(sql, args)]
+
+    def query_numors(self, **conditions):
+        """Like :meth:`query`, but return a dictionary mapping each file
+        name template to a file number string for :func:`read_numors`.
+        """
+        numors = {}
+        for template, numor in self.query(**conditions):
+            numors.setdefault(template, []).append(numor)
+        return dict((template, numor_string(ns))
+                    for (template, ns) in iteritems(numors))
@@ -61,7 +61,7 @@ def _float_fmt(x):
         return '%.3f' % x
 
 
-def read_data(filename, fp):
+def _read_header(fp):
     meta = {}
     dates = fp.read(10)
     d, m, y, hh, mm = DATEFMT.unpack(dates)
@@ -83,15 +83,37 @@ def read_data(filename, fp):
         meta['subtitle'] += 'ki=%.3f' % headerfields[103]
     else:
         meta['subtitle'] += 'kf=%.3f' % headerfields[103]
+    return meta
+
+
+def _point_format(point):
+    # the format is recognized from the first point
+    if POINTFMT.unpack(point)[15] != 1:
+        return POINTFMT_alt, POINTFIELDS_alt
+    return POINTFMT, POINTFIELDS
+
+
+def read_meta(filename, fp):
+    meta = _read_header(fp)
+    point = fp.read(POINTFMT.size)
+    if len(point) < POINTFMT.size:
+        meta['environment'] = []
+        return POINTFIELDS + ['qx', 'qy'], meta
+    pointfmt, pointfields = _point_format(point)
+    # without the data, take the temperature of the first point
+    meta['T'] = pointfmt.unpack(point)[pointfields.index('T') + 1]
+    meta['environment'] = ['T = %.3f K' % meta['T']]
+    return pointfields + ['qx', 'qy'], meta
+
+
+def read_data(filename, fp):
+    meta = _read_header(fp)
     parr = []
     pointfmt = POINTFMT
     pointfields = POINTFIELDS
     for i, point in enumerate(iter(lambda: fp.read(POINTFMT.size), b'')):
         if i == 0:
-            unp = pointfmt.unpack(point)
-            if unp[15] != 1:
-                pointfmt = POINTFMT_alt
-                pointfields = POINTFIELDS_alt
+            pointfmt, pointfields = _point_format(point)
         coords = pointfmt.unpack(point)[:len(pointfields) + 1]
         parr.append(coords + (coords[1] + 0.5*coords[2],
                               0.5*sqrt(3)*coords[2]))
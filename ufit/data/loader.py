@@ -9,47 +9,120 @@
 """Data loader object."""
 
 import io
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
-from numpy import ones, sqrt
+from numpy import float64, ones, sqrt
 
 from ufit import UFitError
+from ufit.data import cache
+from ufit.data.detect import FormatDetector
+from ufit.data.follow import Follower
 from ufit.data.dataset import ScanData, ImageData, DataList, DatasetList
 from ufit.pycompat import iteritems, string_types, number_types
 
 
 class Loader(object):
-    def __init__(self):
+    def __init__(self, datacache=None):
         self.format = 'auto'
         self.template = '%d'
         self.sets = DataList()
+        # if None, the global cache set by set_datacache() is used
+        self.datacache = datacache
+        # number of threads/processes used to read files in load_numors
+        self.workers = 1
+        self.use_processes = False
+        # (numor, message) for each file skipped in the last load_numors
+        self.failures = []
+        # used for the 'auto' format; see detector.stats() for timing
+        self.detector = FormatDetector()
+        # floating point type of the normalized image arrays
+        self.image_dtype = float64
 
     def _get_reader(self, filename, fobj):
         from ufit.data import data_formats, data_formats_image
         if self.format == 'auto':
-            for n, m in iteritems(data_formats):
-                # check 'simple' formats last
-                if not n.startswith('simple') and m.check_data(fobj):
-                    return m, n in data_formats_image
-            for n, m in iteritems(data_formats):
-                if n.startswith('simple') and m.check_data(fobj):
-                    return m, n in data_formats_image
-            raise UFitError('File %r has no recognized file format' % filename)
+            n = self.detector.detect(filename, fobj, data_formats)
+            return data_formats[n], n in data_formats_image
         return data_formats[self.format], self.format in data_formats_image
 
-    def _inner_load(self, n, xcol, ycol, dycol=None, ncol=None, nscale=1, filter=None):
-        try:
-            filename = self.template % n
-        except TypeError:
-            filename = self.template
+    def _read_file(self, filename):
+        """Return the reader, whether it reads images, and the result of its
+        ``read_data`` for *filename*, using the data cache if enabled.
+        """
+        from ufit.data import data_formats, data_formats_image
+        datacache = self.datacache or cache.get_datacache()
+        if datacache is not None:
+            cached = self._get_cached(datacache, filename)
+            if cached is not None:
+                fmt, result = cached
+                return data_formats[fmt], fmt in data_formats_image, result
         fobj = io.open(filename, 'rb')
+        if datacache is not None:
+            signature = datacache.signature(filename)
         rdr, isimg = self._get_reader(filename, fobj)
+        result = rdr.read_data(filename, fobj)
+        if datacache is not None:
+            fmt = [n for (n, m) in iteritems(data_formats) if m is rdr][0]
+            datacache.put(filename, fmt, rdr, result, signature)
+        return rdr, isimg, result
+
+    def _get_cached(self, datacache, filename):
+        from ufit.data import data_formats
+        if self.format == 'auto':
+            formats = data_formats
+        else:
+            formats = {self.format: data_formats[self.format]}
+        return datacache.get(filename, formats)
+
+    def _filename(self, n):
+        try:
+            return self.template % n
+        except TypeError:
+            return self.template
+
+    def _read_files(self, numors):
+        """Read the files for all *numors* with a pool of workers.
+
+        Returns a dictionary mapping each numor to the result of
+        `_read_file`, or to an exception if reading failed.
+        """
+        from ufit.data import data_formats, data_formats_image
+        numors = list(dict.fromkeys(numors))
+        tasks = [(self.format, self.datacache or cache.get_datacache(),
+                  self.detector, self._filename(n)) for n in numors]
+        poolcls = self.use_processes and Pool or ThreadPool
+        pool = poolcls(min(self.workers, len(tasks)))
+        try:
+            results = pool.map(_read_task, tasks,
+                               max(1, len(tasks) // (4 * self.workers)))
+        finally:
+            pool.close()
+            pool.join()
+        ret = {}
+        for n, (fmt, result) in zip(numors, results):
+            if fmt is None:
+                ret[n] = UFitError(result)
+            else:
+                ret[n] = (data_formats[fmt], fmt in data_formats_image, result)
+        return ret
+
+    def _inner_load(self, n, xcol, ycol, dycol=None, ncol=None, nscale=1,
+                    filter=None, read=None):
+        filename = self._filename(n)
+        if read is None:
+            read = self._read_file(filename)
+        elif isinstance(read, Exception):
+            raise read
+        rdr, isimg, result = read
         if isimg:
-            return self._inner_load_image(rdr, filename, fobj, n, ncol, nscale)
-        return self._inner_load_scan(rdr, filename, fobj, n, xcol, ycol, dycol,
-                                     ncol, nscale, filter)
+            return self._inner_load_image(rdr, filename, result, n, ncol,
+                                          nscale)
+        return self._inner_load_scan(rdr, filename, result, n, xcol, ycol,
+                                     dycol, ncol, nscale, filter)
 
-    def _inner_load_image(self, rdr, filename, fobj, n, ncol, nscale):
-        arr, darr, meta = rdr.read_data(filename, fobj)
+    def _inner_load_image(self, rdr, filename, result, n, ncol, nscale):
+        arr, darr, meta = result
         if 'filenumber' not in meta:
             meta['filenumber'] = n
         meta['datafilename'] = filename
@@ -59,13 +132,14 @@ class Loader(object):
             norm = meta[ncol]
         else:
             norm = 1
-        dset = ImageData(meta, arr, darr, norm, nscale)
+        dset = ImageData(meta, arr, darr, norm, nscale,
+                         dtype=self.image_dtype)
         self.sets[n] = dset
         return dset
 
-    def _inner_load_scan(self, rdr, filename, fobj, n,
+    def _inner_load_scan(self, rdr, filename, result, n,
                          xcol, ycol, dycol, ncol, nscale, filter):
-        colnames, coldata, meta = rdr.read_data(filename, fobj)
+        colnames, coldata, meta = result
         if filter is not None:
             for v, k in filter.items():
                 if v in colnames:
@@ -129,21 +203,68 @@ class Loader(object):
         self.sets[n] = dset
         return dset
 
-    def load(self, n, xcol, ycol, dycol=None, ncol=None, nscale=1, filter=None):
+    def load(self, n, xcol, ycol, dycol=None, ncol=None, nscale=1, filter=None,
+             read=None):
         try:
-            return self._inner_load(n, xcol, ycol, dycol, ncol, nscale, filter)
+            return self._inner_load(n, xcol, ycol, dycol, ncol, nscale, filter,
+                                    read)
         except Exception as e:
             raise UFitError('Could not load data file %d: %s' % (n, e))
 
-    def guess_cols(self, n):
+    def follow(self, n, xcol, ycol, dycol=None, ncol=None, nscale=1,
+               model=None):
+        """Load data file *n* and return a `Follower` that adds points
+        appended to the file to the dataset (its ``dataset`` attribute).
+        """
+        if xcol == 'hkl':
+            raise UFitError('datasets with hkl as X cannot be followed')
+        dset = self.load(n, xcol, ycol, dycol, ncol, nscale)
+        return Follower(dset, dycol, model, self)
+
+    def load_meta(self, n):
+        """Return the metadata of data file *n*, reading only the file
+        header where the format allows it.
+
+        The names of the data columns are given as ``meta['colnames']``, and
+        a guess for the X column as ``meta['xcol']``; from the header alone,
+        this is only exact for formats whose readers define a ``guess_xcol``
+        function.  Values that are derived from the data, like column means,
+        are only present if the file is in the data cache.
+        """
+        from ufit.data import data_formats, data_formats_image
+        filename = self._filename(n)
+        datacache = self.datacache or cache.get_datacache()
+        xcol = None
         try:
-            filename = self.template % n
-        except TypeError:
-            filename = self.template
-        fobj = io.open(filename, 'rb')
-        rdr, isimg = self._get_reader(filename, fobj)
+            cached = datacache and self._get_cached(datacache, filename)
+            if cached:
+                fmt, result = cached
+                meta = result[-1]
+                colnames = [] if fmt in data_formats_image else result[0]
+                if colnames:
+                    xcol = data_formats[fmt].guess_cols(*result)[0]
+            else:
+                with io.open(filename, 'rb') as fobj:
+                    rdr, _ = self._get_reader(filename, fobj)
+                    colnames, meta = rdr.read_meta(filename, fobj)
+                if colnames and hasattr(rdr, 'guess_xcol'):
+                    xcol = rdr.guess_xcol(colnames, meta)
+        except Exception as e:
+            raise UFitError('Could not read metadata of data file %d: %s' %
+                            (n, e))
+        if 'filenumber' not in meta:
+            meta['filenumber'] = n
+        meta['datafilename'] = filename
+        meta['colnames'] = colnames
+        meta['xcol'] = xcol or meta.get('hkle_vary') or \
+            (colnames and colnames[0] or '')
+        return meta
+
+    def guess_cols(self, n):
+        filename = self._filename(n)
+        rdr, isimg, result = self._read_file(filename)
         if isimg:
-            arr, darr, meta = rdr.read_data(filename, fobj)
+            arr, darr, meta = result
             mguess = rdr.guess_norm(meta)
             if mguess:
                 nmon = int(float('%.2g' % meta[mguess]))
@@ -152,7 +273,7 @@ class Loader(object):
             xguess, yguess, dyguess = None, None, None
             colnames = list(meta)
         else:
-            colnames, coldata, meta = rdr.read_data(filename, fobj)
+            colnames, coldata, meta = result
             xguess, yguess, dyguess, mguess = rdr.guess_cols(colnames, coldata, meta)
             if mguess is not None:
                 # use average monitor counts for normalization, but
@@ -168,7 +289,8 @@ class Loader(object):
         return colnames, xguess, yguess, dyguess, mguess, nmon
 
     def load_numors(self, nstring, binsize, xcol, ycol, dycol=None,
-                    ncol=None, nscale=1, floatmerge=True, filter=None):
+                    ncol=None, nscale=1, floatmerge=True, filter=None,
+                    skip_failed=False):
         """Load a number of data files and merge them according to numor
         list operations:
 
@@ -176,6 +298,14 @@ class Loader(object):
         * ``-`` - put sequential files in individual data sets
         * ``+`` - merge single files
         * ``>`` - merge sequential files
+
+        With ``self.workers > 1``, the files are read concurrently by a pool
+        of threads (or processes, if ``self.use_processes`` is set) before
+        the datasets are built and merged in order.
+
+        If a file can't be loaded, an error is raised, unless *skip_failed*
+        is true: then the file is left out and listed in ``self.failures``,
+        and an error is only raised if no dataset could be loaded at all.
         """
         if not isinstance(binsize, number_types):
             raise UFitError('binsize argument must be a number')
@@ -187,28 +317,80 @@ class Loader(object):
                 raise UFitError('Invalid file number: %r' % a)
         # operator "precedence": ',' has lowest, then '+',
         # then '-' and '>' (equal)
-        parts1 = nstring.split(',')
-        datasets = []
-        for part1 in parts1:
+        # first collect a plan: a list of (numors, None) for single datasets
+        # and ([numors, ...], True) for sets merged from inner groups
+        plan = []
+        for part1 in nstring.split(','):
             if '-' in part1:
                 a, b = map(toint, part1.split('-'))
-                datasets.extend(
-                    self.load(n, xcol, ycol, dycol, ncol, nscale, filter).merge(
-                        binsize, floatmerge=floatmerge) for n in range(a, b+1))
+                plan.extend(([n], None) for n in range(a, b+1))
             else:
-                parts2 = part1.split('+')
                 inner = []
-                for part2 in parts2:
+                for part2 in part1.split('+'):
                     if '>' in part2:
                         a, b = map(toint, part2.split('>'))
-                        ds = [self.load(n, xcol, ycol, dycol, ncol, nscale, filter)
-                              for n in range(a, b+1)]
-                        inner.append(ds[0].merge(binsize, *ds[1:],
-                                                 floatmerge=floatmerge))
+                        inner.append(list(range(a, b+1)))
                     else:
-                        inner.append(
-                            self.load(toint(part2), xcol, ycol, dycol,
-                                      ncol, nscale, filter))
-                datasets.append(inner[0].merge(binsize, *inner[1:],
-                                               floatmerge=floatmerge))
+                        inner.append([toint(part2)])
+                plan.append((inner, True))
+
+        allnumors = []
+        for group, merged in plan:
+            allnumors.extend(sum(group, []) if merged else group)
+        if self.workers > 1 and len(allnumors) > 1:
+            reads = self._read_files(allnumors)
+        else:
+            reads = {}
+
+        # now load and merge in the original order; with skip_failed, files
+        # that fail are skipped and reported in self.failures
+        self.failures = []
+        failed = set()
+
+        def load(n):
+            if n in failed:
+                return None
+            try:
+                # a numor given twice is read again, so that the datasets
+                # don't share their metadata
+                return self.load(n, xcol, ycol, dycol, ncol, nscale, filter,
+                                 reads.pop(n, None))
+            except UFitError as e:
+                if not skip_failed:
+                    raise
+                failed.add(n)
+                self.failures.append((n, str(e)))
+
+        def merge(ds):
+            ds = [d for d in ds if d is not None]
+            if ds:
+                return ds[0].merge(binsize, *ds[1:], floatmerge=floatmerge)
+
+        datasets = []
+        for group, merged in plan:
+            if merged:
+                dset = merge([merge([load(n) for n in inner])
+                              for inner in group])
+            else:
+                dset = merge([load(group[0])])
+            if dset is not None:
+                datasets.append(dset)
+        if self.failures and not datasets:
+            raise UFitError('\n'.join(msg for (_, msg) in self.failures))
         return DatasetList(datasets)
+
+
+def _read_task(args):
+    # runs in a pool worker: returns (format name, read_data result), or
+    # (None, error message) since exceptions might not be picklable
+    from ufit.data import data_formats
+    fmt, datacache, detector, filename = args
+    loader = Loader(datacache)
+    loader.format = fmt
+    # with threads, the detector (and its memory) is shared
+    loader.detector = detector
+    try:
+        rdr, _, result = loader._read_file(filename)
+    except Exception as e:
+        return None, str(e)
+    return [n for (n, m) in iteritems(data_formats) if m is rdr][0], result
@@ -11,15 +11,21 @@
 import io
 import time
 
-from numpy import array, loadtxt
+from numpy import array, empty, loadtxt
 
 from ufit import UFitError
+from ufit.data.follow import row_layout
+from ufit.pycompat import iteritems
+
+
+# identifies the format for autodetection: (offset, bytes)
+signature = (0, b'### NICOS data file')
 
 
 def check_data(fp):
     dtline = fp.readline()
     fp.seek(0, 0)
-    return dtline.startswith(b'### NICOS data file')
+    return dtline.startswith(signature[1])
 
 
 def _hkle_index(colnames):
@@ -60,8 +66,7 @@ def guess_cols(colnames, coldata, meta):
     return xg, yg, None, mg
 
 
-def read_data(filename, fp):
-    fp = io.TextIOWrapper(fp, 'ascii', 'ignore')
+def _read_header(filename, fp):
     meta = {}
     dtline = fp.readline()
     if not dtline.startswith('### NICOS data file'):
@@ -115,34 +120,102 @@ def read_data(filename, fp):
         meta['title'] += ', ' + remark
     colnames = fp.readline()[1:].split()
     colunits = fp.readline()[1:].split()
+    return colnames, colunits, meta
+
+
+def read_data(filename, fp):
+    fp = io.TextIOWrapper(fp, 'ascii', 'ignore')
+    colnames, colunits, meta = _read_header(filename, fp)
     return _nicos_common_load(fp, colnames, colunits, meta, '#')
 
 
-def _nicos_common_load(fp, colnames, colunits, meta, comments):
-    def convert_value(s):
+def read_meta(filename, fp):
+    fp = io.TextIOWrapper(fp, 'ascii', 'ignore')
+    colnames, _, meta = _read_header(filename, fp)
+    return _nicos_common_meta(colnames, meta)
+
+
+def data_layout(data):
+    # for following growing files: see ufit.data.follow
+    return row_layout(data, b'### Scan data', 1, 2, (';',), '#', '#')
+
+
+def _convert_value(s):
+    try:
+        return float(s)
+    except ValueError:
+        return 0.0
+
+
+def _read_columns(text, usecols, comments):
+    """Read the whitespace separated columns *usecols* from *text*.
+
+    Only columns that contain tokens which are not valid numbers are
+    converted cell by cell, with invalid values read as 0.  Returns None if
+    the block is not a regular table.
+    """
+    rows = []
+    for line in text.splitlines():
+        if comments in line:
+            line = line[:line.index(comments)]
+        items = line.split()
+        if items:
+            rows.append(items)
+    if not rows:
+        return empty((0, len(usecols)))
+    ncols = len(rows[0])
+    if ncols <= max(usecols) or any(len(row) != ncols for row in rows):
+        return None
+    tokens = array(rows)[:, usecols]
+    coldata = empty(tokens.shape)
+    for i in range(tokens.shape[1]):
         try:
-            return float(s)
+            coldata[:, i] = tokens[:, i].astype(float)
         except ValueError:
-            return 0.0
-    cvdict = dict((i, convert_value) for i in range(len(colnames))
-                  if colnames[i] != ';')
+            coldata[:, i] = [_convert_value(s) for s in tokens[:, i]]
+    return coldata
+
+
+def _environment(meta, names):
+    environment = []
+    for tcol in ['Ts', 'sT', 'T_ccr5_A', 'T_ccr5_B', 'sensor1']:
+        if tcol in names:
+            environment.append('T = %.3f K' % meta[tcol])
+            break
+    if 'B' in names:
+        environment.append('B = %.3f K' % meta['B'])
+    return environment
+
+
+def _nicos_common_meta(colnames, meta):
+    # without the data, the environment is taken from the header values
+    colnames = [name for name in colnames if name != ';']
+    meta['environment'] = _environment(
+        meta, [k for (k, v) in iteritems(meta) if isinstance(v, float)])
+    return colnames, meta
+
+
+def _nicos_common_load(fp, colnames, colunits, meta, comments):
+    usecols = [i for i in range(len(colnames)) if colnames[i] != ';']
     colnames = [name for name in colnames if name != ';']
     colunits = [unit for unit in colunits if unit != ';']
-    usecols = list(cvdict)
-    coldata = loadtxt(fp, converters=cvdict, usecols=usecols, ndmin=2,
-                      comments=comments)
+    text = fp.read()
+    try:
+        # fast path: let numpy parse the whole block natively
+        coldata = loadtxt(io.StringIO(text), usecols=usecols, ndmin=2,
+                          comments=comments)
+    except ValueError:
+        coldata = _read_columns(text, usecols, comments) if usecols else None
+        if coldata is None:
+            cvdict = dict((i, _convert_value) for i in usecols)
+            coldata = loadtxt(io.StringIO(text), converters=cvdict,
+                              usecols=usecols, ndmin=2, comments=comments)
     if not coldata.size:
         raise UFitError('empty data file')
     cols = dict((name, coldata[:, i]) for (i, name) in enumerate(colnames))
-    meta['environment'] = []
     for col in cols:
         meta[col] = cols[col].mean()
-    for tcol in ['Ts', 'sT', 'T_ccr5_A', 'T_ccr5_B', 'sensor1']:
-        if tcol in cols:
-            meta['environment'].append('T = %.3f K' % meta[tcol])
-            break
-    if 'B' in cols:
-        meta['environment'].append('B = %.3f K' % meta['B'])
+    meta['environment'] = _environment(meta, cols)
     qhindex = _hkle_index(colnames)
     if qhindex > -1:
         meta['hkle'] = coldata[:, qhindex:qhindex+4]
@@ -12,18 +12,23 @@ import io
 import time
 
 from ufit import UFitError
-from ufit.data.nicos import _nicos_common_load
+from ufit.data.nicos import _nicos_common_load, _nicos_common_meta
+from ufit.data.follow import row_layout
 
 # guess_cols is the same as for new nicos format
 
 from ufit.data.nicos import guess_cols
 
 
+# identifies the format for autodetection: (offset, bytes)
+signature = (0, b'filename')
+
+
 def check_data(fp):
     dtline = fp.readline()
     fp.seek(0, 0)
     # not sure if it is enough, but it is working
-    return dtline.startswith(b'filename')
+    return dtline.startswith(signature[1])
 
 
 mapping = {
@@ -52,8 +57,7 @@ blacklist = set([
 ])
 
 
-def read_data(filename, fp):
-    fp = io.TextIOWrapper(fp, 'ascii', 'ignore')
+def _read_header(filename, fp):
     meta = {}
     first_pos = fp.tell()
     dtline = fp.readline()
@@ -123,9 +127,25 @@ def read_data(filename, fp):
         meta['filename'] = meta['filename'].strip("'")
         meta['filenumber'] = int(meta['filename'].split("_")[1])
 
-    # read data
+    # subtitle and column names precede the data
     meta['subtitle'] = fp.readline().strip()
     colnames = fp.readline().split()
     colunits = fp.readline().split()
+    return colnames, colunits, meta
+
 
+def read_data(filename, fp):
+    fp = io.TextIOWrapper(fp, 'ascii', 'ignore')
+    colnames, colunits, meta = _read_header(filename, fp)
     return _nicos_common_load(fp, colnames, colunits, meta, '*')
+
+
+def read_meta(filename, fp):
+    fp = io.TextIOWrapper(fp, 'ascii', 'ignore')
+    colnames, _, meta = _read_header(filename, fp)
+    return _nicos_common_meta(colnames, meta)
+
+
+def data_layout(data):
+    # for following growing files: see ufit.data.follow
+    return row_layout(data, b'scan data', 2, 3, (';',), '*')
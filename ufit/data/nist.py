@@ -52,9 +52,7 @@ def _read_meta(fp):
     return values
 
 
-def read_data(filename, fp):
-    fp = io.TextIOWrapper(fp, 'ascii', 'ignore')
-
+def _read_header(fp):
     meta = {}
     meta['instrument'] = 'NIST'
 
@@ -95,6 +93,20 @@ def read_data(filename, fp):
         raise Exception('unknown scan type %r' % meta1[2])
 
     colnames = fp.readline().split()
+    return colnames, mon, meta
+
+
+def read_meta(filename, fp):
+    fp = io.TextIOWrapper(fp, 'ascii', 'ignore')
+    colnames, _, meta = _read_header(fp)
+    # without the data, use the temperature given in the header
+    meta['environment'] = ['T = %.3f K' % meta['temp']]
+    return colnames + ['Mon'], meta
+
+
+def read_data(filename, fp):
+    fp = io.TextIOWrapper(fp, 'ascii', 'ignore')
+    colnames, mon, meta = _read_header(fp)
     arr = loadtxt(fp, ndmin=2)
     # if number of colnames is not correct, discard them
     if len(colnames) != arr.shape[1]:
@@ -44,8 +44,7 @@ def check_data(fp):
     return check_data_simple(fp, None)
 
 
-def read_data_simple(filename, fp, sep=None):
-    fp = io.TextIOWrapper(fp, 'ascii', 'ignore')
+def _read_header(fp):
     line1 = ''
     line2 = fp.readline()
     skiprows = 0
@@ -67,12 +66,31 @@ def read_data_simple(filename, fp, sep=None):
         # must be column names
         colnames = line2.split()
         skiprows += 1
+        line2 = fp.readline()
     else:
         # line1 might have column names
         if line1:
             colnames = line1.split()
         else:
             colnames = []
+    # also return the first data line
+    return colnames, skiprows, comments, line2
+
+
+def read_meta_simple(filename, fp, sep=None):
+    fp = io.TextIOWrapper(fp, 'ascii', 'ignore')
+    colnames, _, comments, dataline = _read_header(fp)
+    ncols = len(dataline.split(comments)[0].split())
+    if len(colnames) != ncols:
+        colnames = ['Column %d' % i for i in range(1, ncols+1)]
+    meta = {}
+    meta['filedesc'] = path.basename(filename)
+    return colnames, meta
+
+
+def read_data_simple(filename, fp, sep=None):
+    fp = io.TextIOWrapper(fp, 'ascii', 'ignore')
+    colnames, skiprows, comments, _ = _read_header(fp)
     fp.seek(0, 0)
     arr = loadtxt(fp, ndmin=2, skiprows=skiprows, comments=comments)
     # if number of colnames is not correct, discard them
@@ -85,3 +103,7 @@ def read_data_simple(filename, fp, sep=None):
 
 def read_data(filename, fp):
     return read_data_simple(filename, fp, None)
+
+
+def read_meta(filename, fp):
+    return read_meta_simple(filename, fp, None)
@@ -8,12 +8,17 @@
 
 """Load routine for simple comma-separated column data files."""
 
-from ufit.data.simple import guess_cols, read_data_simple, check_data_simple
+from ufit.data.simple import guess_cols, read_data_simple, \
+    read_meta_simple, check_data_simple
 
 
 def read_data(filename, fp):
     return read_data_simple(filename, fp, ',')
 
 
+def read_meta(filename, fp):
+    return read_meta_simple(filename, fp, ',')
+
+
 def check_data(fp):
     return check_data_simple(fp, b',')
@@ -17,15 +17,18 @@ def guess_cols(colnames, coldata, meta):
     return meta['def_x'], meta['def_y'], None, meta['preset_channel']
 
 
+# identifies the format for autodetection: (offset, bytes)
+signature = (0, b'# raw_file =')
+
+
 def check_data(fp):
     line = fp.readline()
     fp.seek(0, 0)
     # on the first line is always name of the raw file
-    return line.startswith(b'# raw_file =')
+    return line.startswith(signature[1])
 
 
-def read_data(filename, fp):
-    fp = io.TextIOWrapper(fp, 'ascii', 'ignore')
+def _read_header(fp):
     line1 = ''
     line2 = fp.readline()
     skiprows = 0
@@ -64,7 +67,19 @@ def read_data(filename, fp):
     line1 = line1[1:]
     # if there are comments, line1 will have the comment char
     colnames = line1.split()
+    return colnames, skiprows, meta
+
 
+def read_meta(filename, fp):
+    fp = io.TextIOWrapper(fp, 'ascii', 'ignore')
+    colnames, _, meta = _read_header(fp)
+    meta['environment'] = []
+    return colnames, meta
+
+
+def read_data(filename, fp):
+    fp = io.TextIOWrapper(fp, 'ascii', 'ignore')
+    colnames, skiprows, meta = _read_header(fp)
     fp.seek(0, 0)
     arr = loadtxt(fp, ndmin=2, skiprows=skiprows, comments="#")
     # if number of colnames is not correct, discard them
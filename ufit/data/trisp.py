@@ -15,10 +15,14 @@ from numpy import array, loadtxt, zeros
 from ufit import UFitError
 
 
+# identifies the format for autodetection: (offset, bytes)
+signature = (0, b'pnt  ')
+
+
 def check_data(fp):
     dtline = fp.readline()
     fp.seek(0, 0)
-    return dtline.startswith(b'pnt  ')
+    return dtline.startswith(signature[1])
 
 
 def guess_cols(colnames, coldata, meta):
@@ -42,9 +46,8 @@ def good_ycol(c):
     return c == 'c1'
 
 
-def read_data(filename, fp):
-    fp = io.TextIOWrapper(fp, 'ascii', 'ignore')
-    line = ''
+def _read_info(filename):
+    # the metadata is in a separate .log file
     meta = {}
     infofp = io.open(filename[:-4] + '.log', 'r',
                      encoding='ascii', errors='ignore')
@@ -65,6 +68,29 @@ def read_data(filename, fp):
                 meta[parts[0]] = float(parts[2])
         except ValueError:
             pass
+    return meta
+
+
+def _environment(meta):
+    environment = []
+    if 'TTA' in meta:
+        environment.append('T = %.3f K' % meta['TTA'])
+    return environment
+
+
+def read_meta(filename, fp):
+    fp = io.TextIOWrapper(fp, 'ascii', 'ignore')
+    meta = _read_info(filename)
+    names = fp.readline().split()
+    if names and names[0] == 'pnt':
+        names = names[1:]
+    meta['environment'] = _environment(meta)
+    return names, meta
+
+
+def read_data(filename, fp):
+    fp = io.TextIOWrapper(fp, 'ascii', 'ignore')
+    meta = _read_info(filename)
     names = fp.readline().split()
     pal = 'pal' in names
     # file with polarization analysis?
@@ -77,9 +103,7 @@ def read_data(filename, fp):
     arr = loadtxt(fp, ndmin=2, usecols=usecols)
     for i, n in enumerate(names):
         meta[n] = arr[:, i].mean()
-    meta['environment'] = []
-    if 'TTA' in meta:
-        meta['environment'].append('T = %.3f K' % meta['TTA'])
+    meta['environment'] = _environment(meta)
     if len(arr) == 0:
         raise UFitError('No data found in file %r' % filename)
     if pal:
@@ -9,13 +9,17 @@
 """Data browsing window for the standalone GUI."""
 
 import os
+import time
+import hashlib
 from os import path
+from collections import OrderedDict
 
-from ufit.qt import pyqtSlot, QByteArray, QMainWindow, QApplication, \
-    QListWidgetItem, QVBoxLayout, QFileDialog
+from ufit.qt import pyqtSignal, pyqtSlot, QByteArray, QMainWindow, \
+    QListWidgetItem, QVBoxLayout, QFileDialog, QThread
 
 from ufit.data import Loader
-from ufit.utils import extract_template
+from ufit.utils import attrdict, extract_template
+from ufit.pycompat import cPickle as pickle
 from ufit.gui import logger
 from ufit.gui.common import loadUi, MPLCanvas, MPLToolbar, SettingGroup, \
     path_to_str
@@ -30,7 +34,9 @@ class Unavailable(object):
 
 
 class FormatWrapper(object):
-    """Wraps a dataset for the purposes of format() not raising exceptions."""
+    """Wraps a dataset (or its metadata) for the purposes of format() not
+    raising exceptions.
+    """
 
     def __init__(self, dataset):
         self.__dataset = dataset
@@ -45,6 +51,102 @@ class FormatWrapper(object):
         return getattr(self, attr)
 
 
+# where the directory indexes are kept
+INDEX_DIR = path.expanduser('~/.config/ufit/browse')
+# increase when the layout of the index entries changes
+INDEX_VERSION = 2
+
+# number of fully loaded datasets to keep
+LRU_SIZE = 50
+
+
+def index_filename(root):
+    key = hashlib.sha1(path.abspath(root).encode('utf-8')).hexdigest()
+    return path.join(INDEX_DIR, key + '.index')
+
+
+def load_index(root):
+    """Return the persisted index for *root*, or an empty one."""
+    try:
+        with open(index_filename(root), 'rb') as fp:
+            version, index = pickle.load(fp)
+        if version == INDEX_VERSION:
+            return index
+    except Exception:
+        pass
+    return {}
+
+
+def save_index(root, index):
+    try:
+        if not path.isdir(INDEX_DIR):
+            os.makedirs(INDEX_DIR)
+        fn = index_filename(root)
+        with open(fn + '.tmp', 'wb') as fp:
+            pickle.dump((INDEX_VERSION, index), fp, 2)
+        os.rename(fn + '.tmp', fn)
+    except Exception:
+        pass
+
+
+class IndexWorker(QThread):
+    """Reads the metadata of the files in a directory in the background.
+
+    Entries are ``(signature, template, numor, meta)``; the ones from a
+    previous index are reused if the file's size and mtime are unchanged.
+    Entries are emitted in batches while the directory is scanned.
+    """
+
+    newEntries = pyqtSignal(object)
+    fileFailed = pyqtSignal(object, object)
+
+    def __init__(self, parent, root, files):
+        QThread.__init__(self, parent)
+        self.root = root
+        self.files = files
+        self.index = {}
+        self.stopped = False
+        self.loader = Loader()
+        self.started = time.time()
+
+    def run(self):
+        loader = self.loader
+        self.index = load_index(self.root)
+        index = {}
+        batch = []
+        lastemit = time.time()
+        for fn in self.files:
+            if self.stopped:
+                return
+            fn = path.join(self.root, fn)
+            try:
+                st = os.stat(fn)
+            except OSError:
+                continue
+            if not path.isfile(fn):
+                continue
+            signature = (st.st_size, st.st_mtime)
+            entry = self.index.get(fn)
+            if entry is None or entry[0] != signature:
+                try:
+                    t, n = extract_template(fn)
+                    loader.template = t
+                    entry = (signature, t, n, loader.load_meta(n))
+                except Exception as e:
+                    self.fileFailed.emit(fn, e)
+                    continue
+            index[fn] = entry
+            batch.append(entry)
+            if len(batch) >= 100 or time.time() - lastemit > 0.1:
+                self.newEntries.emit(batch)
+                batch = []
+                lastemit = time.time()
+        if batch:
+            self.newEntries.emit(batch)
+        self.index = index
+        save_index(self.root, index)
+
+
 class BrowseWindow(QMainWindow):
     def __init__(self, parent):
         QMainWindow.__init__(self, parent)
@@ -54,7 +156,11 @@ class BrowseWindow(QMainWindow):
         self.dataloader = parent
         self.rootdir = ''
         self.loader = Loader()
-        self._data = {}
+        # numor -> (template, metadata) for all files in the directory
+        self._index = {}
+        # numor -> dataset for recently viewed files
+        self._data = OrderedDict()
+        self._worker = None
         self.yaxis = None
         self.canvas = MPLCanvas(self)
         self.canvas.plotter.lines = True
@@ -76,9 +182,43 @@ class BrowseWindow(QMainWindow):
             self.splitter.restoreState(splitstate)
             self.monScaleEdit.setText(settings.value('fixedmonval'))
 
+    def _get_data(self, n):
+        """Return the dataset for numor *n*, loading it if necessary."""
+        if n in self._data:
+            self._data[n] = self._data.pop(n)
+            return self._data[n]
+        self.loader.template = self._index[n][0]
+        fixed_yaxis = self.yAxisEdit.text()
+        yaxis = fixed_yaxis if (fixed_yaxis and self.useYAxis.isChecked()) \
+            else 'auto'
+        res = self.loader.load(n, 'auto', yaxis, 'auto', 'auto', -1)
+        if self.useMonScale.isChecked():
+            const = int(self.monScaleEdit.text())  # XXX check
+            res.rescale(const)
+        self._data[n] = res
+        while len(self._data) > LRU_SIZE:
+            self._data.popitem(last=False)
+        return res
+
+    def _get_selected(self):
+        datas = []
+        for item in self.dataList.selectedItems():
+            try:
+                data = self._get_data(item.type())
+            except Exception as e:
+                self.logger.warning('While loading %r: %s' %
+                                    (self._index[item.type()][1].get(
+                                        'datafilename'), e))
+                continue
+            datas.append(data)
+            # now that the whole dataset is known, update the label
+            item.setText(self._label(item.type(), data, data.xcol,
+                                     data.title, data.environment))
+        return datas
+
     @pyqtSlot()
     def on_loadBtn_clicked(self):
-        datas = [self._data[item.type()] for item in self.dataList.selectedItems()]
+        datas = self._get_selected()
         if not datas:
             return
         items = [ScanDataItem(data) for data in datas]
@@ -86,7 +226,7 @@ class BrowseWindow(QMainWindow):
 
     @pyqtSlot()
     def on_addNumBtn_clicked(self):
-        numors = [self._data[item.type()].meta['filenumber']
+        numors = [self._index[item.type()][1]['filenumber']
                   for item in self.dataList.selectedItems()]
         if not numors:
             return
@@ -111,60 +251,77 @@ class BrowseWindow(QMainWindow):
         self.set_directory(self.rootdir)
 
     def set_directory(self, root):
+        self.stop_indexing()
         self.setWindowTitle('ufit browser - %s' % root)
-        self.canvas.axes.text(0.5, 0.5, 'Please wait, loading all data...',
-                              horizontalalignment='center')
-        self.canvas.draw()
-        QApplication.processEvents()
         self.rootdir = root
-        files = os.listdir(root)
+        files = sorted(os.listdir(root))
         self.dataList.clear()
-        for fn in sorted(files):
-            fn = path.join(root, fn)
-            if not path.isfile(fn):
-                continue
-            try:
-                t, n = extract_template(fn)
-                self.loader.template = t
-                fixed_yaxis = self.yAxisEdit.text()
-                yaxis = fixed_yaxis if (fixed_yaxis and self.useYAxis.isChecked()) else 'auto'
-                res = self.loader.load(n, 'auto', yaxis, 'auto', 'auto', -1)
-            except Exception as e:
-                self.logger.warning('While loading %r: %s' % (fn, e))
-            else:
-                if self.useMonScale.isChecked():
-                    const = int(self.monScaleEdit.text())  # XXX check
-                    res.rescale(const)
-                if self.useFmtString.isChecked():
-                    try:
-                        scanLabel = self.fmtStringEdit.text().format(
-                            n, FormatWrapper(res))
-                    except Exception:
-                        scanLabel = '%s (%s) - %s | %s' % (
-                            n, res.xcol, res.title, ', '.join(res.environment))
-                else:
-                    scanLabel = '%s (%s) - %s | %s' % (
-                        n, res.xcol, res.title, ', '.join(res.environment))
-                self._data[n] = res
-                QListWidgetItem(scanLabel, self.dataList, n)
+        self._index.clear()
+        self._data.clear()
         self.canvas.axes.clear()
         self.canvas.draw()
+        self._worker = IndexWorker(self, root, files)
+        self._worker.newEntries.connect(self.on_worker_newEntries)
+        self._worker.fileFailed.connect(self.on_worker_fileFailed)
+        self._worker.finished.connect(self.on_worker_finished)
+        self._worker.start()
+
+    def stop_indexing(self):
+        if self._worker is not None:
+            self._worker.stopped = True
+            self._worker.wait()
+            self._worker = None
+
+    def on_worker_finished(self):
+        worker = self.sender()
+        stats = worker.loader.detector.stats()
+        self.logger.debug('indexed %d files in %.3f s; format detection: '
+                          '%d files, %d probes, %.3f s' %
+                          (len(worker.index), time.time() - worker.started,
+                           stats['files'], stats['probes'], stats['time']))
+
+    def on_worker_fileFailed(self, fn, err):
+        self.logger.warning('While loading %r: %s' % (fn, err))
+
+    def _label(self, n, obj, xcol, title, environment):
+        scanLabel = '%s (%s) - %s | %s' % (n, xcol, title,
+                                           ', '.join(environment))
+        if self.useFmtString.isChecked():
+            try:
+                scanLabel = self.fmtStringEdit.text().format(
+                    n, FormatWrapper(obj))
+            except Exception:
+                pass
+        return scanLabel
+
+    def on_worker_newEntries(self, entries):
+        if self.sender() is not self._worker:
+            return
+        for (_, template, n, meta) in entries:
+            # until the file is loaded, format strings only get the metadata
+            # from the file header (see Loader.load_meta)
+            scanLabel = self._label(n, attrdict(meta), meta['xcol'],
+                                    meta.get('title', ''),
+                                    meta.get('environment', []))
+            self._index[n] = (template, meta)
+            QListWidgetItem(scanLabel, self.dataList, n)
 
     def on_dataList_itemSelectionChanged(self):
-        numors = [item.type() for item in self.dataList.selectedItems()]
-        if not numors:
+        datas = self._get_selected()
+        if not datas:
             return
         plotter = self.canvas.plotter
         plotter.reset(False)
-        if len(numors) > 1:
-            for numor in numors:
-                plotter.plot_data(self._data[numor], multi=True)
+        if len(datas) > 1:
+            for data in datas:
+                plotter.plot_data(data, multi=True)
             plotter.plot_finish()
         else:
-            plotter.plot_data(self._data[numors[0]])
+            plotter.plot_data(datas[0])
         plotter.draw()
 
     def closeEvent(self, event):
+        self.stop_indexing()
         event.accept()
         with self.sgroup as settings:
             settings.setValue('geometry', self.saveGeometry())
@@ -233,11 +233,14 @@ into one set, as well as files 23 and 24.
         numors = str(self.numorsEdit.text())
         try:
             datas = self.loader.load_numors(
-                numors, prec, xcol, ycol, dycol, mcol, mscale, floatmerge, filter)
+                numors, prec, xcol, ycol, dycol, mcol, mscale, floatmerge, filter,
+                skip_failed=True)
         except Exception as e:
             self.logger.exception('Error while loading data file')
             QMessageBox.information(self, 'Error', str(e))
             return
+        for _, msg in self.loader.failures:
+            self.logger.warning(msg)
         self.last_data = datas
         if final:
             self.newDatas.emit(datas, self.groupBox.currentText())
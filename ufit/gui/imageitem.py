@@ -8,16 +8,13 @@
 
 """Session item for datasets and corresponding GUI."""
 
-import operator
-from functools import reduce
-
-from numpy import sqrt, array, arange
+from numpy import array, arange, s_
 
 from ufit.qt import pyqtSlot, QMessageBox, QTabWidget, QWidget
 
 from matplotlib.patches import Rectangle
 
-from ufit.data.dataset import ScanData
+from ufit.data.dataset import ScanData, ImageStack
 from ufit.gui import logger
 from ufit.gui.dataops import DataOps
 from ufit.gui.session import session, SessionItem
@@ -152,7 +149,7 @@ class ImageMultiPanel(QWidget):
         canvas = canvas or self.canvas
         # XXX better title
         canvas.plotter.reset(ImageDataPanel.image_limits)
-        sumdata = reduce(operator.add, self.datas[1:], self.datas[0])
+        sumdata = ImageStack(self.datas).sum()
         canvas.plotter.plot_image(sumdata)
         canvas.plotter.plot_finish(title='sum over %d images' % len(self.datas))
         for box in self.boxes:
@@ -205,14 +202,13 @@ class ImageMultiPanel(QWidget):
         else:
             xdata = array([data.meta[xname] for data in self.datas])
         boxnorm = self.boxNormBox.isChecked()
+        stack = ImageStack(self.datas)
         for box in self.boxes:
             x1, y1, x2, y2 = box.x1Box.value(), box.y1Box.value(), \
                 box.x2Box.value(), box.y2Box.value()
             name = box.nameBox.text()
-            ydata = array([data.arr[x1:x2, y1:y2].sum()
-                           for data in self.datas])
-            dydata = array([sqrt((data.darr[x1:x2, y1:y2]**2).sum())
-                            for data in self.datas])
+            # only reads the pixels in the box from each image
+            ydata, dydata = stack.integrate(s_[x1:x2, y1:y2])
             yname = 'box counts'
             if boxnorm:
                 factor = 1. / ((y2 - y1) * (x2 - x1))
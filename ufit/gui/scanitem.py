@@ -13,8 +13,10 @@ from os import path
 from numpy import savetxt, array, linspace, sqrt, mean
 
 from ufit.qt import pyqtSignal, pyqtSlot, QTabWidget, QWidget, QDialog, \
-    QMessageBox
+    QMessageBox, QCheckBox, QHBoxLayout, QTimer
 
+from ufit import UFitError
+from ufit.data.follow import Follower
 from ufit.data.merge import rebin
 from ufit.param import prepare_params
 from ufit.models import eval_model
@@ -29,6 +31,10 @@ from ufit.gui.dialogs import ParamSetDialog
 from ufit.pycompat import from_encoding
 
 
+# milliseconds between checks for new points when following a data file
+FOLLOW_INTERVAL = 1000
+
+
 def default_model(data):
     ymin = data.y.min()
     ymaxidx = data.y.argmax()
@@ -153,6 +159,66 @@ class ScanDataPanel(QTabWidget):
         self.addTab(self.mbuilder, 'Modeling')
         self.addTab(self.fitter, 'Fitting')
         self.setCurrentWidget(self.mbuilder)
+        self.createFollowUI()
+
+    def createFollowUI(self):
+        # following a data file that is still being written
+        self.follower = None
+        self.followTimer = QTimer(self)
+        self.followTimer.setInterval(FOLLOW_INTERVAL)
+        self.followTimer.timeout.connect(self.on_followTimer_timeout)
+        widget = QWidget(self)
+        layout = QHBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.followBox = QCheckBox('Follow file', widget)
+        self.followBox.setToolTip('Add new points from the data file while '
+                                  'it is being written')
+        self.followBox.toggled.connect(self.on_followBox_toggled)
+        self.refitBox = QCheckBox('Refit', widget)
+        self.refitBox.setToolTip('Fit again when new points are added')
+        self.refitBox.setEnabled(False)
+        layout.addWidget(self.followBox)
+        layout.addWidget(self.refitBox)
+        widget.setLayout(layout)
+        self.setCornerWidget(widget)
+
+    def on_followBox_toggled(self, on):
+        self.followTimer.stop()
+        self.follower = None
+        self.refitBox.setEnabled(on)
+        if not on:
+            return
+        try:
+            self.follower = Follower(self.item.data)
+        except (UFitError, IOError, OSError) as err:
+            QMessageBox.warning(self, 'Error', 'Cannot follow data file: '
+                                '%s' % err)
+            self.followBox.setChecked(False)
+            return
+        self.followTimer.start()
+
+    def on_followTimer_timeout(self):
+        try:
+            added = self.follower.poll()
+        except Exception:
+            logger.exception('Error while following data file')
+            self.followBox.setChecked(False)
+            return
+        if not added:
+            return
+        session.set_dirty()
+        if self.refitBox.isChecked():
+            # starts from the current parameter values; the fitter's replot
+            # would keep the old limits
+            self.fitter.blockSignals(True)
+            try:
+                self.fitter.do_fit()
+            except Exception:
+                logger.exception('Error while refitting')
+            finally:
+                self.fitter.blockSignals(False)
+        # the new points can be outside the old limits
+        self.plot(limits=False)
 
     def on_mbuilder_newModel(self, model, update_modeldef=False,
                              switch_fitter=True):
@@ -9,19 +9,21 @@
 """ufit base models."""
 
 import re
-import inspect
 import operator
 from functools import reduce
 
-from numpy import concatenate
+from numpy import allclose, concatenate, ndarray, result_type, shape
 
 from ufit import param, backends, UFitError, Param, Dataset
 from ufit.result import Result, MultiResult
 from ufit.utils import get_chisqr, cached_property
 from ufit.plotting import DataPlotter
-from ufit.pycompat import exec_, iteritems, cPickle as pickle, number_types
+from ufit.models.exprcomp import ExprError, compile_expr
+from ufit.pycompat import exec_, iteritems, cPickle as pickle, number_types, \
+    getargspec
 
-__all__ = ['Model', 'CombinedModel', 'Function', 'Custom', 'eval_model']
+__all__ = ['Model', 'CombinedModel', 'SumModel', 'ProductModel', 'Function',
+           'Custom', 'eval_model']
 
 
 data_re = re.compile(r'\bdata\b')
@@ -129,11 +131,11 @@ class Model(object):
             other = Constant(other)
         elif not isinstance(other, Model):
             return NotImplemented
-        return CombinedModel(self, other, '+')
+        return SumModel(self, other)
 
     def __radd__(self, other):
         if isinstance(other, number_types):
-            return CombinedModel(Constant(other), self, '+')
+            return SumModel(Constant(other), self)
         return NotImplemented
 
     def __sub__(self, other):
@@ -153,11 +155,11 @@ class Model(object):
             other = Constant(other)
         elif not isinstance(other, Model):
             return NotImplemented
-        return CombinedModel(self, other, '*')
+        return ProductModel(self, other)
 
     def __rmul__(self, other):
         if isinstance(other, number_types):
-            return CombinedModel(Constant(other), self, '*')
+            return ProductModel(Constant(other), self)
         return NotImplemented
 
     def __div__(self, other):
@@ -355,21 +357,20 @@ class CombinedModel(Model):
         if self._components is not None:
             return self._components
         if self._opstr in ('+', '*'):
-            modifiers = []
-            components = []
+            operands = []
             first = self
             while isinstance(first, CombinedModel) and \
                     first._opstr == self._opstr:
-                second = first._b
-                first = first._a
-                if second.is_modifier():
-                    modifiers.append(second)
+                if isinstance(first, NaryModel):
+                    # same (reversed) order as for a chain of CombinedModels
+                    operands.extend(first._models[:0:-1])
+                    first = first._models[0]
                 else:
-                    components.append(second)
-            if first.is_modifier():
-                modifiers.append(first)
-            else:
-                components.append(first)
+                    operands.append(first._b)
+                    first = first._a
+            operands.append(first)
+            modifiers = [m for m in operands if m.is_modifier()]
+            components = [m for m in operands if not m.is_modifier()]
             ret = sum((c.get_components() for c in components), [])
             if modifiers:
                 all_mods = reduce(lambda a, b: CombinedModel(a, b, self._opstr),
@@ -402,7 +403,9 @@ class CombinedModel(Model):
             s += self._a.get_description()
         s += ' ' + self._opstr + ' '
         if isinstance(self._b, CombinedModel) and \
-                self.op_prio[self._b._opstr] < self.op_prio[self._opstr]:
+                (self.op_prio[self._b._opstr] < self.op_prio[self._opstr] or
+                 self.op_prio[self._b._opstr] == self.op_prio[self._opstr]
+                 and self._opstr in ('-', '/')):
             s += '(%s)' % self._b.get_description()
         else:
             s += self._b.get_description()
@@ -420,6 +423,130 @@ class CombinedModel(Model):
         return d
 
 
+class NaryModel(CombinedModel):
+    """Base class for a flat sum or product of any number of sub-models.
+
+    Combining a NaryModel with another model using the same operator extends
+    the flat list of operands instead of nesting another level, so that
+    models with many components are evaluated in one loop.
+    """
+
+    _opstr = None
+    _iop = None
+
+    def __init__(self, *models):
+        self.params = []
+        self._models = []
+        for m in models:
+            if m.__class__ is self.__class__ and not m.python_code:
+                self._models.extend(m._models)
+            else:
+                self._models.append(m)
+        self._op = op = self.op_fcn[self._opstr]
+        self.name = self._opstr.join(m.name for m in self._models if m.name)
+        self._combine_params(*self._models)
+
+        fcns = [m.fcn for m in self._models]
+        iop = self._iop
+
+        def fcn(p, x):
+            result = fcns[0](p, x)
+            owned = False
+            for f in fcns[1:]:
+                value = f(p, x)
+                # accumulate in place once we have an array of our own
+                # that already has the final shape and dtype
+                if owned and shape(value) in ((), result.shape) and \
+                   result_type(result, value) == result.dtype:
+                    iop(result, value)
+                else:
+                    result = op(result, value)
+                    owned = isinstance(result, ndarray)
+            return result
+        self.fcn = fcn
+
+        # cache this!
+        self._components = None
+
+    def _combine_params(self, *models):
+        seen = set()
+        for m in models:
+            for p in m.params:
+                if p.name in seen:
+                    raise UFitError('Parameter name clash: %s - give all model '
+                                    'classes a name to avoid this' % p.name)
+                seen.add(p.name)
+                self.params.append(p)
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__,
+                            (' %s ' % self._opstr).join(map(repr,
+                                                            self._models)))
+
+    def __reduce__(self):
+        """Pickling support: reconstruct the object from a constructor call."""
+        if self.python_code:
+            return (eval_model, (self.python_code, self.params))
+        return (self.__class__, tuple(self._models))
+
+    def get_components(self):
+        if self._components is not None:
+            return self._components
+        modifiers = [m for m in self._models if m.is_modifier()]
+        ret = []
+        for m in self._models:
+            if not m.is_modifier():
+                ret.extend(m.get_components())
+        if modifiers:
+            if len(modifiers) == 1:
+                all_mods = modifiers[0]
+            else:
+                all_mods = self.__class__(*modifiers)
+            ret = [CombinedModel(all_mods, c, self._opstr) for c in ret]
+        self._components = ret
+        return ret
+
+    def get_description(self):
+        if self.python_code:
+            return self.python_code
+        prio = self.op_prio[self._opstr]
+        parts = []
+        for m in self._models:
+            if isinstance(m, CombinedModel) and \
+                    self.op_prio[m._opstr] < prio:
+                parts.append('(%s)' % m.get_description())
+            else:
+                parts.append(m.get_description())
+        return (' %s ' % self._opstr).join(parts)
+
+    def get_pick_points(self):
+        """Get a list of point names that should be picked for initial guess."""
+        return sum((m.get_pick_points() for m in self._models), [])
+
+    def convert_pick(self, *args):
+        """Convert pick point coordinates (x,y) to parameter initial guesses."""
+        d = {}
+        for m in self._models:
+            npp = len(m.get_pick_points())
+            d.update(m.convert_pick(*args[:npp]))
+            args = args[npp:]
+        return d
+
+
+class SumModel(NaryModel):
+    """Models the sum of any number of sub-models, created by ``+``."""
+
+    _opstr = '+'
+    _iop = operator.iadd
+
+
+class ProductModel(NaryModel):
+    """Models the product of any number of sub-models, created by ``*``."""
+
+    _opstr = '*'
+    _iop = operator.imul
+
+
 class Constant(Model):
     """Constant function - no parameters.
 
@@ -453,7 +580,7 @@ class Function(Model):
                 name = fcn.__name__
             else:
                 name = ''
-        pvs = self._init_params(name, inspect.getargspec(fcn)[0][1:], init)
+        pvs = self._init_params(name, getargspec(fcn)[0][1:], init)
 
         self.fcn = lambda p, x: \
             self._real_fcn(x, *(p[pv] for pv in pvs))
@@ -477,7 +604,37 @@ class Custom(Model):
         %s
         return %s
         ''' % ('\n        '.join(param_assign), expr), namespace)
-        self.fcn = namespace['_fcn']
+        plain_fcn = namespace['_fcn']
+        try:
+            body = compile_expr(expr, params, namespace)
+        except ExprError:
+            self.fcn = plain_fcn
+            return
+        exec_('''def _ofcn(p, x):
+        %s
+        ''' % '\n        '.join(param_assign + body), namespace)
+        # the optimized function is checked against the plain one on first
+        # use, and abandoned if it fails or disagrees
+        state = [namespace['_ofcn'], False]
+
+        def fcn(p, x):
+            opt_fcn, checked = state
+            if opt_fcn is None:
+                return plain_fcn(p, x)
+            try:
+                result = opt_fcn(p, x)
+            except Exception:
+                state[0] = None
+                return plain_fcn(p, x)
+            if not checked:
+                expected = plain_fcn(p, x)
+                if shape(result) != shape(expected) or not allclose(
+                        result, expected, rtol=1e-10, atol=0, equal_nan=True):
+                    state[0] = None
+                    return expected
+                state[1] = True
+            return result
+        self.fcn = fcn
 
     def get_description(self):
         return 'Custom(%r, %r, %r)' % (self.name, self._params, self._expr)
@@ -9,26 +9,57 @@
 """Convolution models."""
 
 import re
+import hashlib
+from collections import OrderedDict
 
-from numpy import convolve, exp, log, linspace
+from numpy import exp, log, arange, asarray, unique, diff, median, ceil, \
+    floor, zeros, sqrt, interp, searchsorted, repeat, cumsum, bincount
+from numpy.fft import rfft, irfft
+from scipy.sparse import csr_matrix
 
+from ufit import UFitError
 from ufit.param import Param
 from ufit.models.base import Model
 
-__all__ = ['GaussianConvolution']
+__all__ = ['GaussianConvolution', 'KernelConvolution']
 
 
 id_re = re.compile('[a-zA-Z][a-zA-Z0-9_]*$')
 
 
+def _next_pow2(n):
+    return 1 << int(n - 1).bit_length()
+
+
+def _interp_uniform(x, x0, step, y):
+    """Cubic (4-point Lagrange) interpolation of values *y* given on the
+    uniform grid x0 + i*step, at points x that are at least one step away
+    from the ends of the grid.
+    """
+    pos = (x - x0) / step
+    i = floor(pos).astype(int)
+    t = pos - i
+    return (-t*(t - 1)*(t - 2)/6 * y[i - 1] + (t + 1)*(t - 1)*(t - 2)/2 * y[i] -
+            (t + 1)*t*(t - 2)/2 * y[i + 1] + (t + 1)*t*(t - 1)/6 * y[i + 2])
+
+
 class GaussianConvolution(Model):
     """Models a 1-D convolution with a Gaussian kernel.
 
+    The submodel is evaluated on a uniform grid (with *oversample* points per
+    median spacing of the x values, and at least four points per FWHM), which
+    extends beyond the data by three times the FWHM.  The convolution is done
+    by FFT and the result is interpolated back (cubic) to the x values, which
+    therefore need not be uniformly spaced.
+
     Parameters:
 
     * `width` - FWHM of Gaussian kernel
     """
 
+    oversample = 2
+    maxpoints = 1 << 18
+
     def __init__(self, model, width=1, name=None):
         self._model = model
         if name is not None:
@@ -40,17 +71,167 @@ class GaussianConvolution(Model):
         self.params = model.params[:]
         pname = self.name + '_width'
         self.params.append(Param.from_init(pname, width))
+        self._grid = (None, None)
+        self._kernels = {}
 
         def convfcn(p, x):
-            data = model.fcn(p, x)
-            # construct Gaussian filter
-            N = len(x)   # number of data points
-            M = 2*N - 1  # number of filter points
-            # "valid" convolution mode now returns M - N + 1 == N points
-            binwidth = (x.max() - x.min()) / len(x)
-            filtx = linspace(-N*binwidth, N*binwidth, M)
-            filt = exp(-filtx**2 / p[pname]**2 * 4*log(2))
-            # normalize filter
-            filt /= filt.sum()
-            return convolve(data, filt, mode='valid')
+            width = abs(p[pname])
+            grid = self._get_grid(x, width)
+            if grid is None:
+                return model.fcn(p, x)
+            data = model.fcn(p, grid)
+            conv = irfft(rfft(data, len(self._kernels[width])*2 - 2) *
+                         self._kernels[width])
+            return _interp_uniform(asarray(x, dtype=float), grid[0],
+                                   grid[1] - grid[0], conv)
         self.fcn = convfcn
+
+    def _get_grid(self, x, width):
+        """Return the uniform grid for evaluating the submodel for the given
+        x values, and make sure the FFT of the kernel is cached.
+
+        Grid and kernels are kept as long as x and the grid spacing stay the
+        same; the padding only changes in powers of two.
+        """
+        x = asarray(x, dtype=float)
+        key = hashlib.sha1(x.tobytes()).hexdigest()
+        if self._grid[0] is None or self._grid[0][0] != key:
+            xs = unique(x)
+            if len(xs) < 2:
+                return None
+            self._grid = (key, median(diff(xs)) / self.oversample,
+                          xs[0], xs[-1]), None
+            self._kernels = {}
+        (_, step, xmin, xmax), grid = self._grid
+        if width < 4 * step:
+            if width == 0:
+                return None
+            step = width / 4.
+        # number of points in the kernel on either side of the center
+        nkernel = int(ceil(3 * width / step))
+        npad = _next_pow2(nkernel)
+        nfft = _next_pow2(int(ceil((xmax - xmin) / step)) + 1 + 2*npad +
+                          nkernel)
+        while nfft > self.maxpoints:
+            step *= 2
+            nkernel = int(ceil(3 * width / step))
+            npad = _next_pow2(nkernel)
+            nfft = _next_pow2(int(ceil((xmax - xmin) / step)) + 1 + 2*npad +
+                              nkernel)
+        if grid is None or grid[0] != step or grid[1] != npad:
+            points = arange(-npad, int(ceil((xmax - xmin) / step)) + 1 + npad)
+            grid = (step, npad, xmin + step * points)
+            self._grid = self._grid[0], grid
+            self._kernels = {}
+        if width not in self._kernels:
+            # kernel with its center at index 0, for circular convolution
+            offsets = arange(-nkernel, nkernel + 1) * step
+            kernel = exp(-offsets**2 / width**2 * 4*log(2))
+            wrapped = zeros(nfft)
+            wrapped[:nkernel + 1] = kernel[nkernel:]
+            wrapped[nfft - nkernel:] = kernel[:nkernel]
+            if len(self._kernels) > 16:
+                self._kernels.clear()
+            self._kernels[width] = rfft(wrapped / kernel.sum())
+        return grid[2]
+
+
+class KernelConvolution(Model):
+    """Models a 1-D convolution with a Gaussian resolution whose width is
+    known for each point, but is not a fit parameter.
+
+    *fwhm* can be a number, a function returning the FWHM for an array of x
+    values, or a tuple (xref, fwhmref) of arrays that is interpolated, e.g.
+    ``(data.x, data.col_res)``; see also `from_column`.
+
+    For each set of x values, the submodel is evaluated on a uniform grid
+    with *oversample* points per smallest standard deviation, and a sparse
+    matrix containing the normalized kernels up to *nsigma* standard
+    deviations is built and cached.  Evaluating the model is then one sparse
+    matrix-vector product.
+    """
+
+    oversample = 2
+    maxpoints = 1 << 20
+    maxcache = 8
+
+    def __init__(self, model, fwhm, name=None, nsigma=4):
+        self._model = model
+        if name is not None:
+            self.name = name
+        elif model.name and id_re.match(model.name):
+            self.name = '%s_conv' % model.name
+        else:
+            self.name = 'conv'
+        self.params = model.params[:]
+        self._fwhm = fwhm
+        self._nsigma = nsigma
+        self._kernels = OrderedDict()
+
+        def convfcn(p, x):
+            matrix, grid = self._get_kernel(x)
+            return matrix.dot(model.fcn(p, grid))
+        self.fcn = convfcn
+
+    @classmethod
+    def from_column(cls, model, data, column, **kwds):
+        """Create a convolution using the FWHM values from the given column of
+        the dataset.
+        """
+        return cls(model, (data.x, data['col_' + column]), **kwds)
+
+    def get_description(self):
+        if self.python_code:
+            return self.python_code
+        if callable(self._fwhm):
+            fwhm = getattr(self._fwhm, '__name__', repr(self._fwhm))
+        elif isinstance(self._fwhm, tuple):
+            fwhm = '(%s)' % ', '.join('numpy.array(%r)' % asarray(v).tolist()
+                                      for v in self._fwhm)
+        else:
+            fwhm = repr(self._fwhm)
+        return '%s(%s, %s, name=%r, nsigma=%r)' % (
+            self.__class__.__name__, self._model.get_description(), fwhm,
+            self.name, self._nsigma)
+
+    def __reduce__(self):
+        if self.python_code:
+            return Model.__reduce__(self)
+        return (self.__class__, (self._model, self._fwhm, self.name,
+                                 self._nsigma))
+
+    def _get_fwhm(self, x):
+        if callable(self._fwhm):
+            return asarray(self._fwhm(x), dtype=float) + 0*x
+        elif isinstance(self._fwhm, tuple):
+            xref, fwhmref = asarray(self._fwhm[0]), asarray(self._fwhm[1])
+            order = xref.argsort()
+            return interp(x, xref[order], fwhmref[order])
+        return self._fwhm + 0*x
+
+    def _get_kernel(self, x):
+        x = asarray(x, dtype=float)
+        key = hashlib.sha1(x.tobytes()).hexdigest()
+        if key in self._kernels:
+            return self._kernels[key]
+        sigma = self._get_fwhm(x) / (2*sqrt(2*log(2)))
+        if (sigma <= 0).any():
+            raise UFitError('resolution width must be positive for all points')
+        lo = (x - self._nsigma*sigma).min()
+        hi = (x + self._nsigma*sigma).max()
+        step = sigma.min() / self.oversample
+        step = max(step, (hi - lo) / self.maxpoints)
+        grid = lo + step * arange(int(ceil((hi - lo) / step)) + 1)
+        # all (row, column) pairs within the kernel ranges
+        start = searchsorted(grid, x - self._nsigma*sigma)
+        counts = searchsorted(grid, x + self._nsigma*sigma, 'right') - start
+        rows = repeat(arange(len(x)), counts)
+        cols = arange(counts.sum()) - repeat(cumsum(counts) - counts, counts) + \
+            start[rows]
+        values = exp(-(grid[cols] - x[rows])**2 / (2*sigma[rows]**2))
+        values /= bincount(rows, values, len(x))[rows]
+        result = csr_matrix((values, (rows, cols)), shape=(len(x), len(grid))), grid
+        self._kernels[key] = result
+        if len(self._kernels) > self.maxcache:
+            self._kernels.popitem(last=False)
+        return result
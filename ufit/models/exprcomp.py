@@ -0,0 +1,299 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# ufit, a universal scattering fitting suite
+#
+# Copyright (c) 2013-2019, Georg Brandl and contributors.  All rights reserved.
+# Licensed under a 2-clause BSD license, see LICENSE.
+# *****************************************************************************
+
+"""Optimizing compiler for the expressions of Custom models.
+
+The expression is translated into a sequence of single-operation
+assignments.  On the way,
+
+* products and sums are reassociated so that all factors/terms that only
+  depend on parameters are combined before touching an array,
+* repeated subexpressions are computed only once, and
+* operations on array temporaries that are not needed anymore are done in
+  place, reusing their buffers, as long as that gives the same result
+  (see `_inplace`).
+
+Expressions using constructs not handled here raise `ExprError`, and the
+caller falls back to evaluating the expression as written.
+"""
+
+import ast
+import operator
+
+import numpy as np
+
+from ufit import UFitError
+
+__all__ = ['ExprError', 'compile_expr']
+
+
+class ExprError(UFitError):
+    pass
+
+
+BINOPS = {
+    ast.Add: '+',
+    ast.Sub: '-',
+    ast.Mult: '*',
+    ast.Div: '/',
+    ast.Pow: '**',
+    ast.Mod: '%',
+    ast.FloorDiv: '//',
+}
+
+UNARYOPS = {
+    ast.USub: '-',
+    ast.UAdd: '+',
+}
+
+# operators that can be applied in place to the left (or, when commutative,
+# the right) operand
+INPLACE = {'+': True, '-': False, '*': True, '/': False, '**': False}
+
+# (in-place, normal) functions for the operators
+OPERATORS = {
+    '+': (operator.iadd, operator.add),
+    '-': (operator.isub, operator.sub),
+    '*': (operator.imul, operator.mul),
+    '/': (operator.itruediv, operator.truediv),
+    '**': (operator.ipow, operator.pow),
+    'neg': (lambda arr: np.negative(arr, out=arr), operator.neg),
+}
+
+
+def _keeps_result(arr, args):
+    # true if the operation on arr and args can be done in arr: not for
+    # integer arrays (e.g. from int x values), upcasting operands, or
+    # operands that broadcast arr to a larger shape
+    if type(arr) is not np.ndarray or arr.dtype.kind not in 'fc':
+        return False
+    for arg in args:
+        if type(arg) in (float, int):
+            # Python numbers don't upcast floating point arrays
+            continue
+        if getattr(arg, 'shape', None) not in ((), arr.shape):
+            return False
+        if getattr(arg, 'dtype', None) != arr.dtype and \
+                np.result_type(arr, arg) != arr.dtype:
+            return False
+    return True
+
+
+def _inplace(op, arr, *args):
+    # apply the operator (or ufunc) in place if that gives the same result
+    if op in OPERATORS:
+        if _keeps_result(arr, args):
+            return OPERATORS[op][0](arr, *args)
+        return OPERATORS[op][1](arr, *args)
+    if _keeps_result(arr, args):
+        return op(arr, *args, out=arr)
+    return op(arr, *args)
+
+
+# the intermediate representation is made of tuples:
+# ('name', id), ('const', value), ('bin', op, a, b), ('un', op, a),
+# ('call', funcname, args)
+
+
+def _to_ir(node):
+    if isinstance(node, ast.Expression):
+        return _to_ir(node.body)
+    if isinstance(node, ast.BinOp) and type(node.op) in BINOPS:
+        return ('bin', BINOPS[type(node.op)], _to_ir(node.left),
+                _to_ir(node.right))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in UNARYOPS:
+        return ('un', UNARYOPS[type(node.op)], _to_ir(node.operand))
+    if isinstance(node, ast.Name):
+        return ('name', node.id)
+    # constants are kept as their repr, so that 2 and 2.0 stay distinct
+    if isinstance(node, getattr(ast, 'Constant', ())) and \
+            isinstance(node.value, (int, float, complex)) and \
+            not isinstance(node.value, bool):
+        return ('const', repr(node.value))
+    if isinstance(node, getattr(ast, 'Num', ())):
+        return ('const', repr(node.n))
+    if isinstance(node, ast.Call) and not node.keywords and \
+            not getattr(node, 'starargs', None) and \
+            not getattr(node, 'kwargs', None) and \
+            not any(isinstance(a, getattr(ast, 'Starred', ()))
+                    for a in node.args):
+        return ('call', _dotted_name(node.func),
+                tuple(_to_ir(arg) for arg in node.args))
+    raise ExprError('cannot optimize %s node' % node.__class__.__name__)
+
+
+def _dotted_name(node):
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        return _dotted_name(node.value) + '.' + node.attr
+    raise ExprError('cannot optimize call of %s' % node.__class__.__name__)
+
+
+class _Compiler(object):
+
+    def __init__(self, params, namespace):
+        self.params = set(params)
+        self.namespace = namespace
+        self.stmts = []      # (target, op, operands, is_array, owned)
+        self.cse = {}        # IR node -> temporary name
+        self.arrays = set()  # temporaries holding arrays
+
+    def is_scalar(self, ir):
+        """Return true if *ir* only depends on parameters and constants."""
+        kind = ir[0]
+        if kind == 'const':
+            return True
+        if kind == 'name':
+            return ir[1] in self.params or (
+                ir[1] in self.namespace and
+                isinstance(self.namespace[ir[1]], (int, float)))
+        if kind == 'bin':
+            return self.is_scalar(ir[2]) and self.is_scalar(ir[3])
+        if kind == 'un':
+            return self.is_scalar(ir[2])
+        return all(self.is_scalar(arg) for arg in ir[2])
+
+    def reassociate(self, ir):
+        """Combine scalar factors of products and terms of sums."""
+        kind = ir[0]
+        if kind == 'un':
+            return ('un', ir[1], self.reassociate(ir[2]))
+        if kind == 'call':
+            return ('call', ir[1], tuple(map(self.reassociate, ir[2])))
+        if kind != 'bin':
+            return ir
+        if ir[1] in '*/' and len(ir[1]) == 1:
+            return self._reassoc_chain(ir, '*', '/')
+        if ir[1] in '+-' and len(ir[1]) == 1:
+            return self._reassoc_chain(ir, '+', '-')
+        return ('bin', ir[1], self.reassociate(ir[2]),
+                self.reassociate(ir[3]))
+
+    def _reassoc_chain(self, ir, op, invop):
+        # flatten a left-deep chain like a*b/c*d into [(a, False),
+        # (b, False), (c, True), (d, False)]
+        items = []
+        while ir[0] == 'bin' and ir[1] in (op, invop):
+            items.append((self.reassociate(ir[3]), ir[1] == invop))
+            ir = ir[2]
+        items.append((self.reassociate(ir), False))
+        items.reverse()
+        scalars = [item for item in items if self.is_scalar(item[0])]
+        arrays = [item for item in items if not self.is_scalar(item[0])]
+        if len(scalars) < 2 or not arrays or arrays[0][1]:
+            # nothing to gain, or would need to invert an array
+            return self._build_chain(items, op, invop)
+        return ('bin', op, self._build_chain(arrays, op, invop),
+                self._build_chain(scalars, op, invop))
+
+    def _build_chain(self, items, op, invop):
+        if items[0][1]:
+            unit = ('const', op == '*' and '1.0' or '0')
+            ir = ('bin', invop, unit, items[0][0])
+        else:
+            ir = items[0][0]
+        for item, inverted in items[1:]:
+            ir = ('bin', inverted and invop or op, ir, item)
+        return ir
+
+    def emit(self, ir):
+        """Emit statements computing *ir*; return the operand to use."""
+        kind = ir[0]
+        if kind == 'name':
+            return ir[1], ir[1] not in self.params and \
+                not self.is_scalar(ir), False
+        if kind == 'const':
+            return ir[1], False, False
+        if ir in self.cse:
+            name = self.cse[ir]
+            return name, name in self.arrays, True
+        if kind == 'bin':
+            left = self.emit(ir[2])
+            right = self.emit(ir[3])
+            operands = (left[0], right[0])
+            is_array = left[1] or right[1]
+            owned = is_array
+            op = ir[1]
+        elif kind == 'un':
+            arg = self.emit(ir[2])
+            if ir[1] == '+':
+                return arg
+            operands = (arg[0],)
+            is_array = owned = arg[1]
+            op = 'neg'
+        else:
+            args = [self.emit(arg) for arg in ir[2]]
+            operands = tuple(arg[0] for arg in args)
+            is_array = any(arg[1] for arg in args)
+            # numpy ufuncs return new arrays and accept out=
+            owned = is_array and len(args) == 1 and \
+                isinstance(self.namespace.get(ir[1]), np.ufunc)
+            op = ('call', ir[1])
+        name = '_t%d' % len(self.stmts)
+        self.stmts.append((name, op, operands, is_array, owned))
+        if is_array:
+            self.arrays.add(name)
+        self.cse[ir] = name
+        return name, is_array, True
+
+    def generate(self, result):
+        """Generate source lines, doing operations in place on dead arrays."""
+        last_use = {}
+        for i, (_, _, operands, _, _) in enumerate(self.stmts):
+            for operand in operands:
+                last_use[operand] = i
+        last_use[result] = len(self.stmts)
+        owned = set(stmt[0] for stmt in self.stmts if stmt[4])
+        storage = {}
+        lines = []
+        for i, (name, op, operands, is_array, _) in enumerate(self.stmts):
+            dead = [o in owned and last_use[o] == i and
+                    operands.count(o) == 1 for o in operands]
+            ops = [storage.get(o, o) for o in operands]
+            if is_array and op in INPLACE and dead[0]:
+                lines.append('%s = _inplace(%r, %s, %s)' %
+                             (ops[0], op, ops[0], ops[1]))
+                storage[name] = ops[0]
+            elif is_array and INPLACE.get(op) and dead[1]:
+                lines.append('%s = _inplace(%r, %s, %s)' %
+                             (ops[1], op, ops[1], ops[0]))
+                storage[name] = ops[1]
+            elif is_array and op == 'neg' and dead[0]:
+                lines.append('%s = _inplace(%r, %s)' % (ops[0], op, ops[0]))
+                storage[name] = ops[0]
+            elif is_array and isinstance(op, tuple) and dead[0] and \
+                    name in owned:
+                lines.append('%s = _inplace(%s, %s)' % (ops[0], op[1], ops[0]))
+                storage[name] = ops[0]
+            elif op == 'neg':
+                lines.append('%s = -%s' % (name, ops[0]))
+            elif isinstance(op, tuple):
+                lines.append('%s = %s(%s)' % (name, op[1], ', '.join(ops)))
+            else:
+                lines.append('%s = %s %s %s' % (name, ops[0], op, ops[1]))
+        lines.append('return %s' % storage.get(result, result))
+        return lines
+
+
+def compile_expr(expr, params, namespace):
+    """Compile *expr* into optimized function body lines.
+
+    *params* are the (local) parameter names, all other names except "x"
+    are looked up in *namespace*, to which the helpers used by the lines are
+    added.  Raises `ExprError` if the expression can't be handled.
+    """
+    try:
+        tree = ast.parse(expr.strip(), mode='eval')
+    except SyntaxError as err:
+        raise ExprError('invalid expression: %s' % err)
+    compiler = _Compiler(params, namespace)
+    ir = compiler.reassociate(_to_ir(tree))
+    result, _, _ = compiler.emit(ir)
+    namespace['_inplace'] = _inplace
+    return compiler.generate(result)
@@ -8,13 +8,17 @@
 
 """Models for different peak shapes."""
 
-from numpy import exp, log, sqrt, sin, cos, pi
-from scipy.special import wofz
+from numpy import arange, argsort, array, array_equal, asarray, bincount, \
+    concatenate, cumsum, empty, exp, log, newaxis, ndarray, repeat, \
+    searchsorted, sqrt, sin, cos, pi, subtract, unique, zeros
+from scipy.special import erfcx, wofz
 
+from ufit import UFitError
 from ufit.models import Model
 
 __all__ = ['Gauss', 'GaussInt', 'Lorentz', 'LorentzInt',
-           'Voigt', 'PseudoVoigt', 'DHO']
+           'Voigt', 'PseudoVoigt', 'DHO',
+           'GaussArray', 'LorentzArray', 'PseudoVoigtArray']
 
 
 class Gauss(Model):
@@ -138,6 +142,41 @@ class LorentzInt(Model):
         }
 
 
+# coefficients of Humlicek's CPF12 approximation of the Faddeeva function
+# (J. Quant. Spectrosc. Radiat. Transfer 21, 309 (1979)), with the terms for
+# +T and -T merged into one set of 12 poles
+_CPF12_T = array([0.314240376, 0.947788391, 1.59768264, 2.27950708,
+                  3.02063703, 3.8897249])
+_CPF12_C = array([1.01172805, -0.75197147, 1.2557727e-2, 1.00220082e-2,
+                  -2.42068135e-4, 5.00848061e-7])
+_CPF12_S = array([1.393237, 0.231152406, -0.155351466, 6.21836624e-3,
+                  9.19082986e-5, -6.27525958e-7])
+_CPF12_T = concatenate([_CPF12_T, -_CPF12_T])
+_CPF12_C = concatenate([_CPF12_C, _CPF12_C])
+_CPF12_S = concatenate([-_CPF12_S, _CPF12_S])
+
+
+def voigt_re_w(x, y):
+    """Fast approximation of Re w(x + iy), the Faddeeva function, for y >= 0.
+
+    Uses the first region of Humlicek's CPF12 approximation, which needs
+    only real arithmetic.  The absolute error is below 5e-7 of the peak
+    value for all y; far in the wings of nearly Gaussian profiles (y < 0.5)
+    the relative error grows up to 1e-4.
+    """
+    x = asarray(x, float)
+    if x.size > 4096:
+        # keep the (N, 12) temporaries in cache
+        flat = x.ravel()
+        return concatenate([voigt_re_w(flat[i:i+4096], y)
+                            for i in range(0, flat.size, 4096)]
+                           ).reshape(x.shape)
+    y1 = y + 1.5
+    r = subtract.outer(x, _CPF12_T)
+    d = 1. / (r*r + y1*y1)
+    return d.dot(_CPF12_C * y1) + (r*d).dot(_CPF12_S)
+
+
 class Voigt(Model):
     """Voigt peak
 
@@ -149,19 +188,35 @@ class Voigt(Model):
     * `ampl` - Amplitude at center
     * `fwhm` - Full width at half maximum of the Gauss part
     * `shape` - Lorentz contribution
+
+    If `fast` is true, the profile is computed with a rational approximation
+    (see `voigt_re_w`) instead of the complex Faddeeva function; the result
+    agrees to better than 1e-6 of the amplitude.
     """
     param_names = ['pos', 'ampl', 'fwhm', 'shape']
 
-    def __init__(self, name='', pos=None, ampl=None, fwhm=None, shape=None):
+    def __init__(self, name='', pos=None, ampl=None, fwhm=None, shape=None,
+                 fast=False):
         pp, pa, pf, psh = self._init_params(name, self.param_names, locals())
         # amplitude and fwhms should be positive
         self.params[1].finalize = abs
         self.params[2].finalize = abs
         self.params[3].finalize = abs
-
-        self.fcn = lambda p, x: \
-            p[pa] / wofz(1j*sqrt(log(2))*p[psh]).real * \
-            wofz(2*sqrt(log(2)) * (x-p[pp])/p[pf] + 1j*sqrt(log(2))*p[psh]).real
+        self.fast = fast
+        sqrtln2 = sqrt(log(2))
+
+        # Re w(iy) = erfcx(y) gives the normalization to the peak value
+        # without a complex evaluation; it is the same for all x.  Since the
+        # shape is finalized with abs, its sign is ignored in both modes.
+        if fast:
+            self.fcn = lambda p, x: \
+                p[pa] / erfcx(sqrtln2*abs(p[psh])) * \
+                voigt_re_w(2*sqrtln2 * (x-p[pp])/p[pf], sqrtln2*abs(p[psh]))
+        else:
+            self.fcn = lambda p, x: \
+                p[pa] / erfcx(sqrtln2*abs(p[psh])) * \
+                wofz(2*sqrtln2 * (x-p[pp])/p[pf] +
+                     1j*sqrtln2*abs(p[psh])).real
 
     pick_points = ['peak', 'width']
 
@@ -173,6 +228,17 @@ class Voigt(Model):
             self.params[3].name: 0,
         }
 
+    def get_description(self):
+        if self.python_code or not self.fast:
+            return Model.get_description(self)
+        return 'Voigt(%r, fast=True)' % self.name
+
+    def __reduce__(self):
+        if self.python_code:
+            return Model.__reduce__(self)
+        return (self.__class__, (self.name,) + tuple(self.params) +
+                (self.fast,))
+
 
 class PseudoVoigt(Model):
     """Pseudo-Voigt peak
@@ -261,23 +327,309 @@ class Gauss2D(Model):
     * `fwhm_x` - Full width in X direction
     * `fwhm_y` - Full width in Y direction
     * `theta`  - rotation of Gaussian in radians
+
+    If `roi` is given, the Gaussian is only evaluated for points within `roi`
+    times the larger FWHM of the current center; outside, the model is
+    just the background.  Points on a regular grid (e.g. image pixels) are
+    evaluated as a product of X and Y profiles while `theta` is zero.
     """
     param_names = ['bkgd', 'pos_x', 'pos_y', 'ampl', 'fwhm_x', 'fwhm_y', 'theta']
 
     def __init__(self, name='', bkgd=None, pos_x=None, pos_y=None, ampl=None,
-                 fwhm_x=None, fwhm_y=None, theta=None):
+                 fwhm_x=None, fwhm_y=None, theta=None, roi=None):
         pb, ppx, ppy, pa, pfx, pfy, pth = self._init_params(
             name, self.param_names, locals())
         self.params[3].finalize = abs
         self.params[4].finalize = abs
         self.params[5].finalize = abs
+        self.roi = roi
+        self._xcache = (None, None, None)
 
         def fcn(p, x):
-            # rotate coordinate system by theta
-            c, s = cos(p[pth]), sin(p[pth])
-            x1 = (x[:, 0] - p[ppx])*c - (x[:, 1] - p[ppy])*s
-            y1 = (x[:, 0] - p[ppx])*s + (x[:, 1] - p[ppy])*c
-            return abs(p[pb]) + abs(p[pa]) * \
-                exp(-x1**2/p[pfx]**2 * 4*log(2)) * \
-                exp(-y1**2/p[pfy]**2 * 4*log(2))
+            if p[pth] == 0 or roi is not None:
+                self._check_xcache(x)
+            if p[pth] == 0:
+                grid = self._get_grid(x)
+                if grid is not None:
+                    # separable evaluation on the distinct X and Y values
+                    ux, ix, uy, iy = grid
+                    return abs(p[pb]) + abs(p[pa]) * \
+                        self._profile(ux, p[ppx], p[pfx])[ix] * \
+                        self._profile(uy, p[ppy], p[pfy])[iy]
+            if roi is None:
+                return abs(p[pb]) + self._rotated(
+                    x, abs(p[pa]), p[ppx], p[ppy], p[pfx], p[pfy], p[pth])
+            # select the points around the center using the points
+            # sorted by X, then the Y distance
+            order, xs = self._get_sorted(x)
+            width = roi * max(abs(p[pfx]), abs(p[pfy]))
+            lo, hi = searchsorted(xs, [p[ppx] - width, p[ppx] + width])
+            idx = order[lo:hi]
+            idx = idx[abs(x[idx, 1] - p[ppy]) < width]
+            result = empty(len(x))
+            result.fill(abs(p[pb]))
+            result[idx] += self._rotated(
+                x[idx], abs(p[pa]), p[ppx], p[ppy], p[pfx], p[pfy], p[pth])
+            return result
         self.fcn = fcn
+
+    def _rotated(self, x, ampl, px, py, fx, fy, theta):
+        # rotate coordinate system by theta
+        c, s = cos(theta), sin(theta)
+        x1 = (x[:, 0] - px)*c - (x[:, 1] - py)*s
+        y1 = (x[:, 0] - px)*s + (x[:, 1] - py)*c
+        return ampl * exp(-x1**2/fx**2 * 4*log(2)) * \
+            exp(-y1**2/fy**2 * 4*log(2))
+
+    def _profile(self, u, pos, fwhm):
+        # 1-D Gaussian on the sorted distinct coordinates u
+        if self.roi is None:
+            return exp((u - pos)**2 * (-4*log(2)/fwhm**2))
+        lo, hi = searchsorted(u, [pos - self.roi*abs(fwhm),
+                                  pos + self.roi*abs(fwhm)])
+        result = zeros(len(u))
+        result[lo:hi] = exp((u[lo:hi] - pos)**2 * (-4*log(2)/fwhm**2))
+        return result
+
+    def _check_xcache(self, x):
+        # the fit calls us with the same X values, analyze them only once;
+        # compare with a copy, since arrays can be changed in place
+        if self._xcache[0] is None or not array_equal(self._xcache[0], x):
+            self._xcache = (x.copy(), None, None)
+
+    def _get_grid(self, x):
+        if self._xcache[1] is None:
+            ux, ix = unique(x[:, 0], return_inverse=True)
+            uy, iy = unique(x[:, 1], return_inverse=True)
+            # only worth it if coordinates repeat (regular grid)
+            grid = (ux, ix, uy, iy) if len(ux) + len(uy) <= len(x) // 2 \
+                else False
+            self._xcache = (self._xcache[0], grid, self._xcache[2])
+        return self._xcache[1] or None
+
+    def _get_sorted(self, x):
+        if self._xcache[2] is None:
+            order = argsort(x[:, 0], kind='mergesort')
+            self._xcache = (self._xcache[0], self._xcache[1],
+                            (order, x[order, 0]))
+        return self._xcache[2]
+
+    def get_description(self):
+        if self.python_code or self.roi is None:
+            return Model.get_description(self)
+        return 'Gauss2D(%r, roi=%r)' % (self.name, self.roi)
+
+    def __reduce__(self):
+        if self.python_code:
+            return Model.__reduce__(self)
+        return (self.__class__, (self.name,) + tuple(self.params) +
+                (self.roi,))
+
+
+class PeakArray(Model):
+    """Base class for models of many peaks of the same shape.
+
+    Each peak has its own set of scalar parameters, named e.g. "name_pos3",
+    but all peaks are evaluated together with vectors of parameter values.
+    Subclasses set `array_params` and implement `_profile()`.
+    """
+    # names of the per-peak parameters, the first one must be "pos"
+    array_params = []
+    # finalizers for per-peak parameters
+    finalizers = {'ampl': abs, 'fwhm': abs}
+
+    def _init_array(self, name, window, init):
+        if init['pos'] is None:
+            raise UFitError('%s needs a list of peak positions' %
+                            self.__class__.__name__)
+        npeaks = len(init['pos'])
+        pnames = []
+        pinit = {}
+        for pname in self.array_params:
+            values = init[pname]
+            if not isinstance(values, (list, ndarray)):
+                values = [values] * npeaks
+            elif len(values) != npeaks:
+                raise UFitError('%s: %d values given for %s, expected %d' %
+                                (self.__class__.__name__, len(values), pname,
+                                 npeaks))
+            for i, value in enumerate(values):
+                pnames.append('%s%d' % (pname, i))
+                pinit['%s%d' % (pname, i)] = value
+        # sort parameters by peak for a readable parameter list
+        nparams = len(self.array_params)
+        pnames = [pnames[j*npeaks + i] for i in range(npeaks)
+                  for j in range(nparams)]
+        pnames_real = self._init_params(name, pnames, pinit)
+        for pname, par in zip(pnames, self.params):
+            par.finalize = self.finalizers.get(pname.rstrip('0123456789'),
+                                               par.finalize)
+        # names of the parameters, grouped by kind then by peak
+        self._pvecs = [pnames_real[j::nparams] for j in range(nparams)]
+        self.npeaks = npeaks
+        self.window = window
+        self._sorted = (None, None, None)
+        self._components = None
+        self.fcn = self._fcn
+
+    def _profile(self, dx, *pvalues):
+        """Evaluate the peak shape at distances *dx* from the peak centers.
+
+        The parameter arrays are given in the order of `array_params` without
+        the position; they are either of the same shape as *dx* or column
+        vectors broadcast against it, so factors only depending on parameters
+        should be grouped to be computed on the small arrays.
+        """
+        raise NotImplementedError
+
+    def _fcn(self, p, x):
+        pos, rest = self._get_vectors(p)
+        if self.window is not None:
+            return self._eval_windowed(x, pos, rest)
+        x = asarray(x)
+        pos = pos[:, newaxis]
+        rest = [v[:, newaxis] for v in rest]
+        # evaluate in blocks of x, keeping the (npeaks, block) temporaries
+        # in cache
+        block = max(256, 32768 // len(pos))
+        if len(x) <= block:
+            return self._profile(x - pos, *rest).sum(0)
+        return concatenate([self._profile(x[i:i+block] - pos, *rest).sum(0)
+                            for i in range(0, len(x), block)])
+
+    def _get_vectors(self, p):
+        vecs = [array([p[n] for n in names]) for names in self._pvecs]
+        return vecs[0], vecs[1:]
+
+    def _eval_windowed(self, x, pos, rest):
+        # only evaluate each peak within window*fwhm of its center; the x
+        # values are sorted once (the fit calls us with the same array)
+        x = asarray(x)
+        if self._sorted[0] is not x:
+            order = argsort(x, kind='mergesort')
+            self._sorted = (x, order, x[order])
+        order, xs = self._sorted[1:]
+        halfwidth = self.window * abs(rest[self.array_params.index('fwhm')
+                                           - 1])
+        lo = searchsorted(xs, pos - halfwidth)
+        hi = searchsorted(xs, pos + halfwidth, 'right')
+        counts = (hi - lo).clip(0)
+        peak = repeat(arange(len(pos)), counts)
+        idx = arange(counts.sum()) + repeat(lo - cumsum(counts) + counts,
+                                            counts)
+        vals = self._profile(xs[idx] - pos[peak], *(v[peak] for v in rest))
+        result = empty(len(x))
+        result[order] = bincount(idx, weights=vals, minlength=len(x))
+        return result
+
+    def get_components(self):
+        if self._components is None:
+            self._components = [PeakArrayComponent(self, i)
+                                for i in range(self.npeaks)]
+        return self._components
+
+    def get_description(self):
+        if self.python_code:
+            return self.python_code
+        pos = [p.value for p in self.params[::len(self.array_params)]]
+        return '%s(%r, pos=%r, window=%r)' % (self.__class__.__name__,
+                                              self.name, pos, self.window)
+
+    def __reduce__(self):
+        if self.python_code:
+            return Model.__reduce__(self)
+        nparams = len(self.array_params)
+        return (self.__class__, (self.name,) + tuple(
+            self.params[j::nparams] for j in range(nparams)) + (self.window,))
+
+    def convert_pick(self, *args):
+        return {}
+
+
+class PeakArrayComponent(Model):
+    """A single peak of a `PeakArray` model, used for plotting."""
+
+    def __init__(self, parent, index):
+        self.name = '%s%d' % (parent.name and parent.name + '_' or 'peak',
+                              index)
+        nparams = len(parent.array_params)
+        self.params = parent.params[index*nparams:(index+1)*nparams]
+        pnames = [names[index] for names in parent._pvecs]
+        profile = parent._profile
+
+        self.fcn = lambda p, x: \
+            profile(x - p[pnames[0]], *(p[n] for n in pnames[1:]))
+
+
+class GaussArray(PeakArray):
+    """Array of Gaussian peaks
+
+    Parameters (given as lists with one entry per peak; a single value
+    is used for all peaks):
+
+    * `pos` - Peak center positions
+    * `ampl` - Amplitudes at center
+    * `fwhm` - Full widths at half maximum
+
+    If `window` is given, each peak is only evaluated within `window`
+    times its FWHM of the center.
+    """
+    array_params = ['pos', 'ampl', 'fwhm']
+
+    def __init__(self, name='', pos=None, ampl=None, fwhm=None, window=None):
+        self._init_array(name, window, locals())
+
+    def _profile(self, dx, ampl, fwhm):
+        return abs(ampl) * exp(dx**2 * (-4*log(2)/fwhm**2))
+
+
+class LorentzArray(PeakArray):
+    """Array of Lorentzian peaks
+
+    Parameters (given as lists with one entry per peak; a single value
+    is used for all peaks):
+
+    * `pos` - Peak center positions
+    * `ampl` - Amplitudes at center
+    * `fwhm` - Full widths at half maximum
+
+    If `window` is given, each peak is only evaluated within `window`
+    times its FWHM of the center; note that the Lorentzian tails are
+    long, a window of 10 still cuts off 0.25% of the amplitude.
+    """
+    array_params = ['pos', 'ampl', 'fwhm']
+
+    def __init__(self, name='', pos=None, ampl=None, fwhm=None, window=None):
+        self._init_array(name, window, locals())
+
+    def _profile(self, dx, ampl, fwhm):
+        return abs(ampl) / (1 + dx**2 * (4/fwhm**2))
+
+
+class PseudoVoigtArray(PeakArray):
+    """Array of Pseudo-Voigt peaks
+
+    Parameters (given as lists with one entry per peak; a single value
+    is used for all peaks):
+
+    * `pos` - Peak center positions
+    * `ampl` - Amplitudes at center
+    * `fwhm` - Full widths at half maximum
+    * `eta` - Lorentzicities
+
+    If `window` is given, each peak is only evaluated within `window`
+    times its FWHM of the center.
+    """
+    array_params = ['pos', 'ampl', 'fwhm', 'eta']
+    # eta should be between 0 and 1
+    finalizers = {'ampl': abs, 'fwhm': abs, 'eta': lambda e: e % 1.0}
+
+    def __init__(self, name='', pos=None, ampl=None, fwhm=None, eta=0.5,
+                 window=None):
+        self._init_array(name, window, locals())
+
+    def _profile(self, dx, ampl, fwhm, eta):
+        eta = eta % 1.0
+        dx2 = dx**2
+        return (abs(ampl) * eta) / (1 + dx2 * (4/fwhm**2)) + \
+            (abs(ampl) * (1 - eta)) * exp(dx2 * (-4*log(2)/fwhm**2))
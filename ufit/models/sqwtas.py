@@ -8,15 +8,17 @@
 
 """Model of S(q,w) with resolution convolution for TAS."""
 
-import inspect
+import hashlib
 
-from numpy import matrix as zeros
+from numpy import asarray, matrix as zeros
 
+from ufit.cluster import function_code
 from ufit.rescalc import resmat, calc_MC, calc_MC_cluster, calc_MC_mcstas, \
-    load_cfg, load_par, PARNAMES, CFGNAMES, plot_resatpoint
+    calc_GH, load_cfg, load_par, PARNAMES, CFGNAMES, plot_resatpoint, \
+    plot_resalongscan, ResolutionGrid
 from ufit.models.base import Model
 from ufit.param import prepare_params, update_params
-from ufit.pycompat import string_types
+from ufit.pycompat import getargspec, string_types
 
 __all__ = ['ConvolvedScatteringLaw']
 
@@ -29,8 +31,13 @@ class ConvolvedScatteringLaw(Model):
 
        sqw(h, k, l, E, QE0, Sigma, par0, par1, ...)
 
-    If the function is given as a string, it it taken as ``module:function``.
-    The calculation is then clustered using SSH and ufit.cluster.
+    If the function is given as a string, it it taken as ``module:function``,
+    and the source of the module is sent to the workers.  Functions given
+    directly are sent by reference, or serialized if that is not possible
+    (see ufit.cluster.function_code).
+
+    The Monte-Carlo calculation runs in parallel on local worker processes,
+    or with *cluster* true, on the workers configured for ufit.cluster.
 
     h,k,l,E are arrays of the Monte-Carlo point coordinates, QE0 is the center
     of the ellipse, Sigma are the ellipse widths around the center.  A constant
@@ -46,23 +53,48 @@ class ConvolvedScatteringLaw(Model):
     Use cfg_ALL=1 or par_ALL=1 to add all cfg or par entries to the fit
     parameters (this is mostly useful to interactively play around with the
     resolution in one scan).
+
+    If *quadrature* is given, it is the number of Gauss-Hermite nodes per
+    dimension used to integrate over the resolution ellipsoid instead of the
+    Monte-Carlo method (the NMC parameter is then ignored).  For smooth
+    scattering laws, an order of 4 to 6 gives results comparable to several
+    thousand MC points without the statistical noise.
+
+    If *mcstas* is true, the resolution is taken from a McStas simulation of
+    the instrument; it can also be the path to the compiled McStas instrument.
+    The simulated events for each point are kept in ``resmat.mcstas_bankdir``
+    and reused as long as the instrument parameters don't change.
+
+    If *resgrid* is given, evaluations with at least that many points (e.g.
+    plotting with 4x as many points as data points, or simulating a dense
+    region) take the resolution from a ResolutionGrid interpolated between
+    a coarse grid of exactly calculated points spanning the evaluated points.
+    Set it larger than the number of points in the fitted datasets so that
+    fits use the exact resolution.
+
+    Resolution ellipsoids are cached per point and instrument configuration
+    in ``ufit.rescalc.rescache``; use its ``set_directory()`` method to keep
+    them on disk between sessions.
     """
     nsamples = -1  # for plotting: plot only 4x as many points as datapoints
 
     def __init__(self, sqw, instfiles, NMC=2000, name=None, cluster=False,
-                 mcstas=None, matrix=None, mathkl=None, **init):
-        self._cluster = False
+                 mcstas=None, matrix=None, mathkl=None, quadrature=None,
+                 resgrid=None, **init):
+        self._cluster = cluster
         self._mcstas = mcstas
+        self._quadrature = quadrature
+        self._resgrid = resgrid
+        self._grid = None
         if isinstance(sqw, string_types):
             modname, funcname = sqw.split(':')
             mod = __import__(modname)
             code = open(mod.__file__.rstrip('c')).read()
-            self._sqwfunc = funcname
-            self._sqwcode = code
+            self._sqwcode = code + '\n__sqw = %s\n' % funcname
             self._sqw = getattr(mod, funcname)
             self.name = funcname
-            self._cluster = cluster
-        else:  # cannot cluster
+        else:
+            self._sqwcode = None
             self._sqw = sqw
             self.name = name or sqw.__name__
         init['NMC'] = str(NMC)  # str() makes it a fixed parameter
@@ -116,7 +148,7 @@ class ConvolvedScatteringLaw(Model):
         arg_sqw = getattr(self._sqw, 'py_func', self._sqw)
         self._pvs = self._init_params(name,
                                       ['NMC', 'bkgd'] +
-                                      inspect.getargspec(arg_sqw)[0][6:] +
+                                      getargspec(arg_sqw)[0][6:] +
                                       instparnames, init)
         self._ninstpar = len(instparnames)
         self._resmat = resmat(cfg_orig, par_orig)
@@ -126,6 +158,17 @@ class ConvolvedScatteringLaw(Model):
             self._resmat.setNPMatrix(matrix, mathkl)
             # self._resmat.NP = matrix
             self._resmat.R0_corrected = 1.0
+        if isinstance(mcstas, string_types):
+            self._resmat.mcstas_executable = mcstas
+
+    def _get_grid(self, x):
+        if not self._resgrid or len(x) < self._resgrid:
+            return None
+        key = (self._resmat._cache.config_key(self._resmat),
+               hashlib.sha1(asarray(x, dtype=float).tobytes()).hexdigest())
+        if self._grid is None or self._grid[0] != key:
+            self._grid = key, ResolutionGrid(self._resmat, x)
+        return self._grid[1]
 
     def fcn(self, p, x):
         parvalues = [p[pv] for pv in self._pvs]
@@ -138,20 +181,24 @@ class ConvolvedScatteringLaw(Model):
                     self._resmat.par[pn] = pv
                 else:
                     self._resmat.cfg[pn] = pv
-            use_caching = False
         else:
             sqwpar = parvalues[2:]
-            use_caching = True
         if self._mcstas:
             res = calc_MC_mcstas(x, sqwpar, self._sqw, self._resmat,
                                  parvalues[0])
-        elif self._cluster:
-            res = calc_MC_cluster(x, sqwpar, self._sqwcode,
-                                  self._sqwfunc, self._resmat, parvalues[0],
-                                  use_caching=use_caching)
+        elif self._quadrature:
+            res = calc_GH(x, sqwpar, self._sqw, self._resmat,
+                          self._quadrature, grid=self._get_grid(x))
+        elif self._cluster or self._sqwcode:
+            sqwcode = self._sqwcode or function_code(self._sqw, '__sqw')
+            res = calc_MC_cluster(x, sqwpar, sqwcode, self._resmat,
+                                  parvalues[0], grid=self._get_grid(x),
+                                  local=not self._cluster)
         else:
-            res = calc_MC(x, sqwpar, self._sqw, self._resmat,
-                          parvalues[0], use_caching=use_caching)
+            # calc_MC falls back to a forked pool for functions that can't
+            # be transferred to the local workers
+            res = calc_MC(x, sqwpar, self._sqw, self._resmat, parvalues[0],
+                          grid=self._get_grid(x))
         res += parvalues[1]  # background
         # t2 = time.time()
         # print 'Sqw: iteration = %.3f sec' % (t2-t1)
@@ -161,6 +208,13 @@ class ConvolvedScatteringLaw(Model):
         self._resmat.sethklen(h, k, l, e)
         plot_resatpoint(self._resmat.cfg, self._resmat.par, self._resmat)
 
+    def resplot_scan(self, data, axes=(0, 3), projection=True):
+        """Plot the resolution ellipses at all points of *data* (a dataset or
+        an array of (h, k, l, E) points), see rescalc.plot_resalongscan.
+        """
+        points = getattr(data, 'x', data)
+        plot_resalongscan(self._resmat, points, axes, projection)
+
     def simulate(self, data):
         varying, varynames, dependent, _ = prepare_params(self.params, data.meta)
         pd = dict((p.name, p.value) for p in self.params)
@@ -28,6 +28,12 @@ else:
 # all builtin number types (useful for isinstance checks)
 number_types = integer_types + (float,)
 
+# inspect.getargspec was removed in Python 3.11
+if six.PY2:
+    from inspect import getargspec
+else:
+    from inspect import getfullargspec as getargspec
+
 # missing str/bytes helpers
 
 if six.PY2:
@@ -13,13 +13,24 @@ Marc Janoschek.
 """
 
 import os
+import shutil
+import hashlib
+import tempfile
+import subprocess
 import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict
 
 from numpy import pi, radians, degrees, sin, cos, tan, arcsin, arccos, \
     arctan2, abs, sqrt, real, matrix, diag, cross, dot, array, arange, \
-    zeros, concatenate, reshape, delete, loadtxt
+    zeros, concatenate, reshape, delete, loadtxt, asarray, indices, prod, \
+    savez, save, load, matmul, full, nan, isnan, linspace, meshgrid
 from numpy.random import randn
-from numpy.linalg import inv, det, eig, norm
+from numpy.linalg import inv, det, eig, eigh, norm, svd
+from numpy.polynomial.hermite import hermgauss
+from scipy.interpolate import RegularGridInterpolator
+
+from ufit import UFitError
 
 
 class unitcell(object):
@@ -329,6 +340,11 @@ CFGDESC = [
     "height monitor"
 ]
 
+# McStas instrument used by resmat.run_mcstas, and directory where the
+# simulated event banks are kept
+MCSTAS_EXECUTABLE = '/data/software/ufit/mcstas/templateTAS.out'
+MCSTAS_BANKDIR = os.path.join(tempfile.gettempdir(), 'ufit-mcstas')
+
 MEV2AA2 = 0.48259642  # hbar**2/(2 * m_n)
 MIN2RAD = 1/60. * pi/180.
 
@@ -354,6 +370,10 @@ class resmat(object):
         # use a fixed resolution matrix
         self.fixed_res = False
 
+        # settings for McStas simulation of the resolution
+        self.mcstas_executable = MCSTAS_EXECUTABLE
+        self.mcstas_bankdir = MCSTAS_BANKDIR
+
         # a string message or None if calculations are fine
         self.ERROR = None
 
@@ -372,7 +392,7 @@ class resmat(object):
         self.calc_popovici()
         self.calc_STrafo()
 
-        self._cache = {}
+        self._cache = rescache
 
     def calc_popovici(self):
         """Performs the actual calculation.
@@ -831,11 +851,12 @@ Resolution Info:
 
     __repr__ = __str__
 
-    def run_mcstas(self, NMC, QE):
-        os.system('rm -rf /tmp/x')
-        cmd = '/data/software/ufit/mcstas/templateTAS.out -n%g' % (NMC * 1000)
-        cmd += ' --dir /tmp/x'
-        for p in self.par:
+    def mcstas_args(self, NMC, QE):
+        """Return the McStas command line (without output directory) that
+        simulates the resolution at the point *QE*, as a list.
+        """
+        args = [self.mcstas_executable, '-n%g' % (NMC * 1000)]
+        for p in sorted(self.par):
             if p in ('qx', 'qy', 'qz', 'en', 'de', 'dqx', 'dqy', 'dqz', 'gh',
                      'gk', 'gl', 'gmod', 'etas'):
                 continue
@@ -844,17 +865,17 @@ Resolution Info:
                 pn = 'KFIX'
             if p == 'kfix':
                 pn = 'FX'
-            cmd += ' %s=%s' % (pn, self.par[p])
-        cmd += ' L1=%s L2=%s L3=%s L4=%s' % (self.cfg[19]/100,
-                                             self.cfg[20]/100,
-                                             self.cfg[21]/100,
-                                             self.cfg[22]/100)
-        cmd += ' WM=%s HM=%s WA=%s HA=%s WD=%s HD=%s' % (self.cfg[14]/100,
-                                                         self.cfg[15]/100,
-                                                         self.cfg[17]/100,
-                                                         self.cfg[18]/100,
-                                                         self.cfg[11]/100,
-                                                         self.cfg[12]/100)
+            args.append('%s=%s' % (pn, self.par[p]))
+        args.append('L1=%s' % (self.cfg[19]/100))
+        args.append('L2=%s' % (self.cfg[20]/100))
+        args.append('L3=%s' % (self.cfg[21]/100))
+        args.append('L4=%s' % (self.cfg[22]/100))
+        args.append('WM=%s' % (self.cfg[14]/100))
+        args.append('HM=%s' % (self.cfg[15]/100))
+        args.append('WA=%s' % (self.cfg[17]/100))
+        args.append('HA=%s' % (self.cfg[18]/100))
+        args.append('WD=%s' % (self.cfg[11]/100))
+        args.append('HD=%s' % (self.cfg[12]/100))
         # if self.cfg[23] <= 0:
         #    cmd += ' RMH=%s' % self.cfg[23]
         # else:
@@ -871,20 +892,23 @@ Resolution Info:
         #    cmd += ' RAV=%s' % self.cfg[26]
         # else:
         #    cmd += ' RAV=%s' % (1/self.cfg[26]/100)
-        cmd += ' swidth=%s sheight=%s sthick=%s' % (self.cfg[7]/100,
-                                                    self.cfg[8]/100,
-                                                    self.cfg[9]/100)
-        cmd += ' QH=%s QK=%s QL=%s EN=%s' % tuple(QE)
-        print('[MCSTAS] running: %s' % cmd)
-        os.system(cmd)
-        print('[MCSTAS] finished')
+        args.append('swidth=%s' % (self.cfg[7]/100))
+        args.append('sheight=%s' % (self.cfg[8]/100))
+        args.append('sthick=%s' % (self.cfg[9]/100))
+        args.extend('%s=%s' % item for item in zip(('QH', 'QK', 'QL', 'EN'), QE))
+        return args
+
+    def _read_mcstas_events(self, directory):
+        """Read the events written by the McStas run into *directory* and
+        return them as a (5, N) array of qh, qk, ql, w and weight.
+        """
         try:
-            arr = loadtxt('/tmp/x/res.dat', ndmin=2)
+            arr = loadtxt(os.path.join(directory, 'res.dat'), ndmin=2)
         except IOError:
-            return [], [], [], [], []
-        # some mcstas bug?!
-        if len(arr.T) == 4:
-            return [], [], [], [], []
+            return zeros((5, 0))
+        # no events, or some mcstas bug?!
+        if not len(arr) or len(arr.T) == 4:
+            return zeros((5, 0))
         kix, kiy, kiz, kfx, kfy, kfz, x, y, z, pi, pf = arr.T
         # NOTE: cyclic shift of x, y, z here due to different coordinate system
         # conventions in McStas and here:
@@ -893,9 +917,85 @@ Resolution Info:
         Q = array((kiz, kix, kiy)) - array((kfz, kfx, kfy))
         w = 2.072*(kix**2 + kiy**2 + kiz**2 - kfx**2 - kfy**2 - kfz**2)
         p = pi*pf/1e7
-        print('%d neutrons for MC calculation' % len(w))
-        Q = array([array(dot(self.unitc.cart2rluMat, q))[0] for q in Q.T]).T
-        return Q[0], Q[1], Q[2], w, p
+        Q = asarray(dot(self.unitc.cart2rluMat, Q))
+        return concatenate((Q, [w], [p]))
+
+    def _simulate_mcstas(self, args, bankfile):
+        """Run McStas and store the events in *bankfile*.  Returns false if
+        there are no events; that bank is not stored.
+        """
+        tmpdir = tempfile.mkdtemp(prefix='ufit-mcstas-')
+        try:
+            # McStas refuses to write into an existing directory
+            outdir = os.path.join(tmpdir, 'out')
+            print('[MCSTAS] running: %s' % ' '.join(args))
+            logname = os.path.join(tmpdir, 'log')
+            with open(logname, 'wb') as logfile:
+                ret = subprocess.call(args + ['--dir', outdir], stdout=logfile,
+                                      stderr=subprocess.STDOUT)
+            if ret != 0:
+                with open(logname, 'rb') as logfile:
+                    log = logfile.read().decode('utf-8', 'replace')
+                raise UFitError('McStas failed with exit code %d, output:\n%s'
+                                % (ret, '\n'.join(log.splitlines()[-20:])))
+            events = self._read_mcstas_events(outdir)
+            print('[MCSTAS] finished, %d neutrons for MC calculation' %
+                  events.shape[1])
+            if not events.shape[1]:
+                return False
+            # write under a temporary name first, so that concurrent readers
+            # of the bank directory never see partial files
+            tmpname = os.path.join(tmpdir, 'bank.npy')
+            with open(tmpname, 'wb') as fp:
+                save(fp, events)
+            shutil.move(tmpname, bankfile)
+            return True
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def mcstas_banks(self, NMC, points):
+        """Return the McStas event banks for all given (h, k, l, E) points, as
+        memory-mapped (5, N) arrays of qh, qk, ql, w and weight, or None for
+        points without events.
+
+        Banks are stored in *self.mcstas_bankdir*, keyed on the McStas command
+        line, so that they are reused between evaluations and sessions.  Points
+        without a bank are simulated concurrently; a `UFitError` is raised if
+        McStas fails.  Simulations without events are not stored.
+        """
+        bankdir = os.path.expanduser(self.mcstas_bankdir)
+        if not os.path.isdir(bankdir):
+            os.makedirs(bankdir)
+        bankfiles = []
+        missing = {}
+        for QE in points:
+            args = self.mcstas_args(NMC, QE)
+            key = hashlib.sha1(' '.join(args).encode()).hexdigest()
+            bankfile = os.path.join(bankdir, key + '.npy')
+            bankfiles.append(bankfile)
+            if not os.path.isfile(bankfile):
+                missing[bankfile] = args
+        if missing:
+            workers = ThreadPool(min(len(missing), multiprocessing.cpu_count()))
+            try:
+                workers.map(lambda item: self._simulate_mcstas(item[1], item[0]),
+                            missing.items())
+            finally:
+                workers.close()
+        banks = []
+        for bankfile in bankfiles:
+            if not os.path.isfile(bankfile):
+                banks.append(None)
+                continue
+            bank = load(bankfile, mmap_mode='r')
+            banks.append(bank if bank.shape[1] else None)
+        return banks
+
+    def run_mcstas(self, NMC, QE):
+        bank = self.mcstas_banks(NMC, [QE])[0]
+        if bank is None:
+            return [], [], [], [], []
+        return tuple(bank)
 
     def calc_STrafo(self):
         """Calculates transformation matrix self.S, which transforms from the
@@ -1056,55 +1156,46 @@ Resolution Info:
 
     def resellipse(self):
         """Returns the projections of the resolution ellipse of a triple axis."""
-        A = self.NP
+        # stack of one matrix, see resellipses
+        A = asarray(self.NP)[None]
 
-        # ----- Remove the vertical component from the matrix.
-        B = [[A[0, 0], A[0, 1], A[0, 3]],
-             [A[1, 0], A[1, 1], A[1, 3]],
-             [A[3, 0], A[3, 1], A[3, 3]]]
-        B = matrix(B)
-        # ----- Work out projections for different cuts through the ellipse
-
-        # ----- S is the rotation matrix that diagonalises the projected ellipse
+        # ----- Work out projections for different cuts through the ellipse.
+        # For the projections, the vertical component is removed from the
+        # matrix (i.e. the ellipsoid is cut at Qz = 0) and the remaining one
+        # is integrated out.
 
         # ----- 1. Qx, Qy plane
         # (this is maximal extension of the resolution ellipsoid parallel to x and
         # y, whereas the slice added later is just a cut through the ellipsoid in
         # the xy-plane)
-        R0 = self.R0
-        _R0P, MP = GaussInt(2, R0, B)
-        # print R0P, MP
-        hwhm_xp, hwhm_yp, theta = calcEllipseAxis(MP)
-        xy_x, xy_y = ellipse_coords(hwhm_xp, hwhm_yp, theta)
-
+        xy_x, xy_y = resellipses(A, (0, 1), (3,))
         # slice through Qx,Qy plane
-        MP = A[0:2, 0:2]
-        hwhm_xp, hwhm_yp, theta = calcEllipseAxis(MP)
-        xys_x, xys_y = ellipse_coords(hwhm_xp, hwhm_yp, theta)
+        xys_x, xys_y = resellipses(A, (0, 1))
 
         # ----- 2. Qx, W plane
-        R0P, MP = GaussInt(1, R0, B)
-        hwhm_xp, hwhm_yp, theta = calcEllipseAxis(MP)
-        xw_x, xw_y = ellipse_coords(hwhm_xp, hwhm_yp, theta)
-
+        xw_x, xw_y = resellipses(A, (0, 3), (1,))
         # slice through Qx,W plane
-        MP = [[A[0, 0], A[0, 3]], [A[3, 0], A[3, 3]]]
-        hwhm_xp, hwhm_yp, theta = calcEllipseAxis(MP)
-        xws_x, xws_y = ellipse_coords(hwhm_xp, hwhm_yp, theta)
+        xws_x, xws_y = resellipses(A, (0, 3))
 
         # ----- 3. Qy, W plane
-        R0P, MP = GaussInt(0, R0, B)
-        hwhm_xp, hwhm_yp, theta = calcEllipseAxis(MP)
-        yw_x, yw_y = ellipse_coords(hwhm_xp, hwhm_yp, theta)
-
+        yw_x, yw_y = resellipses(A, (1, 3), (0,))
         # slice through Qy,W plane
-        MP = [[A[1, 1], A[1, 3]], [A[3, 1], A[3, 3]]]
-        hwhm_xp, hwhm_yp, theta = calcEllipseAxis(MP)
-        yws_x, yws_y = ellipse_coords(hwhm_xp, hwhm_yp, theta)
+        yws_x, yws_y = resellipses(A, (1, 3))
 
-        return xy_x, xy_y, xys_x, xys_y, \
-            xw_x, xw_y, xws_x, xws_y, \
-            yw_x, yw_y, yws_x, yws_y
+        return xy_x[0], xy_y[0], xys_x[0], xys_y[0], \
+            xw_x[0], xw_y[0], xws_x[0], xws_y[0], \
+            yw_x[0], yw_y[0], yws_x[0], yws_y[0]
+
+    def resolution_matrices(self, points):
+        """Return the resolution matrices in the (h, k, l, E) frame for all
+        given points as an array of shape (n, 4, 4).
+
+        The matrices are reconstructed from the (cached) ellipsoids used for
+        the convolution; they are NaN for points where the scattering triangle
+        does not close.
+        """
+        return array([ellipsoid_matrix(ellipsoid) for ellipsoid in
+                      get_ellipsoids(self, points)]).reshape((-1, 4, 4))
 
 
 def rc_int(index, r0, m):
@@ -1191,6 +1282,62 @@ def ellipse_coords(a, b, phi):
     return x, y
 
 
+# batched versions of the ellipse functions, working on stacks of matrices
+
+def project_ellipses(mats, axes, integrate=()):
+    """Return the 2x2 matrices of the resolution ellipses in the plane given
+    by the two indices in *axes* for a stack of resolution matrices (shape
+    (n, N, N)).
+
+    The ellipsoid is integrated over the coordinates in *integrate*
+    (projection), and cut at zero in all others (slice).
+    """
+    mats = asarray(mats)
+    sub = list(axes) + list(integrate)
+    mp = mats[:, sub][:, :, sub]
+    result = mp[:, :2, :2]
+    if integrate:
+        b = mp[:, :2, 2:]
+        result = result - matmul(matmul(b, inv(mp[:, 2:, 2:])),
+                                 b.transpose((0, 2, 1)))
+    return result
+
+
+def ellipses_axes(mps):
+    """Batched version of calcEllipseAxis: return arrays of the half widths
+    along the principal axes and of the rotation angles for a stack of 2x2
+    ellipse matrices.
+    """
+    const = 1.17741
+    m00, m01, m11 = mps[:, 0, 0], mps[:, 0, 1], mps[:, 1, 1]
+    theta = 0.5*arctan2(2*m01, m00 - m11)
+    c, s = cos(theta), sin(theta)
+    hwhm_xp = const/sqrt(c*c*m00 + 2*c*s*m01 + s*s*m11)
+    hwhm_yp = const/sqrt(s*s*m00 - 2*c*s*m01 + c*c*m11)
+    return hwhm_xp, hwhm_yp, theta
+
+
+def ellipses_coords(a, b, phi):
+    """Batched version of ellipse_coords: return arrays of shape (n, 101)
+    with coordinates for ellipses with semiaxes a, b and rotated by phi.
+    """
+    th = arange(0, 2*pi+2*pi/100, 2*pi/100)
+    x = a[:, None]*cos(th)
+    y = b[:, None]*sin(th)
+    c = cos(phi)[:, None]
+    s = sin(phi)[:, None]
+    return x*c - y*s, x*s + y*c
+
+
+def resellipses(mats, axes, integrate=()):
+    """Return x and y coordinates (arrays of shape (n, 101)) of the resolution
+    ellipses in the plane given by *axes* for a stack of resolution matrices.
+    See project_ellipses for *integrate*.
+    """
+    return ellipses_coords(*ellipses_axes(project_ellipses(mats, axes,
+                                                           integrate)))
+
+
 def single_mc(NMC, sqw, fit_par, QE, b_mat, sigma, R0_corrected):
     xp = zeros((4, NMC))
     xp[0, :] = sigma[0]*randn(NMC)
@@ -1210,6 +1357,361 @@ def single_mc(NMC, sqw, fit_par, QE, b_mat, sigma, R0_corrected):
     mc_intens = sqw(qh, qk, ql, w, QE, (b_mat, sigma), *fit_par)
     return R0_corrected * mc_intens.mean()
 
+
+# relative weight below which nodes of the tensor product grid are dropped
+GH_PRUNE = 1e-4
+
+_gh_cache = {}
+
+
+def gh_nodes(order):
+    """Return nodes (4 x N) and weights (N) of a pruned tensor-product
+    Gauss-Hermite rule for the 4D standard normal distribution.
+
+    Nodes whose product weight is smaller than GH_PRUNE times the largest
+    weight are dropped (for order 5 this keeps 417 of 625 nodes), and the
+    remaining weights are renormalized to sum to one.
+    """
+    if order in _gh_cache:
+        return _gh_cache[order]
+    t, w = hermgauss(order)
+    # transform from weight function exp(-t**2) to the standard normal
+    t = t * sqrt(2)
+    w = w / sqrt(pi)
+    idx = indices((order,) * 4).reshape((4, -1))
+    nodes = t[idx]
+    weights = prod(w[idx], axis=0)
+    keep = weights >= GH_PRUNE * weights.max()
+    nodes = nodes[:, keep]
+    weights = weights[keep] / weights[keep].sum()
+    _gh_cache[order] = nodes, weights
+    return nodes, weights
+
+
+def single_gh(order, sqw, fit_par, QE, b_mat, sigma, R0_corrected):
+    """Deterministic counterpart of single_mc: integrate S(q,w) over the
+    resolution ellipsoid using Gauss-Hermite quadrature.
+    """
+    nodes, weights = gh_nodes(order)
+    xp = asarray(sigma).reshape((4, 1)) * nodes
+    XGH = dot(asarray(b_mat).reshape((4, 4)).T, xp)
+
+    qh = XGH[0] + QE[0]
+    qk = XGH[1] + QE[1]
+    ql = XGH[2] + QE[2]
+    w  = XGH[3] + QE[3]
+
+    gh_intens = sqw(qh, qk, ql, w, QE, (b_mat, sigma), *fit_par)
+    return R0_corrected * dot(gh_intens, weights)
+
+
+class ResolutionCache(object):
+    """LRU cache for the resolution ellipsoids (b_mat, sigma, R0_corrected)
+    computed by `resmat`.
+
+    Entries are keyed on the (h, k, l, E) point and a hash of all instrument
+    configuration and parameter values that enter the Popovici calculation,
+    so that entries stay valid while cfg_/par_ values are being fitted and
+    can be shared between models for the same instrument.
+
+    If *directory* is given, the entries for each instrument configuration
+    are also stored there as an .npz file and reloaded on first use, so that
+    they survive a restart of the session.
+    """
+
+    def __init__(self, maxsize=20000, directory=None):
+        self.maxsize = maxsize
+        self.directory = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._loaded = set()
+        self._dirty = set()
+        if directory is not None:
+            self.set_directory(directory)
+
+    def set_directory(self, directory):
+        """Set the directory for persistent storage (None to disable)."""
+        if directory is not None:
+            directory = os.path.expanduser(directory)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        self.directory = directory
+        self._loaded.clear()
+        self._dirty.clear()
+
+    def config_key(self, resmat):
+        """Return a hash of everything except the (h, k, l, E) point that
+        determines the resolution ellipsoid of *resmat*.
+        """
+        h = hashlib.sha1()
+        for name in sorted(resmat.par):
+            if name not in ('qx', 'qy', 'qz', 'en'):
+                h.update(('%s=%r;' % (name, float(resmat.par[name]))).encode())
+        for value in resmat.cfg:
+            h.update(('%r;' % float(value)).encode())
+        if resmat.fixed_res:
+            h.update(asarray(resmat.NP, dtype=float).tobytes())
+        return h.hexdigest()
+
+    def _filename(self, confkey):
+        return os.path.join(self.directory, 'res-%s.npz' % confkey)
+
+    def _load(self, confkey):
+        self._loaded.add(confkey)
+        fn = self._filename(confkey)
+        if not os.path.isfile(fn):
+            return
+        try:
+            data = load(fn)
+            for qe, b_mat, sigma, r0 in zip(data['qe'], data['b_mat'],
+                                            data['sigma'], data['r0']):
+                # b_mat must stay a matrix, single_mc relies on it
+                self._store((confkey, tuple(qe)),
+                            (matrix(b_mat), sigma, float(r0)))
+        except Exception as err:
+            print('Could not load resolution cache file %s: %s' % (fn, err))
+
+    def _store(self, key, value):
+        self._entries[key] = value
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def get(self, confkey, QE):
+        """Return the cached ellipsoid for the point, or None."""
+        if self.directory is not None and confkey not in self._loaded:
+            self._load(confkey)
+        key = (confkey, QE)
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, confkey, QE, value):
+        """Add an ellipsoid for the point."""
+        self._store((confkey, QE), value)
+        if self.directory is not None:
+            self._dirty.add(confkey)
+
+    def flush(self):
+        """Write the entries of all configurations changed since the last
+        flush to the cache directory.
+        """
+        if self.directory is None:
+            return
+        for confkey in self._dirty:
+            items = [(key[1], value) for (key, value) in self._entries.items()
+                     if key[0] == confkey]
+            if not items:
+                continue
+            fn = self._filename(confkey)
+            try:
+                # write to a temporary file first, so that a concurrent
+                # session never reads a partial file
+                with open(fn + '.tmp', 'wb') as fp:
+                    savez(fp,
+                          qe=array([qe for (qe, _) in items]),
+                          b_mat=array([asarray(v[0]).reshape(16)
+                                       for (_, v) in items]),
+                          sigma=array([v[1] for (_, v) in items]),
+                          r0=array([v[2] for (_, v) in items]))
+                os.rename(fn + '.tmp', fn)
+            except Exception as err:
+                print('Could not write resolution cache file %s: %s' % (fn, err))
+        self._dirty.clear()
+
+    def clear(self):
+        """Remove all entries from memory (not from the cache directory) and
+        reset the statistics.
+        """
+        self._entries.clear()
+        self._loaded.clear()
+        self._dirty.clear()
+        self.hits = self.misses = 0
+
+    def stats(self):
+        """Return a dictionary with cache size and hit/miss counts."""
+        return {'size': len(self._entries), 'maxsize': self.maxsize,
+                'hits': self.hits, 'misses': self.misses}
+
+
+# global cache, shared by all resmat instances
+rescache = ResolutionCache()
+
+
+def get_ellipsoid(resmat, QE, confkey=None):
+    """Return (b_mat, sigma, R0_corrected) for the given point, taken from the
+    resolution cache if possible.  *confkey* is the instrument configuration
+    key from `ResolutionCache.config_key`; if it is None, the cache is not
+    used.
+
+    Returns None if the scattering triangle does not close.
+    """
+    if confkey is not None:
+        ellipsoid = resmat._cache.get(confkey, QE)
+        if ellipsoid is not None:
+            return ellipsoid
+    resmat.calcResEllipsoid(*QE)
+    if resmat.ERROR:
+        print('Scattering triangle will not close for point: '
+              'qh = %1.3f qk = %1.3f ql = %1.3f en = %1.3f' % tuple(QE))
+        print('Attention: Intensity is therefore equal to zero at this point!')
+        return None
+    sigma = resmat.calcSigma()
+    ellipsoid = resmat.b_mat[0:16], sigma, resmat.R0_corrected
+    if confkey is not None:
+        resmat._cache.put(confkey, QE, ellipsoid)
+    return ellipsoid
+
+
+def calc_MC_mcstas(x, fit_par, sqw, resmat, NMC):
+    """Version of calc_MC that uses events from a McStas simulation of the
+    instrument instead of the Popovici resolution ellipsoid.
+    """
+    results = []
+    for QE, bank in zip(x, resmat.mcstas_banks(NMC, [tuple(QE) for QE in x])):
+        if bank is None:
+            results.append(0)
+            continue
+        qh, qk, ql, en, weights = bank
+        results.append(dot(sqw(qh, qk, ql, en, QE, None, *fit_par), weights))
+    return array(results)
+
+
+def ellipsoid_matrix(ellipsoid):
+    """Return the resolution matrix in the (h, k, l, E) frame for an
+    ellipsoid as returned by get_ellipsoid (NaN for None).
+    """
+    if ellipsoid is None:
+        return full((4, 4), nan)
+    b_mat, sigma = asarray(ellipsoid[0]).reshape((4, 4)), ellipsoid[1]
+    # invert the covariance matrix of the points sampled by single_mc
+    return inv(dot(b_mat.T * sigma**2, b_mat))
+
+
+def get_ellipsoids(resmat, points, use_caching=True, grid=None):
+    """Return a list of ellipsoids (see get_ellipsoid) for all points.
+
+    If a ResolutionGrid for the current instrument configuration is given,
+    points that are covered by it take the interpolated ellipsoid.
+    """
+    confkey = resmat._cache.config_key(resmat) if use_caching else None
+    if grid is not None and grid.confkey != resmat._cache.config_key(resmat):
+        grid = None
+    ellipsoids = []
+    for QE in points:
+        QE = tuple(QE)
+        ellipsoid = grid.ellipsoid(QE) if grid is not None else None
+        if ellipsoid is None:
+            ellipsoid = get_ellipsoid(resmat, QE, confkey)
+        ellipsoids.append(ellipsoid)
+    resmat._cache.flush()
+    return ellipsoids
+
+
+class ResolutionGrid(object):
+    """Resolution ellipsoids tabulated on a coarse regular grid that spans a
+    set of (h, k, l, E) points, for cheap evaluation at many intermediate
+    points (e.g. for plotting).
+
+    The grid lies in the (usually one- or two-dimensional) affine subspace
+    spanned by the points.  The resolution matrix elements and R0 are
+    linearly interpolated between the nodes.  Starting with *nodes* nodes per
+    dimension, the grid is refined until the relative interpolation error
+    at the cell centers (attribute *error*) is below *tol*.  If the grid
+    would need more than *maxnodes* nodes for that, it is not used (attribute
+    *usable* is false), and the resolution is calculated exactly for all
+    points.
+
+    Points outside of the grid, or next to nodes where the scattering
+    triangle does not close, are not handled (`ellipsoid` returns None).
+    """
+
+    def __init__(self, resmat, points, nodes=9, tol=1e-3, maxnodes=1000):
+        points = asarray(points, dtype=float)
+        self.confkey = resmat._cache.config_key(resmat)
+        self.center = points.mean(axis=0)
+        _, sv, vt = svd(points - self.center)
+        self._offtol = 1e-8 * max(sv.max() if len(sv) else 0, 1)
+        self.dirs = vt[:(sv > self._offtol).sum()]
+        coords = dot(points - self.center, self.dirs.T)
+        self.ndim = len(self.dirs)
+        self._interp = None
+        self.error = 0.
+        self.usable = True
+        if self.ndim == 0:
+            return
+        lo, hi = coords.min(axis=0), coords.max(axis=0)
+        while True:
+            axes = [linspace(lo[i], hi[i], nodes) for i in range(self.ndim)]
+            self._interp = RegularGridInterpolator(
+                axes, self._tabulate(resmat, axes, nodes),
+                bounds_error=False, fill_value=nan)
+            # cell centers, where the linear interpolation error is largest
+            mids = [0.5*(ax[1:] + ax[:-1]) for ax in axes]
+            mvalues = self._tabulate(resmat, mids, nodes - 1)
+            ivalues = self._interp(self._grid_coords(mids))
+            ivalues = ivalues.reshape(mvalues.shape)
+            self.error = self._relerror(ivalues, mvalues)
+            if self.error <= tol:
+                break
+            if (2*nodes - 1)**self.ndim > maxnodes:
+                print('Resolution grid error %.2g with %d nodes is above the '
+                      'tolerance of %.2g, calculating exact resolutions' %
+                      (self.error, nodes**self.ndim, tol))
+                self.usable = False
+                self._interp = None
+                break
+            nodes = 2*nodes - 1
+
+    def _grid_coords(self, axes):
+        mesh = meshgrid(*axes, indexing='ij')
+        return array([m.ravel() for m in mesh]).T
+
+    def _tabulate(self, resmat, axes, n):
+        points = self.center + dot(self._grid_coords(axes), self.dirs)
+        values = [concatenate((ellipsoid_matrix(ellipsoid).ravel(),
+                               [ellipsoid[2] if ellipsoid is not None else nan]))
+                  for ellipsoid in get_ellipsoids(resmat, points)]
+        return array(values).reshape((n,) * self.ndim + (17,))
+
+    def _relerror(self, approx, exact):
+        approx = approx.reshape((-1, 17))
+        exact = exact.reshape((-1, 17))
+        ok = ~(isnan(approx).any(axis=1) | isnan(exact).any(axis=1))
+        if not ok.any():
+            return 0.
+        approx, exact = approx[ok], exact[ok]
+        merr = abs(approx[:, :16] - exact[:, :16]).max(axis=1) / \
+            abs(exact[:, :16]).max(axis=1)
+        rerr = abs(approx[:, 16] - exact[:, 16]) / abs(exact[:, 16])
+        return max(merr.max(), rerr.max())
+
+    def ellipsoid(self, QE):
+        """Return the interpolated (b_mat, sigma, R0_corrected) for the point,
+        or None if the point is not covered by the grid.
+        """
+        if self._interp is None:
+            return None
+        p = asarray(QE, dtype=float) - self.center
+        u = dot(self.dirs, p)
+        if norm(p - dot(u, self.dirs)) > self._offtol:
+            return None
+        value = self._interp(u[None])[0]
+        if isnan(value).any():
+            return None
+        M = value[:16].reshape((4, 4))
+        E, V = eigh(0.5*(M + M.T))
+        if (E <= 0).any():
+            return None
+        # same convention as calcSigma: b_mat is the inverse eigenvector matrix
+        return matrix(V.T.reshape((1, 16))), 1/sqrt(E), value[16]
+
+
 pool = None
 
 
@@ -1221,48 +1723,54 @@ class dummy_result(object):
         return self.res
 
 
-def calc_MC_mcstas(x, fit_par, sqw, resmat, NMC):
-    """Trial with McStas."""
-    results = []
-    for QE in x:
-        qh, qk, ql, en, weights = resmat.run_mcstas(NMC, QE)
-        if qh == []:
-            mc_intens = 0
-        else:
-            mc_intens = (sqw(qh, qk, ql, en, QE, None, *fit_par) * weights).sum()
-        results.append(mc_intens)
-    return array(results)
-
-
-def calc_MC(x, fit_par, sqw, resmat, NMC, use_caching=True):
+def calc_MC(x, fit_par, sqw, resmat, NMC, use_caching=True, grid=None):
     """Calculates intensity of point in reciprocal space (qh,qk,ql,en) at takes
     into account the spectrometer resolution calculated by resolution class
     resmat (which uses the Popovici algorithm to do so).
+
+    The points are calculated in parallel by local worker processes, see
+    calc_MC_cluster.  Functions that can't be transferred to them by
+    reference or with cloudpickle are run in a multiprocessing pool, whose
+    forked processes have the function's module globals.
     """
+    from ufit.cluster import function_code
+    sqwcode = function_code(sqw, '__sqw', source=False)
+    if sqwcode is not None:
+        return calc_MC_cluster(x, fit_par, sqwcode, resmat, NMC, use_caching,
+                               grid, local=True)
     global pool
     if pool is None:
         pool = multiprocessing.Pool(multiprocessing.cpu_count())
     results = []
-    for QE in x:
-        QE = tuple(QE)
-        if QE in resmat._cache and use_caching:
-            b_mat, sigma, R0_corrected = resmat._cache[QE]
-        else:
-            resmat.calcResEllipsoid(*QE)
-            if resmat.ERROR:
-                print('Scattering triangle will not close for point: '
-                      'qh = %1.3f qk = %1.3f ql = %1.3f en = %1.3f' % tuple(QE))
-                print('Attention: Intensity is therefore equal to zero at this point!')
-                results.append(dummy_result(0))
-                continue
-            sigma = resmat.calcSigma()
-            b_mat = resmat.b_mat[0:16]
-            R0_corrected = resmat.R0_corrected
-            resmat._cache[QE] = b_mat, sigma, R0_corrected
-        results.append(pool.apply_async(single_mc, (NMC, sqw, fit_par, QE, b_mat,
-                                                    sigma, R0_corrected)))
+    for QE, ellipsoid in zip(x, get_ellipsoids(resmat, x, use_caching, grid)):
+        if ellipsoid is None:
+            results.append(dummy_result(0))
+            continue
+        b_mat, sigma, R0_corrected = ellipsoid
+        results.append(pool.apply_async(single_mc, (NMC, sqw, fit_par,
+                                                    tuple(QE), b_mat, sigma,
+                                                    R0_corrected)))
     return array([res.get() for res in results])
 
+
+def calc_GH(x, fit_par, sqw, resmat, order, use_caching=True, grid=None):
+    """Version of calc_MC that uses a Gauss-Hermite quadrature of the given
+    order per dimension instead of random sampling.
+
+    For smooth scattering laws this needs a few hundred evaluations per point
+    and the result does not fluctuate between calls, so that numerical
+    derivatives taken by the fitting backend are well-behaved.
+    """
+    results = []
+    for QE, ellipsoid in zip(x, get_ellipsoids(resmat, x, use_caching, grid)):
+        if ellipsoid is None:
+            results.append(0)
+            continue
+        b_mat, sigma, R0_corrected = ellipsoid
+        results.append(single_gh(order, sqw, fit_par, tuple(QE), b_mat, sigma,
+                                 R0_corrected))
+    return array(results)
+
 single_mc_cluster_code = '''
 from numpy import zeros, reshape
 from numpy.random import randn
@@ -1290,29 +1798,23 @@ def single_mc(NMC, fit_par, QE, b_mat, sigma, R0_corrected):
 '''
 
 
-def calc_MC_cluster(x, fit_par, sqwcode, sqwfunc, resmat, NMC, use_caching=True):
-    """Version of calc_MC with clustering support."""
+def calc_MC_cluster(x, fit_par, sqwcode, resmat, NMC, use_caching=True,
+                    grid=None, local=False):
+    """Version of calc_MC with clustering support.
+
+    *sqwcode* must define the S(q,w) function as "__sqw" (see
+    ufit.cluster.function_code).  It is executed only once per worker.
+    """
     from ufit import cluster
     args = []
-    for QE in x:
-        QE = tuple(QE)
-        if QE in resmat._cache and use_caching:
-            b_mat, sigma, R0_corrected = resmat._cache[QE]
-        else:
-            resmat.calcResEllipsoid(*QE)
-            if resmat.ERROR:
-                print('Scattering triangle will not close for point: '
-                      'qh = %1.3f qk = %1.3f ql = %1.3f en = %1.3f' % tuple(QE))
-                print('Attention: Intensity is therefore equal to zero at this point!')
-                args.append((0, [], None, None, None, None))
-                continue
-            sigma = resmat.calcSigma()
-            b_mat = resmat.b_mat[0:16]
-            R0_corrected = resmat.R0_corrected
-            resmat._cache[QE] = b_mat, sigma, R0_corrected
-        args.append((NMC, fit_par, QE, b_mat, sigma, R0_corrected))
-    code = sqwcode + '\n__sqw = %s\n' % sqwfunc + single_mc_cluster_code
-    return array(cluster.run_cluster(code, 'single_mc', args))
+    for QE, ellipsoid in zip(x, get_ellipsoids(resmat, x, use_caching, grid)):
+        if ellipsoid is None:
+            args.append((0, [], None, None, None, None))
+            continue
+        b_mat, sigma, R0_corrected = ellipsoid
+        args.append((NMC, fit_par, tuple(QE), b_mat, sigma, R0_corrected))
+    code = sqwcode + single_mc_cluster_code
+    return array(cluster.run_cluster(code, 'single_mc', args, local=local))
 
 
 def load_par(filename):
@@ -1437,3 +1939,38 @@ $a$ (\AA) & $b$ (\AA) & $c$ (\AA) & $\alpha$ ($^{\circ}$) & $\beta$ ($^{\circ}$)
                     transform=ax3.transAxes)
     t3.set_size(10)
     pylab.show()
+
+
+AXISLABELS = ['h (r.l.u.)', 'k (r.l.u.)', 'l (r.l.u.)', 'Energy (meV)']
+
+
+def plot_resalongscan(resmat, points, axes=(0, 3), projection=True,
+                      fignum='Resolution along scan'):
+    """Plot the resolution ellipses for all given (h, k, l, E) points in the
+    plane given by the two indices *axes* (0-2 for h, k, l, 3 for E).
+
+    With *projection* true, the ellipsoids are integrated over the other two
+    coordinates, otherwise they are cut at the point.
+    """
+    import pylab
+    from matplotlib.collections import LineCollection
+
+    points = asarray(points, dtype=float)
+    mats = resmat.resolution_matrices(points)
+    ok = ~isnan(mats).any(axis=(1, 2))
+    integrate = [i for i in range(4) if i not in axes] if projection else []
+    xs, ys = resellipses(mats[ok], axes, integrate)
+    xs += points[ok, axes[0]][:, None]
+    ys += points[ok, axes[1]][:, None]
+
+    pylab.figure(fignum)
+    pylab.clf()
+    pylab.connect('key_press_event', pylab_key_handler)
+    ax = pylab.gca()
+    ax.add_collection(LineCollection(
+        [list(zip(x, y)) for (x, y) in zip(xs, ys)]))
+    ax.plot(points[ok, axes[0]], points[ok, axes[1]], 'o', ms=3)
+    ax.autoscale_view()
+    ax.set_xlabel(AXISLABELS[axes[0]])
+    ax.set_ylabel(AXISLABELS[axes[1]])
+    pylab.show()